@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+
+# ==========================================
+# 既存メンバーの一括オンボーディング
+# ==========================================
+# 1人ずつ create_personal_channel を呼ぶと数千人規模では何時間もかかるため、
+# 同時実行数を絞ったワーカーで並行に処理する。
+# Discord のルートごとのレート制限は discord.py の HTTP クライアントが
+# 429 / X-RateLimit ヘッダを見て待つので、ここでは同時実行数だけを管理する。
+# 進捗は DB に記録し、落ちても pending のメンバーから再開できる。
+
+class OnboardingBackfill:
+    """
+    provision(member) を全対象メンバーに対して並行実行するジョブ
+    """
+
+    def __init__(self, store, state, provision, concurrency=4, checkpoint_every=10.0):
+        self.store = store
+        self.state = state
+        self.provision = provision
+        self.concurrency = concurrency
+        self.checkpoint_every = checkpoint_every
+        self._running = set() # 実行中のギルドID
+
+    def is_running(self, guild_id):
+        return guild_id in self._running
+
+    def plan(self, guild, members):
+        """
+        対象メンバーを pending として登録し、未処理のメンバーID一覧を返す
+        """
+        self.store.backfill_enqueue(guild.id, [member.id for member in members], time.time())
+        return self.store.backfill_pending(guild.id)
+
+    async def run(self, guild, report=None, report_every=30.0):
+        """
+        pending のメンバーを処理する。report(stats) は進捗報告用のコルーチン関数
+        """
+        if guild.id in self._running:
+            return None
+        self._running.add(guild.id)
+        try:
+            return await self._run(guild, report, report_every)
+        finally:
+            self._running.discard(guild.id)
+
+    async def _run(self, guild, report, report_every):
+        pending = self.store.backfill_pending(guild.id)
+        queue = asyncio.Queue()
+        for member_id in pending:
+            queue.put_nowait(member_id)
+
+        total = len(pending)
+        done = []
+        failed = []
+        started = time.monotonic()
+        last_checkpoint = started
+        last_report = started
+
+        def stats():
+            elapsed = time.monotonic() - started
+            processed = len(done) + len(failed)
+            rate = processed / elapsed if elapsed > 0 else 0.0
+            remaining = total - processed
+            return {
+                "total": total,
+                "done": len(done),
+                "failed": len(failed),
+                "elapsed": elapsed,
+                "rate_per_min": rate * 60,
+                "eta": remaining / rate if rate > 0 else None,
+            }
+
+        finished_done = []
+        finished_failed = []
+
+        def checkpoint():
+            # DB の書き出しを済ませてから done を記録する
+            # （done なのにユーザー行が消えている、という状態を作らない）
+            # 履歴の圧縮中は書き出しが止まっているので、記録も次の機会に回す
+            if self.state.flush_held:
+                return False
+            self.state.flush()
+            now = time.time()
+            self.store.backfill_mark(guild.id, finished_done, "done", now)
+            self.store.backfill_mark(guild.id, finished_failed, "failed", now)
+            finished_done.clear()
+            finished_failed.clear()
+            return True
+
+        async def worker():
+            while True:
+                try:
+                    member_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                member = guild.get_member(member_id)
+                try:
+                    if member is None:
+                        # 途中で退出したメンバーは完了扱い
+                        pass
+                    else:
+                        await self.provision(member)
+                    done.append(member_id)
+                    finished_done.append(member_id)
+                except Exception as e:
+                    print(f"Backfill Error ({member_id}): {e}")
+                    failed.append(member_id)
+                    finished_failed.append(member_id)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            while not all(w.done() for w in workers):
+                await asyncio.wait(workers, timeout=1.0)
+                now = time.monotonic()
+                if now - last_checkpoint >= self.checkpoint_every and checkpoint():
+                    last_checkpoint = now
+                if report and now - last_report >= report_every:
+                    await report(stats())
+                    last_report = now
+        finally:
+            for w in workers:
+                w.cancel()
+            while not checkpoint():
+                await asyncio.sleep(1.0)
+
+        return stats()
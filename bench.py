@@ -0,0 +1,566 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from keywords import AhoCorasick, load_keywords
+
+# ベンチマーク一式
+# Usage:
+#   python bench.py generate noise_db.json --users 20 --history 100   # 合成コーパスを作る
+#   python bench.py run --output bench_results.json                   # 計測して JSON に書き出す
+#   python bench.py compare before.json after.json                     # 2回分の結果を比べる
+# run は一時ディレクトリで動き、作業ディレクトリのデータベースには触れない。
+# 結果の各項目は {"value", "unit", "better": "lower" / "higher"} を持つ。
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DIM = 768
+BAND = (0.5, 0.7)
+N_CLUSTERS = 50
+
+KEYWORDS = load_keywords(os.path.join(REPO_DIR, "keywords.txt"))
+OPENERS = ["今日は", "なんとなく", "ふと", "最近", "やっぱり", "正直", "昨日の夜", "ずっと", "朝から", "帰り道で"]
+NOUNS = ["コーヒー", "雨", "電車", "猫", "仕事", "友達", "音楽", "散歩", "締め切り", "季節", "夢", "部屋"]
+ENDINGS = [
+    "について考えていた。", "が気になっている。", "のことを書いておく。", "は奥が深い。",
+    "をもっと知りたい。", "にモヤモヤする。", "で頭がいっぱい。", "が最高だった。",
+]
+
+
+# ==========================================
+# 合成コーパス
+# ==========================================
+def make_text(rng):
+    """
+    キーワードを含みやすい日本語の短文
+    """
+    parts = []
+    for _ in range(int(rng.integers(1, 4))):
+        word = KEYWORDS[int(rng.integers(len(KEYWORDS)))] if rng.random() < 0.6 else NOUNS[int(rng.integers(len(NOUNS)))]
+        parts.append(f"{OPENERS[int(rng.integers(len(OPENERS)))]}{word}{ENDINGS[int(rng.integers(len(ENDINGS)))]}")
+    return "".join(parts)
+
+
+def cluster_centers(seed):
+    return np.random.default_rng(seed).normal(size=(N_CLUSTERS, DIM))
+
+
+def make_vectors(rng, centers, n):
+    """
+    クラスタ付きの正規化ベクトル（同じクラスタ同士の類似度がおよそ 0.5〜0.6 になる）
+    """
+    vectors = centers[rng.integers(0, len(centers), n)] + rng.normal(size=(n, DIM)) * 0.9
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def generate_corpus(path, users=20, history=100, seed=0):
+    """
+    旧形式の noise_db.json (users × history、768次元ベクトル付き) を書き出す
+    """
+    rng = np.random.default_rng(seed)
+    centers = cluster_centers(seed)
+    start = datetime(2025, 1, 1)
+    data = {"users": {}}
+    for u in range(users):
+        user_id = str(100000000000000000 + u)
+        texts = [make_text(rng) for _ in range(history)]
+        vectors = np.round(make_vectors(rng, centers, history), 5)
+        stats = {}
+        for text in texts:
+            for keyword in KEYWORDS:
+                if keyword in text:
+                    stats[keyword] = stats.get(keyword, 0) + 1
+        data["users"][user_id] = {
+            "channel_id": 200000000000000000 + u,
+            "points": int(rng.integers(0, 500)),
+            "expose_count": 0,
+            "onboarding_status": "completed",
+            "connection_enabled": True,
+            "keyword_stats": stats,
+            "history": [
+                {
+                    "content": text,
+                    "timestamp": str(start + timedelta(minutes=int(i * users + u))),
+                    "vector": vector.tolist(),
+                }
+                for i, (text, vector) in enumerate(zip(texts, vectors))
+            ],
+        }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    return os.path.getsize(path)
+
+
+# ==========================================
+# 計測ヘルパー
+# ==========================================
+def result(value, unit, better="lower", **extra):
+    return {"value": value, "unit": unit, "better": better, **extra}
+
+
+def best_of(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return min(samples), statistics.median(samples)
+
+
+# ==========================================
+# データベース
+# ==========================================
+def bench_db(workdir, corpus, repeat):
+    from state import NoiseState
+    from storage import NoiseStore
+    from vector_store import VectorStore
+
+    results = {}
+
+    # 旧方式 (load_db / save_db): JSON 全体を読み書きする
+    def legacy_load():
+        with open(corpus, "r", encoding="utf-8") as f:
+            return json.load(f)
+    data = legacy_load()
+    best, median = best_of(legacy_load, repeat)
+    results["db.legacy_json_load"] = result(best * 1000, "ms", median_ms=median * 1000)
+
+    def legacy_save():
+        with open(os.path.join(workdir, "legacy_save.json"), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+    best, median = best_of(legacy_save, repeat)
+    results["db.legacy_json_save"] = result(best * 1000, "ms", median_ms=median * 1000)
+
+    # 現行方式: SQLite + ベクトルファイルへの取り込み（初回起動時のみ）
+    db_dir = os.path.join(workdir, "db")
+    os.makedirs(db_dir)
+    shutil.copy(corpus, os.path.join(db_dir, "noise_db.json"))
+    start = time.perf_counter()
+    vectors = VectorStore(os.path.join(db_dir, "noise_vectors.f32"), dim=DIM)
+    store = NoiseStore(os.path.join(db_dir, "noise_db.sqlite3"))
+    store.migrate_from_json(os.path.join(db_dir, "noise_db.json"), vectors)
+    results["db.migrate_json"] = result((time.perf_counter() - start) * 1000, "ms", rows=store.count_history())
+
+    # 起動時の読み込み（ユーザー・レジストリ・転置インデックス）
+    best, median = best_of(lambda: NoiseState(store), repeat)
+    results["db.load_state"] = result(best * 1000, "ms", median_ms=median * 1000, users=len(data["users"]))
+
+    # 発言1000件分の変更を1回のフラッシュで書き出す
+    state = NoiseState(store)
+    state.sync_keyword_index(KEYWORDS)
+    user_ids = list(state.users)
+    rng = np.random.default_rng(1)
+    for i in range(1000):
+        user_id = user_ids[i % len(user_ids)]
+        state.add_points(user_id, 1)
+        history_id = state.append_history(user_id, make_text(rng), str(datetime.now()), None)
+        state.add_postings(user_id, history_id, KEYWORDS[:3])
+    start = time.perf_counter()
+    state.flush()
+    results["db.flush_1000_messages"] = result((time.perf_counter() - start) * 1000, "ms")
+
+    store.close()
+    vectors.close()
+    return results
+
+
+# ==========================================
+# バンド検索
+# ==========================================
+def bench_search(matrix, n_queries, seed):
+    from search import PRECISIONS, BandSearchEngine, IVFBandIndex
+
+    results = {}
+    rng = np.random.default_rng(seed)
+    queries = matrix[rng.choice(len(matrix), n_queries)] + rng.normal(size=(n_queries, DIM)).astype(np.float32) * 0.005
+    owner_ids = np.zeros(len(matrix))
+    history_ids = np.arange(len(matrix))
+
+    exact = None
+    for precision in PRECISIONS:
+        engine = BandSearchEngine(dim=DIM, precision=precision)
+        start = time.perf_counter()
+        engine.add_batch(owner_ids, history_ids, matrix)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        found = [set(engine.band(q, *BAND)[1].tolist()) for q in queries]
+        ms = (time.perf_counter() - start) * 1000 / n_queries
+        if exact is None:
+            exact = found
+        flips = sum(len(a ^ b) for a, b in zip(found, exact))
+        results[f"search.exact.{precision}"] = result(
+            ms, "ms/query", rows=len(engine), build_ms=build_ms, mb=engine.nbytes() / 1024 / 1024, band_flips=flips
+        )
+
+    engine = BandSearchEngine(dim=DIM)
+    engine.add_batch(owner_ids, history_ids, matrix)
+    index = IVFBandIndex(engine, n_probe=16, min_rows=1)
+    start = time.perf_counter()
+    index.rebuild()
+    build_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    found = [set(index.band(q, *BAND)[1].tolist()) for q in queries]
+    ms = (time.perf_counter() - start) * 1000 / n_queries
+    recalls = [len(f & e) / len(e) for f, e in zip(found, exact) if e]
+    results["search.ivf.probe16"] = result(
+        ms, "ms/query", rows=len(engine), build_ms=build_ms, recall=float(np.mean(recalls)) if recalls else None
+    )
+    results.update(bench_search_pool(matrix, queries, owner_ids, history_ids))
+    return results
+
+
+def bench_search_pool(matrix, queries, owner_ids, history_ids, workers=2):
+    """
+    ワーカープロセスでの全件スキャン: 1件ずつの待ち時間と、並行リクエストのスループット
+    （イベントループ側の CPU 時間も測り、ループをどれだけ止めているかを見る）
+    """
+    from search_pool import SearchPool, SharedBandEngine
+
+    engine = SharedBandEngine(dim=DIM)
+    engine.add_batch(owner_ids, history_ids, matrix)
+    pool = SearchPool(engine, workers=workers)
+
+    async def run():
+        start = time.perf_counter()
+        for q in queries:
+            await pool.band(q, *BAND)
+        sequential = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cpu = time.thread_time()
+        await asyncio.gather(*(pool.band(q, *BAND) for q in queries))
+        return sequential, time.perf_counter() - start, time.thread_time() - cpu
+
+    try:
+        sequential, concurrent, loop_cpu = asyncio.run(run())
+    finally:
+        pool.close()
+    n = len(queries)
+    return {
+        "search.pool.latency": result(sequential * 1000 / n, "ms/query", rows=len(engine), workers=workers),
+        "search.pool.throughput": result(n / concurrent, "queries/s", better="higher", workers=workers),
+        "search.pool.loop_cpu": result(loop_cpu * 1000 / n, "ms/query"),
+    }
+
+
+# ==========================================
+# キーワード判定
+# ==========================================
+def bench_keywords(n_messages, seed):
+    rng = np.random.default_rng(seed)
+    messages = [make_text(rng) for _ in range(n_messages)]
+    automaton = AhoCorasick(KEYWORDS)
+
+    def naive():
+        for text in messages:
+            [keyword for keyword in KEYWORDS if keyword in text]
+
+    def aho_corasick():
+        for text in messages:
+            automaton.find(text)
+
+    results = {}
+    for name, func in (("naive", naive), ("aho_corasick", aho_corasick)):
+        best, _ = best_of(func, 3)
+        results[f"keywords.{name}"] = result(n_messages / best, "messages/s", better="higher")
+    return results
+
+
+# ==========================================
+# ローカル埋め込み
+# ==========================================
+def bench_embedding(n_texts, seed):
+    from embedding import HashingEmbedding
+
+    rng = np.random.default_rng(seed)
+    texts = [make_text(rng) for _ in range(n_texts)]
+    embedder = HashingEmbedding(dim=DIM)
+
+    results = {}
+    best, _ = best_of(lambda: [embedder.encode([text]) for text in texts], 3)
+    results["embedding.local.single"] = result(n_texts / best, "texts/s", better="higher")
+    best, _ = best_of(lambda: embedder.encode(texts), 3)
+    results["embedding.local.batch"] = result(n_texts / best, "texts/s", better="higher", batch=n_texts)
+    return results
+
+
+# ==========================================
+# on_message (Discord / Gemini はスタブ)
+# ==========================================
+class StubChannel:
+    def __init__(self, channel_id, name):
+        self.id = channel_id
+        self.name = name
+        self.mention = f"<#{channel_id}>"
+        self.sent = 0
+
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+
+
+class StubMember:
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.name = name
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+        self.roles = []
+
+
+class StubGuild:
+    def __init__(self, channels):
+        self.id = 1
+        self._channels = {channel.id: channel for channel in channels}
+        self.text_channels = list(channels)
+        self.roles = []
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    def get_member(self, member_id):
+        return None
+
+    def get_role(self, role_id):
+        return None
+
+
+class StubMessage:
+    def __init__(self, author, channel, guild, content):
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.content = content
+        self.mentions = []
+
+
+def bench_on_message(workdir, corpus, n_messages, embed_latency, generate_latency, seed, embedding_backend):
+    """
+    bot.py を一時ディレクトリで import し、on_message → 取り込みワーカー → 思考接続 を丸ごと動かす
+    embedding_backend="local" なら埋め込みはスタブではなくローカル実装で計算する
+    """
+    e2e_dir = os.path.join(workdir, "e2e")
+    os.makedirs(e2e_dir)
+    shutil.copy(corpus, os.path.join(e2e_dir, "noise_db.json"))
+    cwd = os.getcwd()
+    os.chdir(e2e_dir)
+    os.environ["GEMINI_API_KEY"] = "bench"
+    os.environ.setdefault("SEARCH_PRECISION", "float32")
+    os.environ["EMBEDDING_BACKEND"] = embedding_backend
+    try:
+        start = time.perf_counter()
+        import bot as noise_bot
+        startup_ms = (time.perf_counter() - start) * 1000
+        from tracing import TRACER
+
+        centers = cluster_centers(seed)
+
+        async def embed_batch(texts, model, task_type):
+            await asyncio.sleep(embed_latency)
+            vectors = []
+            for text in texts:
+                text_seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+                vectors.append(make_vectors(np.random.default_rng(text_seed), centers, 1)[0].tolist())
+            return vectors
+
+        async def generate(prompt, model):
+            await asyncio.sleep(generate_latency)
+            return "思考のスタブ"
+
+        async def process_commands(message):
+            return None
+
+        noise_bot.gemini.embed_batch = embed_batch
+        noise_bot.gemini.generate = generate
+        noise_bot.bot.process_commands = process_commands
+
+        users = list(noise_bot.db.users.items())
+        channels = [StubChannel(user["channel_id"], f"times-user{i}") for i, (_, user) in enumerate(users)]
+        guild = StubGuild(channels)
+        rng = np.random.default_rng(seed)
+        random.seed(seed)
+        messages = []
+        for _ in range(n_messages):
+            i = int(rng.integers(len(users)))
+            author = StubMember(int(users[i][0]), f"user{i}")
+            messages.append(StubMessage(author, channels[i], guild, make_text(rng)))
+
+        async def run():
+            noise_bot.ingest_queue.start()
+            since = time.time()
+            start = time.perf_counter()
+            for message in messages:
+                await noise_bot.on_message(message)
+            handler_s = time.perf_counter() - start
+            await noise_bot.ingest_queue.join()
+            total_s = time.perf_counter() - start
+            await noise_bot.ingest_queue.stop()
+            return handler_s, total_s, TRACER.summary(since=since)
+
+        handler_s, total_s, spans = asyncio.run(run())
+        start = time.perf_counter()
+        noise_bot.db.flush()
+        flush_ms = (time.perf_counter() - start) * 1000
+
+        results = {
+            "e2e.startup": result(startup_ms, "ms", history_rows=len(noise_bot.db.registry)),
+            "e2e.on_message_throughput": result(n_messages / handler_s, "messages/s", better="higher"),
+            "e2e.pipeline_throughput": result(
+                n_messages / total_s,
+                "messages/s",
+                better="higher",
+                connections=sum(channel.sent for channel in channels),
+                dropped=noise_bot.ingest_queue.dropped,
+                failed=noise_bot.ingest_queue.failed,
+            ),
+            "e2e.final_flush": result(flush_ms, "ms"),
+        }
+        for name, (count, total, longest) in sorted(spans.items()):
+            results[f"e2e.span.{name}"] = result(total / count * 1000, "ms", count=count, max_ms=longest * 1000)
+
+        noise_bot.db.close()
+        noise_bot.vectors.close()
+        noise_bot.embedding_cache.close()
+        noise_bot.generation_cache.close()
+        noise_bot.gemini.close()
+        if noise_bot.search_pool is not None:
+            noise_bot.search_pool.close()
+        return results
+    finally:
+        os.chdir(cwd)
+
+
+# ==========================================
+# 実行 / 比較
+# ==========================================
+def metadata(args):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "params": {k: v for k, v in vars(args).items() if k != "func"},
+    }
+
+
+def run(args):
+    suites = set(args.only.split(",")) if args.only else {"db", "search", "keywords", "embedding", "e2e"}
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="noise-bench-") as workdir:
+        corpus = args.corpus
+        if corpus is None:
+            corpus = os.path.join(workdir, "noise_db.json")
+            size = generate_corpus(corpus, args.users, args.history, args.seed)
+            print(f"Generated {args.users} users x {args.history} history ({size / 1024 / 1024:.1f}MB)")
+
+        if "db" in suites:
+            results.update(bench_db(workdir, corpus, args.repeat))
+        if "search" in suites:
+            rng = np.random.default_rng(args.seed)
+            matrix = make_vectors(rng, cluster_centers(args.seed), args.search_rows).astype(np.float32)
+            results.update(bench_search(matrix, args.queries, args.seed))
+        if "keywords" in suites:
+            results.update(bench_keywords(args.keyword_messages, args.seed))
+        if "embedding" in suites:
+            results.update(bench_embedding(args.embedding_texts, args.seed))
+        if "e2e" in suites:
+            results.update(
+                bench_on_message(
+                    workdir,
+                    corpus,
+                    args.messages,
+                    args.embed_latency,
+                    args.generate_latency,
+                    args.seed,
+                    args.embedding_backend,
+                )
+            )
+
+    report = {"meta": metadata(args), "results": results}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print()
+    for name, r in results.items():
+        print(f"{name:<40} {r['value']:>12.2f} {r['unit']}")
+    print(f"\nWrote {args.output}")
+
+
+def compare(args):
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)["results"]
+
+    print(f"{'benchmark':<40} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name in sorted(set(baseline) & set(current)):
+        before = baseline[name]["value"]
+        after = current[name]["value"]
+        if not before:
+            continue
+        change = (after - before) / before * 100
+        # 悪化した方向に ! を付ける（5%以上）
+        worse = change > 5 if current[name]["better"] == "lower" else change < -5
+        print(f"{name:<40} {before:>12.2f} {after:>12.2f} {change:>+8.1f}%{' !' if worse else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Noise bot benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("generate", help="write a synthetic noise_db.json")
+    p.add_argument("output")
+    p.add_argument("--users", type=int, default=20)
+    p.add_argument("--history", type=int, default=100)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=lambda a: print(f"Wrote {generate_corpus(a.output, a.users, a.history, a.seed)} bytes"))
+
+    p = sub.add_parser("run", help="run the benchmarks and write JSON results")
+    p.add_argument("--corpus", help="existing noise_db.json (generated if omitted)")
+    p.add_argument("--users", type=int, default=20)
+    p.add_argument("--history", type=int, default=100)
+    p.add_argument("--search-rows", type=int, default=50000)
+    p.add_argument("--queries", type=int, default=100)
+    p.add_argument("--keyword-messages", type=int, default=20000)
+    p.add_argument("--embedding-texts", type=int, default=2000)
+    p.add_argument("--messages", type=int, default=500)
+    p.add_argument("--embedding-backend", choices=["gemini", "local"], default="gemini", help="backend used by the e2e run")
+    p.add_argument("--embed-latency", type=float, default=0.0, help="stubbed Gemini embed latency (s)")
+    p.add_argument("--generate-latency", type=float, default=0.0, help="stubbed Gemini generate latency (s)")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--only", help="comma-separated subset of db,search,keywords,embedding,e2e")
+    p.add_argument("--output", default="bench_results.json")
+    p.set_defaults(func=run)
+
+    p = sub.add_parser("compare", help="compare two result files")
+    p.add_argument("baseline")
+    p.add_argument("current")
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, REPO_DIR)
+    main()
@@ -1,13 +1,31 @@
 import discord
 from discord.ext import commands, tasks
-import json
 import os
 import random
 import asyncio
+import signal
+import threading
+import time
 from datetime import datetime
 from dotenv import load_dotenv
-import numpy as np
 import google.generativeai as genai
+from storage import NoiseStore
+from state import NoiseState
+from vector_store import VectorStore
+from search import BandSearchEngine, IVFBandIndex
+from search_pool import SearchPool, SharedBandEngine, remove_stale_directories
+from embed_cache import EmbeddingCache
+from embedding import GeminiEmbedding, HashingEmbedding
+from generation_cache import GenerationCache
+from metrics import CONNECTION_TRIGGERS, MESSAGES, Gauge, MetricsServer, StartupHealthServer, monitor_event_loop
+from tracing import TRACER, SamplingProfiler, span, traced
+from gemini_client import GeminiClient, EmbeddingBatcher
+from ingest import IngestQueue
+from keywords import KeywordMatcher
+from scheduler import ExpiryScheduler
+from backfill import OnboardingBackfill
+from fanout import fan_out
+from retention import ColdArchive, HistoryRetention
 
 
 # ==========================================
@@ -19,6 +37,9 @@ GUILD_ID = 000000000000000000 # サーバーID（整数）を入れる
 CATEGORY_NAME = "🧠 Members" # 個室を作るカテゴリー名
 LOG_CHANNEL_NAME = "noise-log" # AIログを流すチャンネル名
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+# 思考接続のトリガーになるキーワード
+# KEYWORDS_FILE があればそちらを使い、/reload_keywords で再読み込みできる
+KEYWORDS_FILE = "keywords.txt"
 CONNECTION_KEYWORDS = [
     # Social
     "地方創生", "地域活性化", "まちづくり", "コミュニティ", "移住", "教育", "福祉",
@@ -30,13 +51,79 @@ CONNECTION_KEYWORDS = [
     "サウナ", "筋トレ", "料理", "読書", "映画", "アート", "旅"
 ]
 
-# 簡易データベース (今回はJSONファイルで代用)
-DB_FILE = "noise_db.json"
+# データベース (SQLite / WALモード)
+DB_PATH = "noise_db.sqlite3"
+LEGACY_DB_FILE = "noise_db.json" # 旧JSONデータベース（初回起動時に取り込む）
+DB_FLUSH_INTERVAL = 2.0 # 変更をまとめてディスクに書き出す間隔（秒）
+SHUTDOWN_DRAIN_TIMEOUT = 8.0 # SIGTERM 後に取り込みキューを処理しきるまで待つ秒数 (Cloud Run の猶予は10秒)
+VECTOR_FILE = "noise_vectors.f32" # 埋め込みベクトル (float32, 追記専用)
+# 履歴の保持: ホット窓から外れた履歴は /compact_history で圧縮セグメントに移す
+HISTORY_ARCHIVE_DIR = "history_archive"
+HISTORY_HOT_DAYS = 90 # これより古い履歴はコールド層へ (None で無効)
+HISTORY_HOT_PER_USER = 2000 # ユーザーごとにホット層に残す件数 (None で無効)
+HISTORY_HOT_TOTAL = None # 全体でホット層に残す件数 (None で無効)
+HISTORY_COLD_SEARCH = True # ホット層に候補がないときコールド層も検索する
+HISTORY_SEGMENT_ROWS = 20000 # コールド層の1セグメントあたりの行数 (検索時はセグメント単位でベクトルを展開する)
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'gemini') # "gemini" (API) または "local" (オフラインの n-gram TF-IDF)
+EMBEDDING_MODEL = "models/text-embedding-004"
+EMBEDDING_TASK_TYPE = "semantic_similarity"
+EMBEDDING_DIM = 768 # text-embedding-004 の次元数 (ローカルバックエンドも合わせる)
+LEGACY_VECTOR_SPACE = "models/text-embedding-004" # バックエンドのタグがない既存ベクトルを作ったモデル
+LOCAL_EMBEDDING_IDF_FILE = "local_embedding_idf.npy" # ローカルバックエンドの IDF (python embedding.py fit-idf で作る。なければ TF のみ)
+EMBED_CACHE_FILE = "embedding_cache.sqlite3" # 埋め込みキャッシュ (同じ文面はAPIを1回しか呼ばない)
+EMBED_CACHE_MEMORY_ITEMS = 4096 # メモリ上に置く件数
+EMBED_CACHE_DISK_MB = 256 # ディスク側の上限サイズ
+GENERATION_MODEL = "gemini-flash-latest"
+CONNECTION_PROMPT_VERSION = 1 # 思考接続のプロンプトを変えたら上げる（生成キャッシュのキーに入る）
+GENERATION_CACHE_FILE = "generation_cache.sqlite3" # 生成キャッシュ (同じ組み合わせの接続コメントを再利用する)
+GENERATION_CACHE_TTL = 7 * 86400 # キャッシュしたコメントを使う期間（秒）
+GENERATION_CACHE_MAX_ENTRIES = 20000 # ディスク側に置く件数
+GENERATION_CACHE_VARIANTS = 1 # 1組あたりに溜めるコメント数（揃うまでは生成し、揃ったらランダムに1件返す）
+GEMINI_MAX_CONCURRENCY = 8 # Gemini への同時リクエスト数
+GEMINI_EMBED_TIMEOUT = 10.0 # 秒
+GEMINI_GENERATE_TIMEOUT = 30.0 # 秒
+GEMINI_EMBED_RPS = 5.0 # 埋め込みリクエストの上限 (回/秒)
+GEMINI_GENERATE_RPS = 1.0 # 生成リクエストの上限 (回/秒)
+GEMINI_MAX_RETRIES = 3 # 一時的なエラーの再試行回数
+GEMINI_BREAKER_ERROR_RATE = 0.5 # このエラー率を超えたら呼び出しを止める
+GEMINI_BREAKER_COOLDOWN = 30.0 # 止めておく時間（秒）
+INGEST_WORKERS = 4 # ベクトル化・思考接続を行うワーカー数
+INGEST_QUEUE_SIZE = 1000 # 取り込みキューの上限
+EXPOSE_DURATION = 86400 # /expose で公開する時間（秒）
+BACKFILL_CONCURRENCY = 4 # /init_all で同時にセットアップする人数
+FANOUT_CONCURRENCY = 5 # ロール付与・DM送信を同時に行う人数
+INGEST_OVERFLOW = "drop_oldest" # 溢れたとき: drop_oldest (古いものを捨てる) / drop_newest (新しいものを捨てる)
+EMBED_BATCH_WINDOW = 0.05 # 埋め込み要求をまとめる時間窓（秒）
+EMBED_BATCH_MAX = 100 # 1リクエストにまとめる最大件数 (batchEmbedContents の上限)
+SIMILARITY_BAND = (0.5, 0.7) # Designed Serendipity: この範囲の類似度を「ちょうどいい距離」とみなす
+SEARCH_INDEX = os.getenv('SEARCH_INDEX', 'exact') # "exact" (全件スキャン) または "ivf" (近似インデックス)
+SEARCH_IVF_PROBES = int(os.getenv('SEARCH_IVF_PROBES', '16')) # IVFで調べるパーティション数 (check_ann.py で決める)
+SEARCH_WORKERS = int(os.getenv('SEARCH_WORKERS', '0')) # 全件スキャンを行うワーカープロセス数 (SEARCH_INDEX=exact のとき。0 ならワーカーを使わない)
+SEARCH_SHARED_DIR = os.getenv('SEARCH_SHARED_DIR') # ワーカーと共有する検索行列ファイルの置き場所 (未設定なら一時ディレクトリ)
+SEARCH_PRECISION = os.getenv('SEARCH_PRECISION', 'float32') # 検索行列の保持形式: float32 / float16 / int8 (check_quantization.py で決める)
+PROFILE_MAX_SECONDS = 120 # /profile で計測できる最大秒数
+PROFILE_INTERVAL = 0.005 # スタックを採取する間隔（秒）
+PROFILE_DIR = "profiles" # collapsed stack の出力先
+PROFILE_TOP_SPANS = 10 # レポートに載せる遅いスパンの件数
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0')) # /metrics を公開するポート (0 で無効。entrypoint.sh が $PORT を渡す)
 BOT_VERSION = "Ver.X (2025-12-28-01)"
 
 if GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
 
+# 検索ワーカー (SEARCH_INDEX=exact のとき)
+# スレッド・待ち受けソケット・読み込んだ DB を引き継がないよう、何よりも先に fork しておく
+# 検索行列はワーカーがリクエストごとにファイルから開くので、engine は組み立て後に渡す
+search_pool = None
+if SEARCH_WORKERS and SEARCH_INDEX == "exact":
+    search_pool = SearchPool(None, workers=SEARCH_WORKERS)
+
+# Cloud Run の起動プローブは $PORT の待ち受けを見るので、重い初期化より先に応答を始める
+# （ログイン前の setup_hook で MetricsServer に引き継ぐ）
+startup_health = StartupHealthServer()
+if METRICS_PORT:
+    startup_health.start(METRICS_PORT)
+
 # ==========================================
 # SETUP & UTILS
 # ==========================================
@@ -45,21 +132,179 @@ intents.members = True
 intents.message_content = True
 bot = commands.Bot(command_prefix='/', intents=intents)
 
-# データベースの読み書き関数
-def load_db():
-    if not os.path.exists(DB_FILE):
-        return {"users": {}}
-    with open(DB_FILE, "r") as f:
-        return json.load(f)
+# データベース (起動時に一度だけ読み込み、変更はまとめて書き出す)
+vectors = VectorStore(VECTOR_FILE, dim=EMBEDDING_DIM)
+store = NoiseStore(DB_PATH)
+store.migrate_from_json(LEGACY_DB_FILE, vectors)
+store.migrate_vectors(vectors)
+store.recover_vector_compaction(vectors)
+store.tag_vector_space(LEGACY_VECTOR_SPACE)
+db = NoiseState(store, flush_interval=DB_FLUSH_INTERVAL)
 
-def save_db(data):
-    with open(DB_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+def build_search_engine(space):
+    """
+    全履歴のうち space で作られたベクトルから類似度検索エンジンを構築する
+    """
+    if search_pool is not None:
+        # ワーカープロセスと共有するため、行列をメモリマップファイルに置く
+        # 強制終了されたプロセスが残したファイルはここで片付ける
+        removed = remove_stale_directories(SEARCH_SHARED_DIR)
+        if removed:
+            print(f"Removed {removed} stale search directories")
+        engine = SharedBandEngine(EMBEDDING_DIM, directory=SEARCH_SHARED_DIR, precision=SEARCH_PRECISION)
+    else:
+        engine = BandSearchEngine(dim=EMBEDDING_DIM, precision=SEARCH_PRECISION)
+    rows = [
+        (uid, history_id, vector_id)
+        for history_id, uid, _, vector_id, vector_space in db.iter_history()
+        if vector_id is not None and vector_space == space
+    ]
+    # float32 の全行コピーを一度に作らないよう、少しずつ量子化して積む
+    for start in range(0, len(rows), 65536):
+        owner_ids, history_ids, vector_ids = zip(*rows[start:start + 65536])
+        engine.add_batch(owner_ids, history_ids, vectors.matrix()[list(vector_ids)])
+    print(f"Search engine ready: {len(engine)} vectors ({space}, {SEARCH_PRECISION}, {engine.nbytes() / 1024 / 1024:.1f}MB)")
+    return engine
+
+# コールド層（圧縮済みの古い履歴）
+cold_archive = ColdArchive(
+    HISTORY_ARCHIVE_DIR, dim=EMBEDDING_DIM, legacy_space=LEGACY_VECTOR_SPACE, max_rows=HISTORY_SEGMENT_ROWS
+)
+history_retention = HistoryRetention(
+    db,
+    vectors,
+    cold_archive,
+    max_age_days=HISTORY_HOT_DAYS,
+    max_per_user=HISTORY_HOT_PER_USER,
+    max_total=HISTORY_HOT_TOTAL
+)
+
+# 埋め込みキャッシュ
+embedding_cache = EmbeddingCache(
+    EMBED_CACHE_FILE,
+    memory_items=EMBED_CACHE_MEMORY_ITEMS,
+    disk_max_bytes=EMBED_CACHE_DISK_MB * 1024 * 1024
+)
+
+# 生成キャッシュ
+generation_cache = GenerationCache(
+    GENERATION_CACHE_FILE,
+    ttl=GENERATION_CACHE_TTL,
+    max_entries=GENERATION_CACHE_MAX_ENTRIES,
+    variants=GENERATION_CACHE_VARIANTS
+)
+
+# Gemini API (スレッドプールで実行し、イベントループを止めない)
+gemini = GeminiClient(
+    max_concurrency=GEMINI_MAX_CONCURRENCY,
+    embed_timeout=GEMINI_EMBED_TIMEOUT,
+    generate_timeout=GEMINI_GENERATE_TIMEOUT,
+    embed_rate=GEMINI_EMBED_RPS,
+    generate_rate=GEMINI_GENERATE_RPS,
+    max_retries=GEMINI_MAX_RETRIES,
+    breaker_error_rate=GEMINI_BREAKER_ERROR_RATE,
+    breaker_cooldown=GEMINI_BREAKER_COOLDOWN
+)
+# 複数チャンネルの発言の埋め込みを1リクエストにまとめる
+embedding_batcher = EmbeddingBatcher(
+    gemini,
+    EMBEDDING_MODEL,
+    EMBEDDING_TASK_TYPE,
+    window=EMBED_BATCH_WINDOW,
+    max_batch=EMBED_BATCH_MAX
+)
+
+# 埋め込みバックエンド (保存するベクトルには embedder.name を付ける)
+if EMBEDDING_BACKEND == "local":
+    embedder = HashingEmbedding(dim=EMBEDDING_DIM, idf_path=LOCAL_EMBEDDING_IDF_FILE)
+elif EMBEDDING_BACKEND == "gemini":
+    embedder = GeminiEmbedding(embedding_batcher, dim=EMBEDDING_DIM)
+else:
+    raise ValueError(f"Unknown EMBEDDING_BACKEND: {EMBEDDING_BACKEND}")
+# Gemini バックエンドは APIキーがなければ使えない
+EMBEDDING_ENABLED = EMBEDDING_BACKEND == "local" or bool(GEMINI_API_KEY)
+
+async def embed_text(text):
+    """
+    テキストを埋め込みベクトル (float32) にする。キャッシュにあればAPIを呼ばない
+    空白だけのテキスト（添付・スタンプのみの投稿）は埋め込まずに None を返す
+    """
+    if not text.strip():
+        return None
+    if not embedder.cacheable:
+        return await embedder.embed(text)
+    vector = embedding_cache.get(embedder.name, EMBEDDING_TASK_TYPE, text)
+    if vector is None:
+        embedding = await embedder.embed(text)
+        vector = embedding_cache.put(embedder.name, EMBEDDING_TASK_TYPE, text, embedding)
+    return vector
+
+# 類似度検索エンジン（今のバックエンドの空間のベクトルだけを載せる）
+search_engine = build_search_engine(embedder.name)
+
+# キーワードマッチャー (Aho-Corasick) と キーワード → 履歴 の転置インデックス
+keyword_matcher = KeywordMatcher(KEYWORDS_FILE, default_keywords=CONNECTION_KEYWORDS)
+db.sync_keyword_index(keyword_matcher.keywords)
+
+# 近似インデックス (SEARCH_INDEX=ivf のときだけ使う)
+if SEARCH_INDEX == "ivf":
+    search_index = IVFBandIndex(search_engine, n_probe=SEARCH_IVF_PROBES)
+    search_index.rebuild()
+else:
+    search_index = search_engine
+
+# 検索ワーカーに組み立てた行列を渡す
+if search_pool is not None:
+    search_pool.engine = search_engine
+    search_pool.postings = db.get_postings
+    print(f"Search workers ready: {SEARCH_WORKERS} processes ({search_engine.directory})")
 
 # ==========================================
 # CORE LOGIC FUNCTIONS
 # ==========================================
 
+ROLE_PREFIX = "role-times-"
+
+def get_member_role(guild, member):
+    """
+    メンバーの個室ロールを返す（なければ None）
+    DBに記録した role_id から引くので、ユーザー名が変わっても見失わない
+    """
+    user_id = str(member.id)
+    role_id = db.get_role_id(user_id)
+    role = guild.get_role(role_id) if role_id else None
+    if role is None:
+        # role_id 未記録の既存データ向け: 名前で探して記録しておく
+        role = discord.utils.get(guild.roles, name=f"{ROLE_PREFIX}{member.name}")
+        if role:
+            db.update_user(user_id, role_id=role.id)
+    return role
+
+async def grant_room_role(member, role, notice):
+    """
+    個室ロールを付与して DM で知らせる。DM が届いたかどうかを返す
+    （DM を閉じている人もいるので、DM の失敗は付与の失敗として扱わない）
+    """
+    await member.add_roles(role)
+    try:
+        await member.send(notice)
+        return True
+    except discord.HTTPException:
+        return False
+
+def summarize_fanout(result):
+    """
+    fan_out の結果から「DM未達」「失敗」の行を作る（なければ空文字）
+    """
+    lines = []
+    undelivered = [member.name for member, dm_sent in result.succeeded if not dm_sent]
+    if undelivered:
+        lines.append(f"📭 DM未達: {', '.join(undelivered)}")
+    if result.failed:
+        errors = ", ".join(f"{member.name} ({type(e).__name__})" for member, e in result.failed)
+        lines.append(f"⚠️ 付与失敗: {errors}")
+    return "".join(f"\n{line}" for line in lines)
+
 async def complete_onboarding_tutorial(member, channel, msg_content):
     """
     オンボーディングチュートリアルの完了処理（思考接続の演出以降）
@@ -89,8 +334,7 @@ async def complete_onboarding_tutorial(member, channel, msg_content):
     
     if target_member:
         # ロール付与
-        role_name = f"role-times-{target_member.name}"
-        role = discord.utils.get(guild.roles, name=role_name)
+        role = get_member_role(guild, target_member)
         if role:
             await member.add_roles(role)
             embed_connect.add_field(name=f"🔗 接続先: {target_member.name}", value="「思考の波長」が共鳴しました。\n相手の思考チャンネルへの**永久アクセス権**が付与されました。", inline=False)
@@ -134,11 +378,7 @@ async def complete_onboarding_tutorial(member, channel, msg_content):
     await channel.send(embed=embed_next)
     
     # DBの状態更新: 完了済みとする
-    db = load_db()
-    user_id = str(member.id)
-    if user_id in db["users"]:
-        db["users"][user_id]["onboarding_status"] = "completed"
-        save_db(db)
+    db.update_user(str(member.id), onboarding_status="completed")
 
 
 async def run_onboarding_tutorial(member, channel):
@@ -166,27 +406,26 @@ async def run_onboarding_tutorial(member, channel):
         await channel.send("...思考の波が途絶えました。また気が向いた時に書き込んでください。")
         
         # タイムアウトした場合: DBにリトライ待ちステータスを記録
-        db = load_db()
-        user_id = str(member.id)
-        if user_id in db["users"]:
-            db["users"][user_id]["onboarding_status"] = "pending_retry"
-            save_db(db)
+        db.update_user(str(member.id), onboarding_status="pending_retry")
         return
 
 
+# 並行セットアップ時にカテゴリーが二重に作られないようにする
+category_lock = asyncio.Lock()
+
 async def create_personal_channel(member):
     guild = member.guild
     
     # カテゴリーの取得または作成
-    category = discord.utils.get(guild.categories, name=CATEGORY_NAME)
-    if not category:
-        category = await guild.create_category(CATEGORY_NAME)
+    async with category_lock:
+        category = discord.utils.get(guild.categories, name=CATEGORY_NAME)
+        if not category:
+            category = await guild.create_category(CATEGORY_NAME)
 
     # ロールの作成
-    role_name = f"role-times-{member.name}"
-    role = discord.utils.get(guild.roles, name=role_name)
+    role = get_member_role(guild, member)
     if not role:
-        role = await guild.create_role(name=role_name)
+        role = await guild.create_role(name=f"{ROLE_PREFIX}{member.name}")
     
     # ロールをメンバーに付与
     if role not in member.roles:
@@ -215,27 +454,13 @@ async def create_personal_channel(member):
         print(f"Updated channel permissions for {member.name}")
     
     # DBに記録
-    db = load_db()
     user_id = str(member.id)
-    if user_id not in db["users"]:
-        db["users"][user_id] = {
-            "channel_id": channel.id,
-            "points": 0,
-            "history": [],
-            "expose_count": 0,
-            "onboarding_status": "started" # ステータス初期化
-        }
-    else:
-        # 既存ユーザーの場合はチャンネルIDだけ更新しておく
-        db["users"][user_id]["channel_id"] = channel.id
-        if "expose_count" not in db["users"][user_id]:
-             db["users"][user_id]["expose_count"] = 0
-        if "expose_count" not in db["users"][user_id]:
-             db["users"][user_id]["expose_count"] = 0
-        db["users"][user_id]["onboarding_status"] = "started" # 再実行時もステータスリセット
-
-
-    save_db(db)
+    db.ensure_user(user_id, channel_id=channel.id)
+    if existing_channel:
+        # 既にある個室: 記録だけ揃え、ウェルカムとチュートリアルはやり直さない
+        db.update_user(user_id, channel_id=channel.id, role_id=role.id)
+        return
+    db.update_user(user_id, channel_id=channel.id, role_id=role.id, onboarding_status="started")
 
     # ウェルカムメッセージ
     await channel.send(f"ようこそ、{member.mention}。ここはあなたの脳内（外部脳）です。\n気になったこと、意味のないこと、なんでも書き込んでください。\nAIがあなたの思考を誰かと接続します。")
@@ -244,16 +469,16 @@ async def create_personal_channel(member):
     asyncio.create_task(run_onboarding_tutorial(member, channel))
 
 
+@traced()
 async def simulate_ai_connection(guild, author, content, forced_keyword=None):
     """
     AIによるマッチングと「第三の文脈」生成 (Gemini版)
     forced_keyword: これが指定されている場合、過去ログからもこのキーワードを含むものを優先する
     """
     # DBからユーザーのチャンネルIDを取得
-    db = load_db()
-    user_data = db["users"].get(str(author.id))
+    user_data = db.get_user(str(author.id))
     
-    if not user_data or "channel_id" not in user_data:
+    if not user_data or not user_data.get("channel_id"):
         return
 
     channel_id = user_data["channel_id"]
@@ -264,15 +489,12 @@ async def simulate_ai_connection(guild, author, content, forced_keyword=None):
 
     # 1. 現在の投稿をベクトル化
     try:
-        # Gemini Embedding
-        result = genai.embed_content(
-            model="models/text-embedding-004",
-            content=content,
-            task_type="semantic_similarity"
-        )
-        current_vector = result['embedding']
+        # 埋め込み (on_message で取得済みならキャッシュから返る)
+        current_vector = await embed_text(content)
     except Exception as e:
-        print(f"Gemini Embedding Error: {e}")
+        print(f"Embedding Error: {e}")
+        return
+    if current_vector is None:
         return
 
     # 2. 過去ログから類似度60%前後のものを検索 (Designed Serendipity)
@@ -280,45 +502,65 @@ async def simulate_ai_connection(guild, author, content, forced_keyword=None):
     
     candidates = []
 
-    for uid, udata in db["users"].items():
-        # 自分自身の直近の発言は除外したいが、今回は簡易的に全探索
-        for history in udata.get("history", []):
-            if "vector" not in history:
-                continue
-            
-            # コサイン類似度計算
-            vec_a = np.array(current_vector)
-            vec_b = np.array(history["vector"])
-            
-            # ベクトルが空またはサイズ違いのチェック
-            if vec_a.size == 0 or vec_b.size == 0 or vec_a.shape != vec_b.shape:
-                continue
-
-            # キーワード強制マッチングロジック
-            if forced_keyword:
-                partner_stats = udata.get("keyword_stats", {})
-                partner_count = partner_stats.get(forced_keyword, 0)
-                
-                # そのキーワードを含む発言か？ または そのキーワードの熟練者が発した言葉か？
-                # 今回は「そのキーワードを含む発言」を対象としつつ、熟練度が高い人を優遇する
-                if forced_keyword in history["content"]:
-                    # 類似度を1.0固定ではなく、熟練度に応じて重み付けする
-                    # base_score 1.0 + (count * 0.1) -> 最大 2.0くらいまで伸びる
-                    score = 1.0 + min(partner_count * 0.1, 1.0)
-                    
-                    candidates.append({
-                        "content": history["content"], 
-                        "user_id": uid, 
-                        "similarity": score, 
-                        "is_keyword_match": True
-                    })
-                    continue
-            
-            similarity = np.dot(vec_a, vec_b) / (np.linalg.norm(vec_a) * np.linalg.norm(vec_b))
-            
-            # 類似度が0.5 ~ 0.7の範囲にあるものを候補にする
-            if 0.5 <= similarity <= 0.7:
-                candidates.append({"content": history["content"], "user_id": uid, "similarity": similarity, "is_keyword_match": False})
+    # キーワード強制マッチングロジック
+    # そのキーワードを含む発言か？ または そのキーワードの熟練者が発した言葉か？
+    # 今回は「そのキーワードを含む発言」を対象としつつ、熟練度が高い人を優遇する
+    # 候補は転置インデックスから直接取り出す（全履歴は走査しない）
+    postings = db.get_postings(forced_keyword) if forced_keyword else []
+    if postings:
+        # 類似度を1.0固定ではなく、熟練度に応じて重み付けする
+        # base_score 1.0 + (count * 0.1) -> 最大 2.0くらいまで伸びる
+        expertise = {}
+        for uid, _ in postings:
+            if uid not in expertise:
+                partner_count = (db.get_user(uid) or {}).get("keyword_stats", {}).get(forced_keyword, 0)
+                expertise[uid] = 1.0 + min(partner_count * 0.1, 1.0)
+        weights = [expertise[uid] for uid, _ in postings]
+
+        # スコア（熟練度込み）で重み付け抽選し、選ばれた1件の本文だけをDBから引く
+        uid, history_id = random.choices(postings, weights=weights, k=1)[0]
+        picked = db.get_history(history_id)
+        if picked:
+            candidates.append({
+                "content": picked[1],
+                "user_id": uid,
+                "similarity": expertise[uid],
+                "is_keyword_match": True
+            })
+
+    # 類似度が0.5 ~ 0.7の範囲にあるものを候補にする（正規化済み行列で一括計算）
+    # キーワードマッチがあればそちらが優先されるので、その場合は検索しない
+    if not candidates:
+        with span("search", stage=True):
+            if search_pool is not None:
+                # 全件スキャンはワーカープロセスで行い、イベントループを止めない
+                band_owner_ids, band_history_ids, band_sims = await search_pool.band(current_vector, *SIMILARITY_BAND)
+            else:
+                band_owner_ids, band_history_ids, band_sims = search_index.band(current_vector, *SIMILARITY_BAND)
+        if len(band_history_ids):
+            # 1件だけ抽選し、その本文だけをDBから引く
+            pick = random.randrange(len(band_history_ids))
+            picked = db.get_history(int(band_history_ids[pick]))
+            if picked:
+                candidates.append({
+                    "content": picked[1],
+                    "user_id": str(band_owner_ids[pick]),
+                    "similarity": float(band_sims[pick]),
+                    "is_keyword_match": False
+                })
+
+    # ホット層に候補がなければ、コールド層（古い履歴）もバンド検索する
+    if not candidates and HISTORY_COLD_SEARCH and len(cold_archive):
+        with span("search_cold", stage=True):
+            cold_matches = await asyncio.to_thread(cold_archive.band, current_vector, *SIMILARITY_BAND, embedder.name)
+        if cold_matches:
+            uid, cold_content, sim = random.choice(cold_matches)
+            candidates.append({
+                "content": cold_content,
+                "user_id": uid,
+                "similarity": sim,
+                "is_keyword_match": False
+            })
 
     # 候補の選定
     keyword_matches = [c for c in candidates if c.get("is_keyword_match")]
@@ -332,16 +574,10 @@ async def simulate_ai_connection(guild, author, content, forced_keyword=None):
         best_match = random.choice(candidates)
     else:
         # 候補がなければ、ランダムに過去ログから選ぶ（Asynchronous Synapsesの強制発動）
-        # 全履歴からランダム取得
-        all_history = []
-        for uid, udata in db["users"].items():
-            for h in udata.get("history", []):
-                if h["content"] != content: # 完全一致は避ける
-                    all_history.append({"content": h["content"], "user_id": uid})
-        
-        if all_history:
-            best_match = random.choice(all_history)
-            best_match["similarity"] = 0.0 # 擬似
+        # 全履歴から一様に抽選し、完全一致は選び直す（全履歴の走査はしない）
+        picked = db.random_history(exclude_content=content)
+        if picked:
+            best_match = {"user_id": picked[0], "content": picked[1], "similarity": 0.0} # 擬似
 
     if not best_match:
         return
@@ -371,13 +607,16 @@ async def simulate_ai_connection(guild, author, content, forced_keyword=None):
     - 出力は「接続コメント」のみにしてください。
     """
 
-    try:
-        model = genai.GenerativeModel('gemini-flash-latest')
-        response = model.generate_content(prompt)
-        ai_comment = response.text
-    except Exception as e:
-        print(f"Gemini Chat Error: {e}")
-        ai_comment = "思考の回線が混線しています...しかし、偶然のノイズもまた一興です。"
+    # 同じ組み合わせで生成済みならキャッシュから返す（失敗時のメッセージはキャッシュしない）
+    ai_comment = generation_cache.get(GENERATION_MODEL, CONNECTION_PROMPT_VERSION, content, partner_content)
+    if ai_comment is None:
+        try:
+            with span("generate", stage=True):
+                ai_comment = await gemini.generate(prompt, GENERATION_MODEL)
+            generation_cache.put(GENERATION_MODEL, CONNECTION_PROMPT_VERSION, content, partner_content, ai_comment)
+        except Exception as e:
+            print(f"Gemini Chat Error: {e}")
+            ai_comment = "思考の回線が混線しています...しかし、偶然のノイズもまた一興です。"
     
     # ログチャンネル（またはユーザーのチャンネル）に投稿
     # ここではユーザーのチャンネルに投稿する
@@ -386,24 +625,321 @@ async def simulate_ai_connection(guild, author, content, forced_keyword=None):
     embed.add_field(name="過去の残響", value=partner_content, inline=False)
     embed.add_field(name="AIの視座", value=ai_comment, inline=False)
     
-    await log_channel.send(embed=embed)
+    with span("discord_send", stage=True):
+        await log_channel.send(embed=embed)
+
+
+
 
 
 
 
 
+# ==========================================
+# INGESTION
+# ==========================================
+
+async def process_ingest_item(item):
+    """
+    取り込みキューのワーカー処理（on_message と同じトレースIDで計測する）
+    """
+    with span("ingest", trace_id=item.get("trace_id")):
+        await ingest_message(item)
+
+async def ingest_message(item):
+    """
+    ベクトル化 → 履歴保存 → 思考接続
+    """
+    user_id = item["user_id"]
+    content = item["content"]
+
+    # ベクトル化して保存
+    vector = None
+    try:
+        if EMBEDDING_ENABLED and content.strip():
+            with span("embed", stage=True):
+                vector = await embed_text(content)
+    except Exception as e:
+        print(f"Embedding Error: {e}")
 
+    # 投稿履歴の保存（AI解析用データとして）
+    # ベクトル本体はベクトルストアに追記し、履歴には行番号だけを残す
+    vector_id = vectors.append(vector) if vector is not None else None
+    history_id = db.append_history(user_id, content, item["timestamp"], vector_id, embedder.name if vector_id is not None else None)
+    item["stored"] = True
+    if vector_id is not None:
+        search_index.add(user_id, history_id, vector)
+        db.add_postings(user_id, history_id, keyword_matcher.find(content))
+
+    if item["should_trigger"] and GEMINI_API_KEY:
+        # forced_keywordがあった場合はそれを渡す、なければNone
+        await simulate_ai_connection(item["guild"], item["author"], content, item["forced_keyword"])
+
+def drop_ingest_item(item):
+    """
+    キューから溢れたメッセージ: AI処理は諦めるが、発言そのものは履歴に残す
+    （終了処理で思考接続の途中に止められた場合は、履歴は保存済み）
+    """
+    if item.get("stored"):
+        return
+    db.append_history(item["user_id"], item["content"], item["timestamp"], None)
 
+ingest_queue = IngestQueue(
+    process_ingest_item,
+    on_drop=drop_ingest_item,
+    workers=INGEST_WORKERS,
+    maxsize=INGEST_QUEUE_SIZE,
+    overflow=INGEST_OVERFLOW
+)
 
 # ==========================================
 # EVENTS
 # ==========================================
 
+# 既存メンバーの一括オンボーディング (進捗はDBに記録し、中断しても再開できる)
+onboarding_backfill = OnboardingBackfill(store, db, create_personal_channel, concurrency=BACKFILL_CONCURRENCY)
+
+def is_provisioned(guild, member):
+    """
+    個室チャンネルとロールがすでに揃っているか
+    （role_id 未記録の既存ユーザーは get_member_role が名前で探して記録する）
+    """
+    user_data = db.get_user(str(member.id))
+    if not user_data or not user_data.get("channel_id"):
+        return False
+    return guild.get_channel(user_data["channel_id"]) is not None and get_member_role(guild, member) is not None
+
+async def run_onboarding_backfill(guild, report_channel):
+    """
+    一括オンボーディングを実行し、進捗とETAを report_channel に報告する
+    """
+    async def report(stats):
+        eta = f"{stats['eta'] / 60:.1f}分" if stats["eta"] is not None else "計算中"
+        await report_channel.send(
+            f"⏳ **Onboarding**: {stats['done'] + stats['failed']} / {stats['total']} 人 "
+            f"(失敗: {stats['failed']}, {stats['rate_per_min']:.1f}人/分, 残り約{eta})"
+        )
+
+    stats = await onboarding_backfill.run(guild, report=report if report_channel else None)
+    if stats and report_channel:
+        await report_channel.send(
+            f"✅ **Onboarding 完了**: {stats['done']} 人をセットアップしました "
+            f"(失敗: {stats['failed']}, {stats['elapsed'] / 60:.1f}分, {stats['rate_per_min']:.1f}人/分)"
+        )
+
+# 期限付きロールの失効 (再起動しても DB から読み直す)
+expiry_scheduler = ExpiryScheduler(store)
+
+async def revoke_expose_roles(entries):
+    """
+    /expose で付与したロールをまとめて剥奪する。再試行したい予定を返す
+    """
+    revocations = []
+    for entry in entries:
+        guild = bot.get_guild(entry["guild_id"])
+        if guild is None:
+            continue
+        member = guild.get_member(entry["member_id"]) # メンバーがまだいるか確認
+        role = guild.get_role(entry["role_id"])
+        if member is None or role is None or role not in member.roles:
+            continue
+        revocations.append((entry, member, role))
+
+    # ロール剥奪
+    result = await fan_out(revocations, lambda r: r[1].remove_roles(r[2]), limit=FANOUT_CONCURRENCY)
+
+    failed = []
+    for (entry, _, _), e in result.failed:
+        if isinstance(e, discord.NotFound):
+            continue
+        print(f"Role Revoke Error: {e}")
+        failed.append(entry)
+    return failed
+
+expiry_scheduler.register("expose_role", revoke_expose_roles)
+
+@tasks.loop(seconds=30)
+@traced()
+async def process_expirations():
+    """
+    期限を過ぎた予定を処理する（停止中に期限が来た分も起動直後にまとめて処理される）
+    """
+    # 例外をループの外に出すと tasks.loop ごと止まり、以後の失効が処理されなくなる
+    try:
+        while await expiry_scheduler.run_due() > 0:
+            pass
+    except Exception as e:
+        print(f"Expiration Error: {e}")
+
+@tasks.loop(minutes=30)
+@traced()
+async def rebuild_search_index():
+    """
+    近似インデックスの定期再構築（件数が増えたときだけ）
+    重心の計算は別スレッドで行い、反映だけをイベントループ上で行う
+    """
+    if not isinstance(search_index, IVFBandIndex) or not search_index.needs_rebuild():
+        return
+    try:
+        # 行列のスナップショットはループ上で取る（学習中の追加・削除の影響を受けない）
+        trained = await asyncio.to_thread(search_index.train, search_index.snapshot())
+        if search_index.install(trained):
+            print(f"Search index rebuilt: {len(search_index)} vectors")
+        else:
+            print("Search index rebuild skipped: rows were removed during training")
+    except Exception as e:
+        print(f"Search Index Rebuild Error: {e}")
+
+@tasks.loop(minutes=1)
+async def watch_keywords_file():
+    """
+    キーワードファイルが更新されていたら読み直す
+    """
+    try:
+        if keyword_matcher.reload_if_changed():
+            db.sync_keyword_index(keyword_matcher.keywords)
+    except Exception as e:
+        print(f"Keyword Reload Error: {e}")
+
+# ==========================================
+# METRICS
+# ==========================================
+# /metrics で公開するゲージ（値は読み出し時に計算する）
+Gauge("noise_storage_bytes", "On-disk / in-memory size of each store", ["store"], function=lambda: {
+    ("db",): store.size_bytes(),
+    ("vectors",): vectors.size_bytes(),
+    ("search_matrix",): search_engine.nbytes(),
+    ("cold_archive",): cold_archive.size_bytes(),
+    ("embed_cache",): embedding_cache.stats()["disk_bytes"],
+})
+Gauge("noise_history_rows", "History rows by tier", ["tier"], function=lambda: {
+    ("hot",): len(db.registry),
+    ("cold",): len(cold_archive),
+    ("indexed",): len(search_index),
+})
+Gauge("noise_ingest_queue_depth", "Messages waiting in the ingest queue", function=lambda: ingest_queue.depth)
+Gauge("noise_ingest_oldest_lag_seconds", "Age of the oldest queued message", function=lambda: ingest_queue.oldest_lag())
+Gauge("noise_ingest_items", "Ingest queue outcomes", ["outcome"], function=lambda: {
+    ("processed",): ingest_queue.processed,
+    ("dropped",): ingest_queue.dropped,
+    ("failed",): ingest_queue.failed,
+})
+Gauge("noise_cache_lookups", "Embedding / generation cache lookups", ["cache", "result"], function=lambda: {
+    (cache, result): stats[result]
+    for cache, stats in (("embedding", embedding_cache.stats()), ("generation", generation_cache.stats()))
+    for result in ("hits", "disk_hits", "misses")
+})
+Gauge("noise_gemini_circuit_open", "1 while the Gemini circuit breaker is not closed", ["kind"], function=lambda: {
+    (kind,): 0 if breaker.state == "closed" else 1 for kind, breaker in gemini.breakers.items()
+})
+
+metrics_server = MetricsServer()
+event_loop_monitor = None
+shutdown_task = None
+
+async def shutdown():
+    """
+    SIGTERM (systemctl restart / Cloud Run の入れ替え) で呼ばれる
+    取り込みキューを処理しきってから切断する（DB の書き出しは bot.run 後の終了処理で行う）
+    """
+    print("SIGTERM received, shutting down...")
+    try:
+        await ingest_queue.drain(timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    except Exception as e:
+        print(f"Ingest Drain Error: {e}")
+    await bot.close()
+
+def request_shutdown():
+    global shutdown_task
+    if shutdown_task is None:
+        shutdown_task = asyncio.create_task(shutdown())
+
+@bot.event
+async def setup_hook():
+    global event_loop_monitor
+    # 起動中の待ち受けを閉じ、同じポートで /metrics とヘルスチェックを始める
+    if METRICS_PORT:
+        await asyncio.to_thread(startup_health.stop)
+        await metrics_server.start(METRICS_PORT)
+    event_loop_monitor = asyncio.create_task(monitor_event_loop())
+    # discord.py は SIGTERM を扱わないので、自前で終了処理につなぐ
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, request_shutdown)
+
 @bot.event
 async def on_ready():
     print(f'Logged in as {bot.user.name}')
+    ingest_queue.start()
+    if not process_expirations.is_running():
+        process_expirations.start()
+
+    # 中断された一括オンボーディングがあれば再開する
+    for guild_id in store.backfill_guilds():
+        guild = bot.get_guild(guild_id)
+        if guild and not onboarding_backfill.is_running(guild_id):
+            log_channel = discord.utils.get(guild.text_channels, name=LOG_CHANNEL_NAME)
+            asyncio.create_task(run_onboarding_backfill(guild, log_channel))
+    if not rebuild_search_index.is_running():
+        rebuild_search_index.start()
+    if not watch_keywords_file.is_running():
+        watch_keywords_file.start()
+
+@bot.event
+async def on_guild_role_create(role):
+    """
+    個室ロールが作られたら、持ち主の role_id を記録する
+    """
+    if not role.name.startswith(ROLE_PREFIX):
+        return
+    member = discord.utils.get(role.guild.members, name=role.name[len(ROLE_PREFIX):])
+    if member and db.get_user(str(member.id)) and not db.get_role_id(str(member.id)):
+        db.update_user(str(member.id), role_id=role.id)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    """
+    手動で個室ロール名に付け替えられた場合も、持ち主が未記録なら拾う
+    """
+    if db.find_owner_by_role(after.id) is None and after.name != before.name:
+        await on_guild_role_create(after)
+
+@bot.event
+async def on_guild_role_delete(role):
+    """
+    個室ロールが消えたら逆引きから外す（次回 create_personal_channel で作り直される）
+    """
+    owner_id = db.find_owner_by_role(role.id)
+    if owner_id:
+        db.update_user(owner_id, role_id=None)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    """
+    個室チャンネルが消えたら持ち主との紐付けを外す
+    """
+    owner_id = db.find_owner_by_channel(channel.id)
+    if owner_id and db.get_user(owner_id).get("channel_id") == channel.id:
+        db.update_user(owner_id, channel_id=None)
 
 @bot.event
+async def on_user_update(before, after):
+    """
+    ユーザー名が変わったら個室ロールの名前も追従させる（role_id で引くので権限は壊れない）
+    """
+    if before.name == after.name:
+        return
+    role_id = db.get_role_id(str(after.id))
+    if not role_id:
+        return
+    for guild in bot.guilds:
+        role = guild.get_role(role_id)
+        if role and role.name == f"{ROLE_PREFIX}{before.name}":
+            try:
+                await role.edit(name=f"{ROLE_PREFIX}{after.name}")
+            except discord.HTTPException as e:
+                print(f"Role Rename Error: {e}")
+
+@bot.event
+@traced()
 async def on_member_join(member):
     """
     【機能1：自動オンボーディング】
@@ -412,6 +948,7 @@ async def on_member_join(member):
     await create_personal_channel(member)
 
 @bot.event
+@traced()
 async def on_message(message):
     """
     【機能2：ポイントシステム & AIフック】
@@ -420,26 +957,19 @@ async def on_message(message):
     if message.author.bot:
         return
 
-    # DB読み込み
-    db = load_db()
+    MESSAGES.inc()
     user_id = str(message.author.id)
 
     # ユーザー登録がまだなら作成（既存メンバー用）
-    if user_id not in db["users"]:
-        db["users"][user_id] = {"channel_id": message.channel.id, "points": 0, "history": [], "expose_count": 0}
-
-    # キーワード統計データの初期化
-    if "keyword_stats" not in db["users"][user_id]:
-        db["users"][user_id]["keyword_stats"] = {}
+    user_data = db.ensure_user(user_id, channel_id=message.channel.id)
 
     # ==================================================
     # チュートリアルのリトライチェック
     # ==================================================
-    if db["users"][user_id].get("onboarding_status") == "pending_retry":
+    if user_data.get("onboarding_status") == "pending_retry":
         # リトライ待ち状態なら、この発言をチュートリアルの回答として処理
         # ステータスを進行中に変更（多重実行防止）
-        db["users"][user_id]["onboarding_status"] = "processing"
-        save_db(db)
+        db.update_user(user_id, onboarding_status="processing")
         
         await complete_onboarding_tutorial(message.author, message.channel, message.content)
         # complete_onboarding_tutorial内で完了ステータスに更新される
@@ -453,59 +983,27 @@ async def on_message(message):
     if message.channel.name.startswith("times-") and message.mentions:
         # チャンネルの持ち主か確認（簡易判定: チャンネル名とユーザー名の一致、またはDB）
         # DBから持ち主判定
-        is_owner = False
-        owner_id = None
-        for uid, val in db["users"].items():
-            if val.get("channel_id") == message.channel.id:
-                owner_id = uid
-                break
+        owner_id = db.find_owner_by_channel(message.channel.id)
         
         if owner_id == str(message.author.id):
             # 持ち主による言及のみ発動
-            role_name = f"role-times-{message.author.name}"
-            role = discord.utils.get(message.guild.roles, name=role_name)
+            role = get_member_role(message.guild, message.author)
             
             if role:
-                invited_names = []
-                for mentioned in message.mentions:
-                    if mentioned.bot or mentioned.id == message.author.id:
-                        continue
-                    
-                    if role not in mentioned.roles:
-                        await mentioned.add_roles(role)
-                        invited_names.append(mentioned.name)
-                        try:
-                            await mentioned.send(f"⚡ **思考への招待** ⚡\n{message.author.name} があなたを思考の部屋に招待しました。\nチャンネル: {message.channel.mention}")
-                        except:
-                            pass
-                
-                if invited_names:
-                    await message.channel.send(f"🔓 **Direct Invite**: {', '.join(invited_names)} を部屋に招き入れました。")
+                invitees = [
+                    mentioned for mentioned in message.mentions
+                    if not mentioned.bot and mentioned.id != message.author.id and role not in mentioned.roles
+                ]
+                notice = f"⚡ **思考への招待** ⚡\n{message.author.name} があなたを思考の部屋に招待しました。\nチャンネル: {message.channel.mention}"
+                result = await fan_out(invitees, lambda m: grant_room_role(m, role, notice), limit=FANOUT_CONCURRENCY)
+
+                if result:
+                    invited_names = [m.name for m, _ in result.succeeded]
+                    await message.channel.send(f"🔓 **Direct Invite**: {', '.join(invited_names) or 'なし'} を部屋に招き入れました。{summarize_fanout(result)}")
 
     # ポイント加算 (+1pt)
-    db["users"][user_id]["points"] += 1
+    db.add_points(user_id, 1)
     
-    # ベクトル化して保存
-    vector = []
-    try:
-        if GEMINI_API_KEY:
-            result = genai.embed_content(
-                model="models/text-embedding-004",
-                content=message.content,
-                task_type="semantic_similarity"
-            )
-            vector = result['embedding']
-    except Exception as e:
-        print(f"Embedding Error: {e}")
-
-    # 投稿履歴の保存（AI解析用データとして）
-    db["users"][user_id]["history"].append({
-        "content": message.content,
-        "timestamp": str(datetime.now()),
-        "vector": vector
-    })
-    save_db(db)
-
     # ---------------------------------------------------------
     # 【機能3：AI思考接続 (Simulation)】
     # ---------------------------------------------------------
@@ -516,42 +1014,44 @@ async def on_message(message):
     trigger_prob = 0.05 # デフォルト確率 (Ver.X Update: 0.1 -> 0.05)
 
     # 思考接続ON/OFF判定
-    user_conf = db["users"][user_id].get("connection_enabled", True) # デフォルトTrue
+    user_conf = user_data.get("connection_enabled", True) # デフォルトTrue
     if not user_conf:
         # OFFならトリガーしない（キーワード集計などはしてもよいが、今回はトリガー自体を抑制）
         pass
     else:    
         # 1. キーワード判定 (優先)
-    
-    # 1. キーワード判定 (優先)
-    for kw in CONNECTION_KEYWORDS:
-        if kw in message.content:
-            # カウントアップ
-            current_count = db["users"][user_id]["keyword_stats"].get(kw, 0)
-            db["users"][user_id]["keyword_stats"][kw] = current_count + 1
-            save_db(db) # 更新
+        # 含まれるキーワードを1回の走査で全部拾う（キーワード一覧の順で返る）
+        for kw in keyword_matcher.find(message.content):
+            # カウントアップ（更新後の回数が返る）
+            keyword_count = db.increment_keyword(user_id, kw)
             
             # 確率計算: 0.1 スタート、1回につき +0.09 -> 10回で1.0 (100%)
             # min(1.0, 0.1 + count * 0.09)
             # countが加算された最新の値を使う
-            prob = min(1.0, 0.1 + (db["users"][user_id]["keyword_stats"][kw] * 0.09))
+            prob = min(1.0, 0.1 + (keyword_count * 0.09))
             
             # 確率が一番高いキーワードを優先する（複数ヒットした場合）
             if prob > trigger_prob:
                 trigger_prob = prob
                 forced_keyword = kw
 
-    # 2. 確率判定
-    # forced_keywordがある場合、trigger_probは上昇している
-    if random.random() < trigger_prob:
-        should_trigger = True
-
-    if should_trigger:
-        if GEMINI_API_KEY:
-            # forced_keywordがあった場合はそれを渡す、なければNone
-            await simulate_ai_connection(message.guild, message.author, message.content, forced_keyword)
-        else:
-            pass
+        # 2. 確率判定
+        # forced_keywordがある場合、trigger_probは上昇している
+        if random.random() < trigger_prob:
+            should_trigger = True
+            CONNECTION_TRIGGERS.inc(keyword=forced_keyword or "")
+
+    # ベクトル化・履歴保存・思考接続はワーカーに任せる（溢れた場合はAI処理だけ捨てる）
+    ingest_queue.submit({
+        "guild": message.guild,
+        "author": message.author,
+        "user_id": user_id,
+        "content": message.content,
+        "timestamp": str(datetime.now()),
+        "should_trigger": should_trigger,
+        "forced_keyword": forced_keyword,
+        "trace_id": TRACER.current_trace_id()
+    })
 
     await bot.process_commands(message)
 
@@ -559,6 +1059,16 @@ async def on_message(message):
 # COMMANDS
 # ==========================================
 
+# コマンドもスパンとして計測する（on_message から呼ばれた場合はその子スパンになる）
+@bot.before_invoke
+async def start_command_span(ctx):
+    ctx.trace_span = span(f"command:{ctx.command.qualified_name}")
+    ctx.trace_span.__enter__()
+
+@bot.after_invoke
+async def end_command_span(ctx):
+    ctx.trace_span.__exit__(None, None, None)
+
 @bot.command()
 async def init_channel(ctx, member: discord.Member):
     """
@@ -571,13 +1081,40 @@ async def init_channel(ctx, member: discord.Member):
     await create_personal_channel(member)
     await ctx.send(f"{member.name} さんのチャンネルとロールのセットアップが完了しました。")
 
+@bot.command()
+async def init_all(ctx):
+    """
+    まだセットアップされていない全メンバーのチャンネルとロールを一括作成する（管理者専用）
+    中断された場合は、再実行（または再起動）で続きから再開する
+    """
+    if ctx.author.name != "udonpalta":
+        await ctx.send("このコマンドを実行する権限がありません。")
+        return
+
+    if onboarding_backfill.is_running(ctx.guild.id):
+        await ctx.send("一括セットアップはすでに実行中です。")
+        return
+
+    # 対象の登録は DB に直接書くので、履歴の圧縮中なら終わるまで待つ
+    if history_retention.running:
+        await ctx.send("履歴の圧縮が終わるのを待っています...")
+        await history_retention.wait_idle()
+
+    members = [m for m in ctx.guild.members if not m.bot and not is_provisioned(ctx.guild, m)]
+    pending = onboarding_backfill.plan(ctx.guild, members)
+    if not pending:
+        await ctx.send("セットアップが必要なメンバーはいません。")
+        return
+
+    await ctx.send(f"🚀 {len(pending)} 人の一括セットアップを開始します (同時実行数: {BACKFILL_CONCURRENCY})")
+    await run_onboarding_backfill(ctx.guild, ctx.channel)
+
 @bot.command()
 async def status(ctx):
     """自分のポイントを確認するコマンド"""
-    db = load_db()
-    user_id = str(ctx.author.id)
-    points = db["users"].get(user_id, {}).get("points", 0)
-    expose_count = db["users"].get(user_id, {}).get("expose_count", 0)
+    user_data = db.get_user(str(ctx.author.id)) or {}
+    points = user_data.get("points", 0)
+    expose_count = user_data.get("expose_count", 0)
     
     # 次回のコスト計算
     if expose_count == 0:
@@ -598,9 +1135,8 @@ async def expose(ctx, mode: str = None):
     ポイントを消費して、ランダムな3人に自分の部屋を24時間公開する
     Usage: /expose [random]
     """
-    db = load_db()
     user_id = str(ctx.author.id)
-    user_data = db["users"].get(user_id)
+    user_data = db.get_user(user_id)
 
     if not user_data:
         await ctx.send("ユーザーデータがありません。まずは何か発言してください。")
@@ -640,9 +1176,8 @@ async def expose(ctx, mode: str = None):
             return
 
     # ポイント消費 & カウントアップ
-    user_data["points"] -= cost
-    user_data["expose_count"] = expose_count + 1
-    save_db(db)
+    db.add_points(user_id, -cost)
+    db.update_user(user_id, expose_count=expose_count + 1)
 
     # ターゲット選定（自分以外のメンバーからランダムに3人）
     members = [m for m in ctx.guild.members if not m.bot and m.id != ctx.author.id]
@@ -653,34 +1188,24 @@ async def expose(ctx, mode: str = None):
     targets = random.sample(members, min(3, len(members)))
     
     # 権限変更（ロールを付与する）
-    role_name = f"role-times-{ctx.author.name}"
-    role = discord.utils.get(ctx.guild.roles, name=role_name)
+    role = get_member_role(ctx.guild, ctx.author)
     
     if not role:
         await ctx.send("あなたのチャンネルロールが見つかりません。")
         return
 
-    exposed_names = []
-    
-    for target in targets:
-        # ロール付与
-        if role not in target.roles:
-            await target.add_roles(role)
-            exposed_names.append(target.name)
-            # 通知を送る
-            try:
-                await target.send(f"⚡ **思考の介入** ⚡\n{ctx.author.name} さんがポイントを消費して、あなたに思考を公開しました。\nチャンネル: {ctx.channel.mention}")
-            except:
-                pass
+    # ロール付与と通知を並行して行う
+    notice = f"⚡ **思考の介入** ⚡\n{ctx.author.name} さんがポイントを消費して、あなたに思考を公開しました。\nチャンネル: {ctx.channel.mention}"
+    pending = [target for target in targets if role not in target.roles]
+    result = await fan_out(pending, lambda t: grant_room_role(t, role, notice), limit=FANOUT_CONCURRENCY)
 
-    await ctx.send(f"✅ **露出成功** (回数: {expose_count+1}, 消費: {cost}pt)\n以下のメンバーにこの部屋を公開しました（ロール付与）。\n対象: {', '.join(exposed_names)}")
+    exposed_names = []
+    for target, _ in result.succeeded:
+        exposed_names.append(target.name)
+        # 24時間後に権限を戻す（DBに期限を記録するので再起動しても失われない）
+        expiry_scheduler.schedule(EXPOSE_DURATION, "expose_role", ctx.guild.id, role.id, target.id)
 
-    # 24時間後に権限を戻す処理（非同期で待機）
-    # ※ 本番環境ではBot再起動対策のため、DBで期限管理をする必要がある
-    await asyncio.sleep(86400) # 24時間待機
-    for target in targets:
-        if target in ctx.guild.members: # メンバーがまだいるか確認
-             await target.remove_roles(role) # ロール剥奪
+    await ctx.send(f"✅ **露出成功** (回数: {expose_count+1}, 消費: {cost}pt)\n以下のメンバーにこの部屋を公開しました（ロール付与）。\n対象: {', '.join(exposed_names)}{summarize_fanout(result)}")
 
 @bot.command()
 async def expose_to(ctx, member: discord.Member):
@@ -688,9 +1213,8 @@ async def expose_to(ctx, member: discord.Member):
     指定したユーザーに自分の部屋を永久公開する
     コスト: 通常のexpose + 1pt
     """
-    db = load_db()
     user_id = str(ctx.author.id)
-    user_data = db["users"].get(user_id)
+    user_data = db.get_user(user_id)
 
     if not user_data:
         await ctx.send("ユーザーデータがありません。")
@@ -714,25 +1238,23 @@ async def expose_to(ctx, member: discord.Member):
         return
 
     # ロール取得
-    role_name = f"role-times-{ctx.author.name}"
-    role = discord.utils.get(ctx.guild.roles, name=role_name)
+    role = get_member_role(ctx.guild, ctx.author)
     if not role:
         await ctx.send("あなたのチャンネルロールが見つかりません。")
         return
 
     # ポイント消費 & カウントアップ
-    user_data["points"] -= cost
-    user_data["expose_count"] = expose_count + 1
-    save_db(db)
+    db.add_points(user_id, -cost)
+    db.update_user(user_id, expose_count=expose_count + 1)
+
+    # 永久公開なので、/expose による失効予定があれば取り消す
+    expiry_scheduler.cancel(role.id, member.id)
 
     # ロール付与
     if role not in member.roles:
-        await member.add_roles(role)
-        try:
-            await member.send(f"⚡ **思考の介入 (永続)** ⚡\n{ctx.author.name} さんがポイントを消費して、あなたに思考を永久公開しました。\nチャンネル: {ctx.channel.mention}")
-        except:
-            pass
-        await ctx.send(f"✅ **永久露出成功** (回数: {expose_count+1}, 消費: {cost}pt)\n{member.name} にこの部屋を永久公開しました。")
+        notice = f"⚡ **思考の介入 (永続)** ⚡\n{ctx.author.name} さんがポイントを消費して、あなたに思考を永久公開しました。\nチャンネル: {ctx.channel.mention}"
+        dm_sent = await grant_room_role(member, role, notice)
+        await ctx.send(f"✅ **永久露出成功** (回数: {expose_count+1}, 消費: {cost}pt)\n{member.name} にこの部屋を永久公開しました。" + ("" if dm_sent else "\n📭 DMは届きませんでした。"))
     else:
         await ctx.send(f"{member.name} は既にこの部屋の閲覧権限を持っています。（ポイントは消費されました）")
 
@@ -741,9 +1263,8 @@ async def rename(ctx, new_name: str):
     """
     自分のチャンネル名を変更する
     """
-    db = load_db()
     user_id = str(ctx.author.id)
-    user_data = db["users"].get(user_id)
+    user_data = db.get_user(user_id)
 
     if not user_data:
         await ctx.send("ユーザーデータがありません。")
@@ -770,13 +1291,15 @@ async def grant_access(ctx, receiver: discord.Member, target: discord.Member):
         return
 
     # targetのロールを取得
-    role_name = f"role-times-{target.name}"
-    role = discord.utils.get(ctx.guild.roles, name=role_name)
+    role = get_member_role(ctx.guild, target)
     
     if not role:
         await ctx.send(f"{target.name} さんのチャンネルロールが見つかりません。")
         return
 
+    # 永久付与なので、/expose による失効予定があれば取り消す
+    expiry_scheduler.cancel(role.id, receiver.id)
+
     # receiverにロール付与
     if role not in receiver.roles:
         await receiver.add_roles(role)
@@ -803,9 +1326,8 @@ async def disconnect(ctx, member: discord.Member):
     【チャンネル管理】
     指定したユーザーの閲覧権限を剥奪する (Kick/Ban)
     """
-    db = load_db()
     user_id = str(ctx.author.id)
-    user_data = db["users"].get(user_id)
+    user_data = db.get_user(user_id)
 
     if not user_data:
         await ctx.send("ユーザーデータがありません。")
@@ -817,8 +1339,7 @@ async def disconnect(ctx, member: discord.Member):
         return
 
     # ロール取得
-    role_name = f"role-times-{ctx.author.name}"
-    role = discord.utils.get(ctx.guild.roles, name=role_name)
+    role = get_member_role(ctx.guild, ctx.author)
     
     if not role:
         await ctx.send("チャンネルロールが見つかりません。")
@@ -830,27 +1351,138 @@ async def disconnect(ctx, member: discord.Member):
     else:
         await ctx.send(f"{member.name} は部屋にいません。")
 
+@bot.command()
+async def ingest_status(ctx):
+    """
+    取り込みキューの状態を確認する（管理者専用）
+    """
+    if ctx.author.name != "udonpalta":
+        await ctx.send("このコマンドを実行する権限がありません。")
+        return
+
+    stats = ingest_queue.stats()
+    await ctx.send(
+        f"📥 **Ingest Queue**\n"
+        f"待ち: {stats['depth']} / {stats['maxsize']} 件 (最古: {stats['oldest_lag']:.1f}秒, 直近の待ち時間: {stats['last_lag']:.1f}秒)\n"
+        f"処理済み: {stats['processed']} / 破棄: {stats['dropped']} / 失敗: {stats['failed']}"
+    )
+
+@bot.command()
+async def reload_keywords(ctx):
+    """
+    キーワードファイルを再読み込みする（管理者専用）
+    """
+    if ctx.author.name != "udonpalta":
+        await ctx.send("このコマンドを実行する権限がありません。")
+        return
+
+    count = keyword_matcher.reload()
+    db.sync_keyword_index(keyword_matcher.keywords)
+    await ctx.send(f"🔑 キーワードを再読み込みしました ({count}件)")
+
+profiler = None
+
+@bot.command()
+async def profile(ctx, seconds: int = 30):
+    """
+    イベントループのサンプリングプロファイルを取り、遅いスパンと一緒に noise-log へ送る（管理者専用）
+    """
+    global profiler
+    if ctx.author.name != "udonpalta":
+        await ctx.send("このコマンドを実行する権限がありません。")
+        return
+
+    if profiler and profiler.running:
+        await ctx.send("⏳ プロファイルは既に実行中です。")
+        return
+
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    log_channel = discord.utils.get(ctx.guild.text_channels, name=LOG_CHANNEL_NAME) or ctx.channel
+    await ctx.send(f"🔬 {seconds}秒間プロファイルを取ります。結果は {log_channel.mention} に送ります。")
+
+    started = time.time()
+    own_trace = TRACER.current_trace_id()
+    profiler = SamplingProfiler(threading.get_ident(), interval=PROFILE_INTERVAL)
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        await asyncio.to_thread(profiler.stop)
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded")
+    with open(path, "w") as f:
+        f.write(profiler.collapsed())
+
+    # このコマンド自身のトレースは除く
+    slow = [s for s in TRACER.slowest(PROFILE_TOP_SPANS + 5, since=started) if s["trace_id"] != own_trace]
+    lines = [f"🔬 **Profile** ({seconds}秒, {profiler.samples} サンプル)", "", "**遅いスパン**"]
+    for s in slow[:PROFILE_TOP_SPANS]:
+        lines.append(f"`{s['duration'] * 1000:8.1f}ms` {s['name']} (trace {s['trace_id']})")
+    if not slow:
+        lines.append("(なし)")
+    lines += ["", "**よく実行されていた関数**"]
+    for frame, count in profiler.top_functions(5):
+        lines.append(f"`{count / max(1, profiler.samples) * 100:5.1f}%` {frame[:80]}")
+    await log_channel.send("\n".join(lines)[:2000], file=discord.File(path))
+
+@bot.command()
+async def compact_history(ctx):
+    """
+    ホット窓から外れた履歴を圧縮セグメントに移す（管理者専用）
+    """
+    if ctx.author.name != "udonpalta":
+        await ctx.send("このコマンドを実行する権限がありません。")
+        return
+
+    if history_retention.running:
+        await ctx.send("⏳ 履歴の圧縮は既に実行中です。")
+        return
+
+    await ctx.send("🗜️ 履歴の圧縮を開始します...")
+    result = await history_retention.compact(search_index, ingest_queue, expiry_scheduler)
+    mb = 1024 * 1024
+    await ctx.send(
+        f"🗜️ **History Compaction**\n"
+        f"コールド層へ移動: {result['archived']} 件 (セグメント: {result['segment_bytes'] / mb:.1f}MB)\n"
+        f"DB: {result['before']['db'] / mb:.1f}MB → {result['after']['db'] / mb:.1f}MB / "
+        f"ベクトル: {result['before']['vectors'] / mb:.1f}MB → {result['after']['vectors'] / mb:.1f}MB\n"
+        f"解放: {result['reclaimed'] / mb:.1f}MB (正味: {(result['reclaimed'] - result['segment_bytes']) / mb:.1f}MB)\n"
+        f"コールド層合計: {len(cold_archive)} 件 / {cold_archive.size_bytes() / mb:.1f}MB"
+    )
+
 @bot.command()
 async def toggle_connection(ctx):
     """
     【思考接続設定】
     AIによる思考接続（横槍）のON/OFFを切り替える
     """
-    db = load_db()
     user_id = str(ctx.author.id)
+    user_data = db.get_user(user_id)
     
-    if user_id not in db["users"]:
+    if not user_data:
         await ctx.send("ユーザーデータがありません。")
         return
     
-    current_status = db["users"][user_id].get("connection_enabled", True)
+    current_status = user_data.get("connection_enabled", True)
     new_status = not current_status
     
-    db["users"][user_id]["connection_enabled"] = new_status
-    save_db(db)
+    db.update_user(user_id, connection_enabled=new_status)
     
     status_msg = "ON" if new_status else "OFF"
     await ctx.send(f"⚡ 思考接続機能を **{status_msg}** にしました。")
 
-# 実行
-bot.run(TOKEN)
+# 実行（bench.py などから import した場合は起動しない）
+if __name__ == "__main__":
+    try:
+        bot.run(TOKEN)
+    finally:
+        # 取り込みキューに残った発言を履歴に回し、未フラッシュの変更を書き出してから終了する
+        ingest_queue.discard_pending()
+        db.close()
+        vectors.close()
+        embedding_cache.close()
+        generation_cache.close()
+        gemini.close()
+        if search_pool is not None:
+            search_pool.close()
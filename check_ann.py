@@ -0,0 +1,74 @@
+import sys
+import time
+
+import numpy as np
+
+from search import BandSearchEngine, IVFBandIndex
+from vector_store import load_by_space
+
+# 全件スキャン (BandSearchEngine) と IVF インデックスの
+# 再現率 / レイテンシを n_probe ごとに比較するレポート
+# Usage: python check_ann.py [ベクトルファイル] [クエリ数] [DBファイル]
+# ファイルがなければ合成データ（クラスタ付き768次元）で計測する
+
+VECTOR_FILE = sys.argv[1] if len(sys.argv) > 1 else "noise_vectors.f32"
+N_QUERIES = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+DB_PATH = sys.argv[3] if len(sys.argv) > 3 else "noise_db.sqlite3"
+DIM = 768
+BAND = (0.5, 0.7)
+PROBES = [4, 8, 16, 32, 64, 128, None]
+
+rng = np.random.default_rng(0)
+
+
+def load_spaces():
+    spaces = load_by_space(VECTOR_FILE, DB_PATH, dim=DIM)
+    if spaces is None:
+        n = 100000
+        centers = rng.normal(size=(300, DIM))
+        print(f"{VECTOR_FILE} or {DB_PATH} not found. Using {n} synthetic vectors")
+        return {"synthetic": centers[rng.integers(0, len(centers), n)] + rng.normal(size=(n, DIM)) * 0.9}
+    for space, matrix in spaces.items():
+        print(f"Loaded {len(matrix)} vectors of {space} from {VECTOR_FILE}")
+    return spaces
+
+
+def report(space, matrix):
+    print(f"\n=== {space}: {len(matrix)} vectors ===")
+    engine = BandSearchEngine(dim=DIM)
+    engine.add_batch(np.zeros(len(matrix)), np.arange(len(matrix)), matrix)
+
+    start = time.perf_counter()
+    index = IVFBandIndex(engine)
+    index.rebuild()
+    print(f"IVF build: {time.perf_counter() - start:.2f}s, {len(index._centroids)} lists")
+
+    # クエリは既存ベクトルに少しノイズを足したもの（実際の投稿に近い分布）
+    picks = rng.choice(len(engine), N_QUERIES)
+    queries = engine.rows(picks) + rng.normal(size=(N_QUERIES, DIM)).astype(np.float32) * 0.005
+
+    exact = []
+    start = time.perf_counter()
+    for q in queries:
+        exact.append(set(engine.band(q, *BAND)[1].tolist()))
+    exact_ms = (time.perf_counter() - start) * 1000 / N_QUERIES
+    print(f"\nexact scan: {exact_ms:.2f} ms/query, avg {np.mean([len(e) for e in exact]):.1f} hits")
+
+    print(f"\n{'n_probe':>8} {'recall':>8} {'any-hit':>8} {'ms/query':>9} {'speedup':>8}")
+    for n_probe in PROBES:
+        recalls = []
+        any_hit = []
+        start = time.perf_counter()
+        results = [set(index.band(q, *BAND, n_probe=n_probe)[1].tolist()) for q in queries]
+        ms = (time.perf_counter() - start) * 1000 / N_QUERIES
+        for got, want in zip(results, exact):
+            if want:
+                recalls.append(len(got & want) / len(want))
+                # ボットは候補から1件を選ぶだけなので「1件以上見つかったか」も重要
+                any_hit.append(bool(got))
+        label = "all" if n_probe is None else str(n_probe)
+        print(f"{label:>8} {np.mean(recalls):>8.3f} {np.mean(any_hit):>8.3f} {ms:>9.2f} {exact_ms / ms:>7.1f}x")
+
+
+for space, matrix in load_spaces().items():
+    report(space, matrix)
@@ -0,0 +1,74 @@
+import sys
+import time
+
+import numpy as np
+
+from search import PRECISIONS, BandSearchEngine
+from vector_store import load_by_space
+
+# 検索行列を float16 / int8 で持ったときに、float32 と比べて
+# バンド判定 (類似度 0.5〜0.7 に入るか) がどれだけ変わるかのレポート
+# Usage: python check_quantization.py [ベクトルファイル] [クエリ数] [DBファイル]
+# ファイルがなければ合成データ（クラスタ付き768次元）で計測する
+
+VECTOR_FILE = sys.argv[1] if len(sys.argv) > 1 else "noise_vectors.f32"
+N_QUERIES = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+DB_PATH = sys.argv[3] if len(sys.argv) > 3 else "noise_db.sqlite3"
+DIM = 768
+BAND = (0.5, 0.7)
+
+rng = np.random.default_rng(0)
+
+
+def load_spaces():
+    spaces = load_by_space(VECTOR_FILE, DB_PATH, dim=DIM)
+    if spaces is None:
+        n = 100000
+        centers = rng.normal(size=(300, DIM))
+        print(f"{VECTOR_FILE} or {DB_PATH} not found. Using {n} synthetic vectors")
+        return {"synthetic": centers[rng.integers(0, len(centers), n)] + rng.normal(size=(n, DIM)) * 0.9}
+    for space, matrix in spaces.items():
+        print(f"Loaded {len(matrix)} vectors of {space} from {VECTOR_FILE}")
+    return spaces
+
+
+def report(space, matrix):
+    print(f"\n=== {space}: {len(matrix)} vectors ===")
+    engines = {}
+    for precision in PRECISIONS:
+        engine = BandSearchEngine(dim=DIM, precision=precision)
+        engine.add_batch(np.zeros(len(matrix)), np.arange(len(matrix)), matrix)
+        engines[precision] = engine
+
+    # クエリはコーパスの行そのもの（新しい投稿も過去の投稿と同じ分布とみなす）
+    queries = engines["float32"].rows(rng.choice(len(matrix), N_QUERIES))
+
+    reference = [engines["float32"].similarities(q) for q in queries]
+    decisions = [(s >= BAND[0]) & (s <= BAND[1]) for s in reference]
+    in_band = sum(int(d.sum()) for d in decisions)
+    print(f"{N_QUERIES} queries x {len(matrix)} rows, {in_band} in-band decisions with float32\n")
+
+    print(f"{'precision':>9} {'MB':>8} {'ms/query':>9} {'max err':>9} {'flips':>8} {'flip rate':>10} {'in->out':>8} {'out->in':>8} {'queries changed':>16}")
+    for precision, engine in engines.items():
+        start = time.perf_counter()
+        sims = [engine.similarities(q) for q in queries]
+        ms = (time.perf_counter() - start) * 1000 / N_QUERIES
+
+        max_err = max(float(np.abs(s - r).max()) for s, r in zip(sims, reference))
+        lost = gained = changed = 0
+        for s, want in zip(sims, decisions):
+            got = (s >= BAND[0]) & (s <= BAND[1])
+            lost += int((want & ~got).sum())
+            gained += int((got & ~want).sum())
+            changed += int(bool((got != want).any()))
+        flips = lost + gained
+        rate = flips / (N_QUERIES * len(matrix))
+        mb = engine.nbytes() / 1024 / 1024
+        print(f"{precision:>9} {mb:>8.1f} {ms:>9.2f} {max_err:>9.5f} {flips:>8} {rate:>10.2e} {lost:>8} {gained:>8} {changed:>8}/{N_QUERIES}")
+
+    # ボットは候補から1件を抽選するだけなので、境界付近の入れ替わりは結果にほぼ影響しない
+    print("\nflips: decisions that differ from float32 (in->out: lost candidates, out->in: new candidates)")
+
+
+for space, matrix in load_spaces().items():
+    report(space, matrix)
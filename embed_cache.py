@@ -0,0 +1,126 @@
+import hashlib
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+
+# ==========================================
+# 埋め込みキャッシュ
+# ==========================================
+# (model, task_type, 正規化テキストのハッシュ) をキーに埋め込みを再利用する。
+# 1段目: プロセス内の LRU (件数上限)
+# 2段目: SQLite ファイル (合計サイズ上限、古い順に削除)
+# 同じ文面は何度投稿されても API 呼び出しは最大1回で済む。
+
+def normalize_text(text):
+    """
+    全角/半角・前後空白・連続空白の違いを吸収する
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split())
+
+
+def cache_key(model, task_type, text):
+    raw = f"{model}\0{task_type}\0{normalize_text(text)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    メモリ LRU + ディスクの2段キャッシュ
+    値は float32 の np.ndarray
+    """
+
+    def __init__(self, path, memory_items=4096, disk_max_bytes=256 * 1024 * 1024):
+        self.memory_items = memory_items
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()
+
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._disk_bytes = self.conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()[0]
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, model, task_type, text):
+        key = cache_key(model, task_type, text)
+
+        vector = self._memory.get(key)
+        if vector is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return vector
+
+        row = self.conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            vector = np.frombuffer(row[0], dtype=np.float32)
+            self.conn.execute("UPDATE embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._remember(key, vector)
+            self.disk_hits += 1
+            return vector
+
+        self.misses += 1
+        return None
+
+    def put(self, model, task_type, text, vector):
+        key = cache_key(model, task_type, text)
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        self._remember(key, vector)
+
+        blob = vector.tobytes()
+        old = self.conn.execute("SELECT LENGTH(vector) FROM embeddings WHERE key = ?", (key,)).fetchone()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+            (key, blob, time.time()),
+        )
+        self._disk_bytes += len(blob) - (old[0] if old else 0)
+        if self._disk_bytes > self.disk_max_bytes:
+            self._evict_disk()
+        return vector
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        # 上限の 90% まで、最後に使われたのが古い順に削除する
+        target = self.disk_max_bytes * 0.9
+        while self._disk_bytes > target:
+            rows = self.conn.execute(
+                "SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 256"
+            ).fetchall()
+            if not rows:
+                self._disk_bytes = 0
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self._disk_bytes -= size
+                if self._disk_bytes <= target:
+                    break
+
+    def stats(self):
+        return {
+            "memory_items": len(self._memory),
+            "disk_bytes": self._disk_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        self.conn.close()
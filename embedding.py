@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import os
+import sys
+import zlib
+
+import numpy as np
+
+from embed_cache import normalize_text
+
+
+# ==========================================
+# 埋め込みバックエンド
+# ==========================================
+# 取り込みと思考接続はここのバックエンドを通してベクトルを得る。
+#   GeminiEmbedding  : Gemini API (text-embedding-004)。EmbeddingBatcher で複数の発言をまとめて送る
+#   HashingEmbedding : ネットワーク不要のローカル実装。文字 n-gram をハッシュしたバケットの TF-IDF を
+#                      疎なランダム射影で dim 次元に落とす（分かち書き不要なので日本語でもそのまま使える）
+# バックエンドごとにベクトル空間が違うので、保存するベクトルには name を付け、
+# 検索行列には今のバックエンドと同じ name のベクトルだけを載せる。
+#
+# ローカル実装の IDF は履歴から一度だけ作って固定する（作り直すと name が変わり、別の空間として扱われる）:
+#   python embedding.py fit-idf noise_db.sqlite3 local_embedding_idf.npy
+
+class GeminiEmbedding:
+    """
+    Gemini API の埋め込み（name はモデル名。タグ導入前のベクトルもこの名前で扱う）
+    """
+    cacheable = True # 埋め込みキャッシュを通す
+
+    def __init__(self, batcher, dim=768):
+        self.batcher = batcher
+        self.dim = dim
+        self.name = batcher.model
+
+    async def embed(self, text):
+        embedding = await self.batcher.embed(text)
+        return np.asarray(embedding, dtype=np.float32)
+
+    async def embed_batch(self, texts):
+        texts = list(texts)
+        vectors = []
+        for start in range(0, len(texts), self.batcher.max_batch):
+            chunk = texts[start:start + self.batcher.max_batch]
+            vectors.extend(await self.batcher.client.embed_batch(chunk, self.batcher.model, self.batcher.task_type))
+        return np.asarray(vectors, dtype=np.float32).reshape(len(texts), self.dim)
+
+
+class HashingEmbedding:
+    """
+    文字 n-gram の TF-IDF + 疎ランダム射影（CPU のみ・決定的）
+    同じ引数・同じ IDF なら、プロセスやマシンが違っても同じテキストは同じベクトルになる
+    """
+    cacheable = False # 計算の方がキャッシュ参照より速い
+
+    def __init__(self, dim=768, ngram_range=(1, 3), buckets=2**18, nnz=4, seed=0, idf_path=None):
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.buckets = buckets
+
+        # バケット → nnz 個の (列, ±1/√nnz)
+        rng = np.random.default_rng(seed)
+        self._columns = rng.integers(0, dim, size=(buckets, nnz), dtype=np.int64)
+        self._signs = rng.choice(np.array([-1.0, 1.0], dtype=np.float32), size=(buckets, nnz)) / np.sqrt(nnz)
+
+        if idf_path and os.path.exists(idf_path):
+            self.idf = np.load(idf_path).astype(np.float32)
+            if self.idf.shape != (buckets,):
+                raise ValueError(f"{idf_path} has {self.idf.shape[0]} buckets, expected {buckets}")
+            idf_tag = hashlib.sha256(self.idf.tobytes()).hexdigest()[:8]
+        else:
+            self.idf = np.ones(buckets, dtype=np.float32)
+            idf_tag = "tf"
+        self.name = f"local:ngram{ngram_range[0]}-{ngram_range[1]}:{buckets}x{nnz}:{dim}:{seed}:{idf_tag}"
+
+    def _buckets(self, text):
+        text = normalize_text(text).lower()
+        low, high = self.ngram_range
+        return [
+            zlib.crc32(text[i:i + n].encode("utf-8")) % self.buckets
+            for n in range(low, high + 1)
+            for i in range(len(text) - n + 1)
+        ]
+
+    def _counts(self, texts):
+        """
+        (文書番号, バケット, 出現回数) の配列
+        """
+        docs = []
+        buckets = []
+        for i, text in enumerate(texts):
+            found = self._buckets(text)
+            docs.extend([i] * len(found))
+            buckets.extend(found)
+        if not buckets:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+        pairs, counts = np.unique(
+            np.asarray(docs, dtype=np.int64) * self.buckets + np.asarray(buckets, dtype=np.int64),
+            return_counts=True,
+        )
+        return pairs // self.buckets, pairs % self.buckets, counts
+
+    def encode(self, texts):
+        """
+        texts を (len(texts), dim) の正規化済み float32 行列にする（同期版）
+        n-gram を1つも含まないテキストはゼロベクトル
+        """
+        texts = list(texts)
+        docs, buckets, counts = self._counts(texts)
+        weights = (1.0 + np.log(counts)).astype(np.float32) * self.idf[buckets]
+        flat = docs[:, None] * self.dim + self._columns[buckets]
+        vectors = np.bincount(
+            flat.ravel(), weights=(self._signs[buckets] * weights[:, None]).ravel(), minlength=len(texts) * self.dim
+        ).astype(np.float32).reshape(len(texts), self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def fit_idf(self, texts):
+        """
+        texts の文書頻度から平滑化した IDF を計算して返す（保存は np.save で行う）
+        """
+        texts = list(texts)
+        docs, buckets, _ = self._counts(texts)
+        df = np.bincount(buckets, minlength=self.buckets)
+        return (np.log((1 + len(texts)) / (1 + df)) + 1).astype(np.float32)
+
+    async def embed(self, text):
+        return self.encode([text])[0]
+
+    async def embed_batch(self, texts):
+        texts = list(texts)
+        if len(texts) <= 16:
+            return self.encode(texts)
+        # まとまった量はイベントループを止めないようスレッドで計算する
+        return await asyncio.to_thread(self.encode, texts)
+
+
+def main():
+    if len(sys.argv) != 4 or sys.argv[1] != "fit-idf":
+        print("Usage: python embedding.py fit-idf DB_PATH OUTPUT.npy")
+        sys.exit(1)
+    from storage import NoiseStore
+
+    store = NoiseStore(sys.argv[2])
+    texts = [content for _, _, content, _, _ in store.iter_history()]
+    store.close()
+    embedder = HashingEmbedding()
+    np.save(sys.argv[3], embedder.fit_idf(texts))
+    print(f"Fitted IDF on {len(texts)} texts -> {sys.argv[3]}")
+    print(f"Vectors produced with it will be tagged {HashingEmbedding(idf_path=sys.argv[3]).name}")
+
+
+if __name__ == "__main__":
+    main()
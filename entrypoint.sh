@@ -1,16 +1,16 @@
 #!/bin/bash
 set -e
 
-# Start Discord Bot in background
-echo "Starting Discord Bot..."
-python bot.py &
-
-# Start Web Interface (Streamlit or Dummy) in foreground
 # Cloud Run requires listening on $PORT
 if [ -f "app.py" ]; then
+    # Start Discord Bot in background
+    echo "Starting Discord Bot..."
+    python bot.py &
+
     echo "Starting Streamlit App..."
     streamlit run app.py --server.port $PORT --server.address 0.0.0.0
 else
-    echo "app.py not found. Starting dummy HTTP server on port $PORT..."
-    python -m http.server $PORT
+    # The bot serves /metrics (and / for health checks) on $PORT itself
+    echo "app.py not found. Starting Discord Bot with metrics on port $PORT..."
+    METRICS_PORT=$PORT exec python bot.py
 fi
@@ -0,0 +1,41 @@
+import asyncio
+
+
+# ==========================================
+# Discord 操作のファンアウト
+# ==========================================
+# ロール付与・DM送信などを対象ごとに順番に await すると、
+# 待ち時間が全対象の往復時間の合計になる（DM は詰まったり失敗したりしやすい）。
+# 同時実行数を制限しつつ並行に実行し、対象ごとの結果と失敗をまとめて返す。
+
+class FanOutResult:
+    """
+    対象ごとの結果 (succeeded: [(target, 戻り値)], failed: [(target, 例外)])
+    """
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []
+
+    def __bool__(self):
+        return bool(self.succeeded or self.failed)
+
+
+async def fan_out(targets, operation, limit=5):
+    """
+    operation(target) を targets 全体に対して最大 limit 件ずつ並行実行する
+    """
+    semaphore = asyncio.Semaphore(limit)
+    result = FanOutResult()
+
+    async def run(target):
+        async with semaphore:
+            try:
+                value = await operation(target)
+            except Exception as e:
+                result.failed.append((target, e))
+            else:
+                result.succeeded.append((target, value))
+
+    await asyncio.gather(*(run(target) for target in targets))
+    return result
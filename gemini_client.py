@@ -0,0 +1,203 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import google.generativeai as genai
+
+from metrics import GEMINI_ERRORS, GEMINI_REQUESTS
+from resilience import TRANSIENT_ERRORS, CircuitBreaker, CircuitOpenError, TokenBucket, call_with_retry
+
+
+# ==========================================
+# 非同期 Gemini クライアント
+# ==========================================
+# genai.embed_content / GenerativeModel.generate_content は同期の通信処理なので、
+# 専用スレッドプールで実行してイベントループ (ハートビート・他のコマンド) を止めない。
+# 同時実行数はセマフォで制限し、呼び出しごとにタイムアウトを掛ける。
+# 埋め込みは EmbeddingBatcher で複数チャンネルの発言をまとめて1リクエストにする。
+# 埋め込みと生成はそれぞれ別のレート制限・サーキットブレーカーを持つ。
+
+class GeminiClient:
+    """
+    Gemini API 呼び出しの窓口
+    """
+
+    def __init__(
+        self,
+        max_concurrency=8,
+        embed_timeout=10.0,
+        generate_timeout=30.0,
+        embed_rate=5.0,
+        generate_rate=1.0,
+        max_retries=3,
+        breaker_error_rate=0.5,
+        breaker_cooldown=30.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.embed_timeout = embed_timeout
+        self.generate_timeout = generate_timeout
+        self.max_retries = max_retries
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="gemini")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._models = {}
+
+        # 種類ごとの流量制御とブレーカー
+        self.limiters = {
+            "embed": TokenBucket(embed_rate),
+            "generate": TokenBucket(generate_rate),
+        }
+        self.breakers = {
+            "embed": CircuitBreaker(error_rate=breaker_error_rate, cooldown=breaker_cooldown),
+            "generate": CircuitBreaker(error_rate=breaker_error_rate, cooldown=breaker_cooldown),
+        }
+
+    async def _run(self, kind, model, timeout, func, *args, **kwargs):
+        async def attempt():
+            GEMINI_REQUESTS.inc(model=model, kind=kind)
+            try:
+                async with self._semaphore:
+                    loop = asyncio.get_running_loop()
+                    future = loop.run_in_executor(self._executor, lambda: func(*args, **kwargs))
+                    return await asyncio.wait_for(future, timeout=timeout)
+            except Exception as e:
+                GEMINI_ERRORS.inc(model=model, kind=kind, error=type(e).__name__)
+                raise
+
+        try:
+            return await call_with_retry(
+                attempt,
+                max_retries=self.max_retries,
+                breaker=self.breakers[kind],
+                limiter=self.limiters[kind],
+            )
+        except CircuitOpenError:
+            GEMINI_ERRORS.inc(model=model, kind=kind, error="CircuitOpenError")
+            raise
+
+    async def embed(self, text, model, task_type):
+        """
+        テキスト1件の埋め込み (float のリスト)
+        """
+        result = await self._run(
+            "embed",
+            model,
+            self.embed_timeout,
+            genai.embed_content,
+            model=model,
+            content=text,
+            task_type=task_type,
+        )
+        return result['embedding']
+
+    async def embed_batch(self, texts, model, task_type):
+        """
+        複数テキストを1リクエストで埋め込む (入力と同じ順のリスト)
+        """
+        result = await self._run(
+            "embed",
+            model,
+            self.embed_timeout,
+            genai.embed_content,
+            model=model,
+            content=list(texts),
+            task_type=task_type,
+        )
+        return result['embedding']
+
+    async def generate(self, prompt, model):
+        """
+        プロンプトからテキストを生成する
+        """
+        if model not in self._models:
+            self._models[model] = genai.GenerativeModel(model)
+        response = await self._run("generate", model, self.generate_timeout, self._models[model].generate_content, prompt)
+        return response.text
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class EmbeddingBatcher:
+    """
+    短い時間窓 (window 秒) か max_batch 件まで埋め込み要求を溜め、
+    1回の batch embed で処理して各呼び出し元の Future に結果を返す
+    """
+
+    def __init__(self, client, model, task_type, window=0.05, max_batch=100):
+        self.client = client
+        self.model = model
+        self.task_type = task_type
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = [] # (text, future)
+        self._timer = None
+        self._tasks = set()
+        self.batches = 0
+        self.texts = 0
+
+    async def embed(self, text):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = self._pending[:self.max_batch]
+        self._pending = self._pending[self.max_batch:]
+        if self._pending:
+            # 溢れた分は次の窓で送る
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._start_flush)
+        if batch:
+            task = asyncio.create_task(self._flush(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, batch):
+        # 同じ文面は1回だけ送る
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            embeddings = await self.client.embed_batch(texts, self.model, self.task_type)
+        except (CircuitOpenError, *TRANSIENT_ERRORS) as e:
+            self._fail(batch, e)
+            return
+        except Exception as e:
+            # 不正な入力が1件混ざっただけでバッチ全体を失敗させないよう、1件ずつ送り直す
+            # （1件だけなら同じリクエストになるので、送り直さずに失敗させる）
+            if len(texts) == 1:
+                self._fail(batch, e)
+                return
+            print(f"Gemini batch embed failed ({type(e).__name__}), retrying {len(texts)} texts one by one")
+            await self._flush_each(batch, texts)
+            return
+
+        self.batches += 1
+        self.texts += len(texts)
+        by_text = dict(zip(texts, embeddings))
+        for text, future in batch:
+            if not future.done():
+                future.set_result(by_text[text])
+
+    def _fail(self, batch, e):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+
+    async def _flush_each(self, batch, texts):
+        results = await asyncio.gather(
+            *(self.client.embed(text, self.model, self.task_type) for text in texts), return_exceptions=True
+        )
+        by_text = dict(zip(texts, results))
+        for text, future in batch:
+            if future.done():
+                continue
+            if isinstance(by_text[text], BaseException):
+                future.set_exception(by_text[text])
+            else:
+                future.set_result(by_text[text])
@@ -0,0 +1,137 @@
+import hashlib
+import random
+import sqlite3
+import time
+from collections import OrderedDict
+
+from embed_cache import normalize_text
+
+
+# ==========================================
+# 生成キャッシュ
+# ==========================================
+# (model, プロンプトのバージョン, 現在の発言, 過去の発言) のハッシュをキーに
+# Gemini の「接続コメント」を再利用する。キーワード強制マッチなどで
+# 同じ組み合わせが何度も選ばれても、生成 API は最初の数回しか呼ばない。
+# 1キーにつき最大 variants 件のコメントを溜め、揃ったら毎回ランダムに1件返す。
+# 1段目: プロセス内の LRU / 2段目: SQLite ファイル (件数上限・TTL)
+
+def generation_key(model, version, content, partner_content):
+    raw = f"{model}\0{version}\0{normalize_text(content)}\0{normalize_text(partner_content)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    """
+    メモリ LRU + ディスクの2段キャッシュ
+    ttl 秒より古いコメントは使わず、ディスク側は max_entries 件を超えたら最後に使われたのが古い順に消す
+    """
+
+    def __init__(self, path, ttl=7 * 86400, max_entries=20000, memory_items=1024, variants=1):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_items = memory_items
+        self.variants = max(1, variants)
+        self._memory = OrderedDict() # key → [(text, created_at)]
+
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            " key TEXT NOT NULL, text TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL,"
+            " PRIMARY KEY (key, text))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_generations_last_used ON generations(last_used)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_generations_created_at ON generations(created_at)")
+        self.conn.execute("DELETE FROM generations WHERE created_at < ?", (time.time() - self.ttl,))
+        self._disk_entries = self.conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, model, version, content, partner_content):
+        """
+        キャッシュ済みのコメントを返す
+        まだ variants 件揃っていなければ None（呼び出し元で生成して put する）
+        """
+        key = generation_key(model, version, content, partner_content)
+        now = time.time()
+
+        from_disk = key not in self._memory
+        entries = self._entries(key)
+
+        fresh = [entry for entry in entries if now - entry[1] < self.ttl]
+        if len(fresh) < len(entries):
+            self.conn.execute("DELETE FROM generations WHERE key = ? AND created_at < ?", (key, now - self.ttl))
+            self._disk_entries -= len(entries) - len(fresh)
+        if fresh or not from_disk:
+            self._remember(key, fresh)
+
+        if len(fresh) < self.variants:
+            self.misses += 1
+            return None
+
+        text = random.choice(fresh)[0]
+        self.conn.execute("UPDATE generations SET last_used = ? WHERE key = ?", (now, key))
+        if from_disk:
+            self.disk_hits += 1
+        else:
+            self.hits += 1
+        return text
+
+    def put(self, model, version, content, partner_content, text):
+        key = generation_key(model, version, content, partner_content)
+        now = time.time()
+
+        existing = self._entries(key)
+        entries = [entry for entry in existing if entry[0] != text]
+        exists = len(entries) < len(existing)
+        entries.append((text, now))
+        self._remember(key, entries)
+
+        self.conn.execute(
+            "INSERT OR REPLACE INTO generations (key, text, created_at, last_used) VALUES (?, ?, ?, ?)",
+            (key, text, now, now),
+        )
+        if not exists:
+            self._disk_entries += 1
+        if self._disk_entries > self.max_entries:
+            self._evict_disk()
+
+    def _entries(self, key):
+        entries = self._memory.get(key)
+        if entries is None:
+            rows = self.conn.execute("SELECT text, created_at FROM generations WHERE key = ?", (key,)).fetchall()
+            entries = [(text, created_at) for text, created_at in rows]
+        return entries
+
+    def _remember(self, key, entries):
+        self._memory[key] = entries
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        # 上限の 90% まで、最後に使われたのが古い順に削除する
+        excess = self._disk_entries - int(self.max_entries * 0.9)
+        rows = self.conn.execute(
+            "SELECT key, text FROM generations ORDER BY last_used LIMIT ?", (excess,)
+        ).fetchall()
+        self.conn.executemany("DELETE FROM generations WHERE key = ? AND text = ?", rows)
+        for key, _ in rows:
+            self._memory.pop(key, None)
+        self._disk_entries -= len(rows)
+
+    def stats(self):
+        return {
+            "memory_items": len(self._memory),
+            "disk_entries": self._disk_entries,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        self.conn.close()
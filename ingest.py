@@ -0,0 +1,165 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+
+# ==========================================
+# 取り込みキュー
+# ==========================================
+# on_message はポイント加算だけ済ませてメッセージをキューに積み、
+# 埋め込み・インデックス登録・思考接続の生成はワーカータスクが行う。
+# キューは有限で、溢れたときは AI 処理だけを捨てる（ポイントは捨てない）。
+
+OVERFLOW_POLICIES = ("drop_newest", "drop_oldest")
+
+
+class IngestQueue:
+    """
+    有限キュー + ワーカープール
+    handler(item) は各アイテムの処理、on_drop(item) は溢れたアイテムの後始末
+    """
+
+    def __init__(self, handler, on_drop=None, workers=4, maxsize=1000, overflow="drop_oldest"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.handler = handler
+        self.on_drop = on_drop
+        self.workers = workers
+        self.overflow = overflow
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._tasks = []
+        self._resume = asyncio.Event() # paused() の間だけクリアされる
+        self._resume.set()
+        self._idle = asyncio.Event() # 処理中のアイテムがないとき set
+        self._idle.set()
+        self._active = 0
+
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_lag = 0.0 # 直近に処理したアイテムの待ち時間（秒）
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    @property
+    def maxsize(self):
+        return self._queue.maxsize
+
+    def oldest_lag(self):
+        """
+        キューの先頭（最も古い）アイテムの待ち時間（秒）
+        """
+        if self._queue.empty():
+            return 0.0
+        enqueued_at, _ = self._queue._queue[0]
+        return time.monotonic() - enqueued_at
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @asynccontextmanager
+    async def paused(self):
+        """
+        処理中のアイテムが終わるのを待ってからワーカーを止める（キューへの積み込みは続く）
+        """
+        self._resume.clear()
+        try:
+            await self._idle.wait()
+            yield
+        finally:
+            self._resume.set()
+
+    def submit(self, item):
+        """
+        アイテムを積む。溢れた場合はポリシーに従って1件捨て、積めたかどうかを返す
+        """
+        entry = (time.monotonic(), item)
+        if not self._queue.full():
+            self._queue.put_nowait(entry)
+            return True
+
+        if self.overflow == "drop_oldest":
+            _, dropped = self._queue.get_nowait()
+            self._queue.task_done()
+            self._queue.put_nowait(entry)
+            self._drop(dropped)
+            return True
+
+        self._drop(item)
+        return False
+
+    def _drop(self, item):
+        self.dropped += 1
+        if self.on_drop:
+            try:
+                self.on_drop(item)
+            except Exception as e:
+                print(f"Ingest Drop Error: {e}")
+
+    async def _worker(self, index):
+        while True:
+            enqueued_at, item = await self._queue.get()
+            await self._resume.wait()
+            self._active += 1
+            self._idle.clear()
+            self.last_lag = time.monotonic() - enqueued_at
+            try:
+                await self.handler(item)
+                self.processed += 1
+            except asyncio.CancelledError:
+                # 終了処理で止められた処理中のアイテムも on_drop に回す
+                self._drop(item)
+                raise
+            except Exception as e:
+                self.failed += 1
+                print(f"Ingest Worker {index} Error: {e}")
+            finally:
+                self._active -= 1
+                if self._active == 0:
+                    self._idle.set()
+                self._queue.task_done()
+
+    async def join(self):
+        await self._queue.join()
+
+    async def drain(self, timeout=None):
+        """
+        積まれているアイテムを処理しきってからワーカーを止める（終了処理用）
+        timeout 秒で終わらなければ、残りは on_drop に回す
+        """
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Ingest drain timed out with {self.depth} items left")
+        await self.stop()
+        self.discard_pending()
+
+    def discard_pending(self):
+        """
+        未処理のアイテムをすべて on_drop に回す（イベントループが止まった後でも呼べる）
+        """
+        while not self._queue.empty():
+            _, item = self._queue.get_nowait()
+            self._queue.task_done()
+            self._drop(item)
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "maxsize": self.maxsize,
+            "oldest_lag": self.oldest_lag(),
+            "last_lag": self.last_lag,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
@@ -0,0 +1,125 @@
+import os
+from collections import deque
+
+
+# ==========================================
+# キーワードマッチング (Aho-Corasick)
+# ==========================================
+# キーワード数に関係なく、メッセージを1回走査するだけで
+# 含まれるキーワードをすべて見つける。
+# キーワードは外部ファイルから読み込み、再起動なしで差し替えられる。
+
+class AhoCorasick:
+    """
+    キーワード集合から構築したオートマトン
+    """
+
+    def __init__(self, keywords):
+        self.keywords = list(dict.fromkeys(k for k in keywords if k))
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+
+        for index, keyword in enumerate(self.keywords):
+            node = 0
+            for char in keyword:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                node = next_node
+            self._output[node].append(index)
+
+        # 失敗リンクを幅優先で張る
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(char, 0)
+                # ルート直下のノードは自分自身ではなくルートへ戻る
+                self._fail[child] = target if target != child else 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def iter_matches(self, text):
+        """
+        (終了位置, キーワード番号) を出現順に返す
+        """
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for index in self._output[node]:
+                yield position, index
+
+    def find(self, text):
+        """
+        text に含まれるキーワード（重複なし、キーワード一覧の順）
+        """
+        found = {index for _, index in self.iter_matches(text)}
+        return [self.keywords[index] for index in sorted(found)]
+
+
+def load_keywords(path):
+    """
+    1行1キーワードのファイルを読む（# 始まりの行と空行は無視）
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        lines = (line.strip() for line in f)
+        return [line for line in lines if line and not line.startswith("#")]
+
+
+class KeywordMatcher:
+    """
+    キーワードファイルに紐づいた Aho-Corasick マッチャー
+    ファイルがなければ default_keywords を使う
+    """
+
+    def __init__(self, path, default_keywords=()):
+        self.path = path
+        self.default_keywords = list(default_keywords)
+        self._mtime = None
+        self.automaton = AhoCorasick(self.default_keywords)
+        self.reload()
+
+    @property
+    def keywords(self):
+        return self.automaton.keywords
+
+    def find(self, text):
+        return self.automaton.find(text)
+
+    def reload(self):
+        """
+        ファイルを読み直してオートマトンを作り直す。キーワード数を返す
+        読み込みに失敗した場合は現在のキーワードを維持する
+        """
+        if not os.path.exists(self.path):
+            return len(self.keywords)
+        try:
+            mtime = os.path.getmtime(self.path)
+            keywords = load_keywords(self.path)
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"Keyword Reload Error: {e}")
+            return len(self.keywords)
+
+        # 構築が終わってから差し替えるので、マッチ中に中途半端な状態は見えない
+        self.automaton = AhoCorasick(keywords)
+        self._mtime = mtime
+        print(f"Loaded {len(self.keywords)} keywords from {self.path}")
+        return len(self.keywords)
+
+    def reload_if_changed(self):
+        if not os.path.exists(self.path):
+            return False
+        if os.path.getmtime(self.path) == self._mtime:
+            return False
+        self.reload()
+        return True
@@ -0,0 +1,283 @@
+import asyncio
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from aiohttp import web
+
+
+# ==========================================
+# メトリクス (Prometheus テキスト形式)
+# ==========================================
+# プロセス内でカウンター / ゲージ / ヒストグラムを集計し、
+# Cloud Run 用のポートで /metrics として公開する（追加の依存は discord.py 同梱の aiohttp のみ）。
+# 各モジュールはここで定義したメトリクスを直接更新する。
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock() # Gemini のワーカースレッドからも更新される
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return lines
+
+    def samples(self):
+        return []
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, description, labelnames=()):
+        super().__init__(name, description, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(v)}" for key, v in sorted(values.items())]
+
+
+class Gauge(Metric):
+    """
+    set() で値を入れるか、function で読み出し時に値を計算する
+    function はラベルなしなら数値、ラベル付きなら {ラベル値のタプル: 数値} を返す
+    """
+    kind = "gauge"
+
+    def __init__(self, name, description, labelnames=(), function=None):
+        super().__init__(name, description, labelnames)
+        self.function = function
+        self._values = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.function is None:
+            with self._lock:
+                values = dict(self._values)
+        else:
+            try:
+                values = self.function()
+            except Exception as e:
+                print(f"Metrics Error ({self.name}): {e}")
+                return []
+            if not isinstance(values, dict):
+                values = {(): values}
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(v)}" for key, v in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {} # key → [各バケットの件数, 合計, 件数]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        with ブロックの所要時間（秒）を記録する（例外で抜けた場合も記録する）
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(entry[0]), entry[1], entry[2]) for key, entry in self._values.items()}
+        lines = []
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = _labels(self.labelnames, key, [("le", _number(bound))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric: {metric.name}")
+        self._metrics[metric.name] = metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# ------------------------------------------
+# 共通のメトリクス
+# ------------------------------------------
+STAGE_SECONDS = Histogram(
+    "noise_stage_seconds",
+    "Latency of message-processing stages (db_load, db_save, embed, search, generate, discord_send)",
+    ["stage"],
+)
+GEMINI_REQUESTS = Counter("noise_gemini_requests_total", "Gemini API attempts", ["model", "kind"])
+GEMINI_ERRORS = Counter("noise_gemini_errors_total", "Failed Gemini API attempts", ["model", "kind", "error"])
+MESSAGES = Counter("noise_messages_total", "Non-bot messages received")
+CONNECTION_TRIGGERS = Counter(
+    "noise_connection_triggers_total",
+    "Thought connections triggered, by forced keyword (\"\" for the base probability)",
+    ["keyword"],
+)
+EVENT_LOOP_LAG = Histogram(
+    "noise_event_loop_lag_seconds",
+    "How late the event loop woke up a periodic probe",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+EVENT_LOOP_LAG_LAST = Gauge("noise_event_loop_lag_last_seconds", "Most recent event loop lag probe")
+
+
+async def monitor_event_loop(interval=0.5):
+    """
+    interval 秒ごとに起き、予定より遅れた分をイベントループの遅延として記録する
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        EVENT_LOOP_LAG.observe(lag)
+        EVENT_LOOP_LAG_LAST.set(lag)
+
+
+class MetricsServer:
+    """
+    GET /metrics (Prometheus) と GET / (ヘルスチェック) を返す HTTP サーバー
+    """
+
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+        self._runner = None
+
+    async def _metrics(self, request):
+        return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def _health(self, request):
+        return web.Response(text="ok")
+
+    async def start(self, port, host="0.0.0.0"):
+        app = web.Application()
+        app.router.add_get("/metrics", self._metrics)
+        app.router.add_get("/", self._health)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        print(f"Metrics server listening on :{port}")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class _StartupHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # 起動中はヘルスチェックにだけ応答し、メトリクスはまだ出さない
+        status, body = (200, b"starting") if self.path == "/" else (503, b"starting up")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StartupHealthServer:
+    """
+    起動処理（DB・検索行列の読み込み）の間だけ GET / に応答する最小の HTTP サーバー（別スレッド）
+    イベントループが動き出したら stop() し、同じポートを MetricsServer に引き継ぐ
+    """
+
+    def __init__(self):
+        self._server = None
+        self._thread = None
+
+    def start(self, port, host="0.0.0.0"):
+        self._server = HTTPServer((host, port), _StartupHandler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={"poll_interval": 0.1}, name="startup-health", daemon=True
+        )
+        self._thread.start()
+        print(f"Startup health check listening on :{port}")
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
@@ -0,0 +1,75 @@
+import random
+
+import numpy as np
+
+
+# ==========================================
+# 履歴レジストリ (ランダム抽選用)
+# ==========================================
+# 思考接続で候補が見つからなかったときの「ランダムな過去ログ」を、
+# 全履歴を走査せずに選ぶための (owner_id, history_id) の平坦な配列。
+# 追加は末尾へ、削除（コールド層への移動）はまとめて詰め直す。
+
+class HistoryRegistry:
+    """
+    全履歴の (owner_id, history_id) を並べた配列
+    sample() は一様に1件を選ぶ（O(1)、コーパスに比例した確保はしない）
+    """
+
+    def __init__(self, initial_capacity=1024):
+        self._count = 0
+        self._owner_ids = np.zeros(initial_capacity, dtype=np.int64)
+        self._history_ids = np.zeros(initial_capacity, dtype=np.int64)
+
+    def __len__(self):
+        return self._count
+
+    def _reserve(self, extra):
+        needed = self._count + extra
+        capacity = len(self._history_ids)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in ("_owner_ids", "_history_ids"):
+            grown = np.zeros(capacity, dtype=np.int64)
+            grown[:self._count] = getattr(self, name)[:self._count]
+            setattr(self, name, grown)
+
+    def add_batch(self, owner_ids, history_ids):
+        n = len(history_ids)
+        if n == 0:
+            return
+        self._reserve(n)
+        end = self._count + n
+        self._owner_ids[self._count:end] = np.asarray(owner_ids, dtype=np.int64)
+        self._history_ids[self._count:end] = np.asarray(history_ids, dtype=np.int64)
+        self._count = end
+
+    def add(self, owner_id, history_id):
+        self._reserve(1)
+        self._owner_ids[self._count] = int(owner_id)
+        self._history_ids[self._count] = history_id
+        self._count += 1
+
+    def remove(self, history_ids):
+        """
+        指定した履歴を取り除き、取り除いた件数を返す
+        """
+        keep = ~np.isin(self._history_ids[:self._count], np.asarray(list(history_ids), dtype=np.int64))
+        n = int(keep.sum())
+        removed = self._count - n
+        if removed:
+            self._owner_ids[:n] = self._owner_ids[:self._count][keep]
+            self._history_ids[:n] = self._history_ids[:self._count][keep]
+            self._count = n
+        return removed
+
+    def sample(self):
+        """
+        一様に1件選んで (owner_id, history_id) を返す（空なら None）
+        """
+        if self._count == 0:
+            return None
+        i = random.randrange(self._count)
+        return str(self._owner_ids[i]), int(self._history_ids[i])
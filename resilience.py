@@ -0,0 +1,155 @@
+import asyncio
+import random
+import time
+from collections import deque
+
+from google.api_core import exceptions as google_exceptions
+
+
+# ==========================================
+# レート制限 / リトライ / サーキットブレーカー
+# ==========================================
+# Gemini へのリクエストを流量制御し、一時的なエラーだけを
+# ジッター付き指数バックオフで再試行する。
+# エラー率が跳ね上がったらブレーカーを開き、しばらくは呼び出し元に
+# 即座に失敗を返して（＝縮退させて）無駄な待ち時間を作らない。
+
+# 再試行してよい（一時的な）エラー
+TRANSIENT_ERRORS = (
+    asyncio.TimeoutError,
+    ConnectionError,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+
+
+class CircuitOpenError(Exception):
+    """
+    ブレーカーが開いているため呼び出しを行わなかった
+    """
+
+
+class TokenBucket:
+    """
+    トークンバケット（rate 個/秒で補充、最大 capacity 個）
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class CircuitBreaker:
+    """
+    直近 window 秒のエラー率が error_rate を超えたら cooldown 秒だけ開く
+    cooldown 後は1件だけ試し (half-open)、成功すれば閉じる
+    """
+
+    def __init__(self, window=60.0, min_calls=10, error_rate=0.5, cooldown=30.0):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self._results = deque() # (時刻, 成功したか)
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def before_call(self):
+        state = self.state
+        if state == "open" or (state == "half_open" and self._probing):
+            raise CircuitOpenError("Gemini circuit is open")
+        if state == "half_open":
+            self._probing = True
+
+    def record(self, ok):
+        now = time.monotonic()
+        if self._opened_at is not None:
+            # half-open の試行結果で閉じるか開き直すかを決める
+            self._probing = False
+            if ok:
+                self._opened_at = None
+                self._results.clear()
+            else:
+                self._opened_at = now
+            return
+
+        self._results.append((now, ok))
+        while self._results and now - self._results[0][0] > self.window:
+            self._results.popleft()
+
+        failures = sum(1 for _, result in self._results if not result)
+        if len(self._results) >= self.min_calls and failures / len(self._results) >= self.error_rate:
+            self._opened_at = now
+            print(f"Gemini circuit opened ({failures}/{len(self._results)} errors)")
+
+    def abandon(self):
+        """
+        結果が分からないまま終わった呼び出し（キャンセル）。エラー率には数えず、half-open の試行枠だけ返す
+        """
+        self._probing = False
+
+
+async def call_with_retry(func, max_retries=3, base_delay=0.5, max_delay=8.0, breaker=None, limiter=None):
+    """
+    func (コルーチン関数) を呼び、一時的なエラーならバックオフして再試行する
+    """
+    attempt = 0
+    while True:
+        if limiter:
+            await limiter.acquire()
+        if breaker:
+            breaker.before_call()
+        try:
+            result = await func()
+        except TRANSIENT_ERRORS as e:
+            if breaker:
+                breaker.record(False)
+            if attempt >= max_retries:
+                raise
+            # full jitter: 0 ~ min(max_delay, base * 2^attempt)
+            delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+            print(f"Gemini transient error ({type(e).__name__}), retrying in {delay:.1f}s")
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        except Exception:
+            # 不正な入力などのエラーは Gemini までは届いている（通信としては成功）ので、ブレーカーは開かない
+            if breaker:
+                breaker.record(True)
+            raise
+        except BaseException:
+            # キャンセル。試行枠を返さないと half-open のまま固まる
+            if breaker:
+                breaker.abandon()
+            raise
+        if breaker:
+            breaker.record(True)
+        return result
@@ -0,0 +1,308 @@
+import asyncio
+import glob
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+
+
+# ==========================================
+# 履歴の保持期間 (ホット層 / コールド層)
+# ==========================================
+# 直近の履歴（ホット窓）だけを DB・検索行列・転置インデックスに置き、
+# 窓から外れた履歴は圧縮済みのセグメントファイルへ追い出す。
+# セグメントは追記専用（一度書いたら変更しない）で、
+# ホット層に候補がないときだけ読み込んでバンド検索する。
+
+class ColdArchive:
+    """
+    圧縮済みセグメント (segment-NNNNNN.npz + segment-NNNNNN.text) の集まり
+    npz は ids と、正規化済みベクトル vectors + 各行のベクトル位置 vector_rows (-1 はベクトルなし) +
+    各ベクトルの空間 vector_spaces、本文ファイル内の各行の位置 text_offsets を持つ
+    本文ファイルは行ごとに zlib 圧縮した JSON [user_id, content, timestamp] を並べたもので、
+    検索でヒットした行だけを読む（セグメント全体の本文は展開しない）
+    1セグメントは max_rows 行まで（展開したベクトルをキャッシュに載せるため）
+    vector_spaces のない古いセグメントのベクトルは legacy_space のものとして扱う
+    """
+
+    def __init__(self, directory, dim=768, cache_segments=4, legacy_space=None, max_rows=20000):
+        self.directory = directory
+        self.dim = dim
+        self.cache_segments = cache_segments
+        self.legacy_space = legacy_space
+        self.max_rows = max_rows
+        os.makedirs(directory, exist_ok=True)
+
+        # 書き込み途中で落ちたセグメントは捨てる
+        for partial in glob.glob(os.path.join(directory, "*.tmp")):
+            os.remove(partial)
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict() # path → 展開済みセグメント（ベクトルと索引だけ）
+        self._ids = {} # path → 履歴ID (重複アーカイブの判定用)
+        self._segments = sorted(glob.glob(os.path.join(directory, "segment-*.npz")))
+        for path in self._segments:
+            with np.load(path) as segment:
+                self._ids[path] = segment["ids"]
+
+        # npz を書く前に落ちたときの本文ファイルも捨てる
+        for text_path in glob.glob(os.path.join(directory, "segment-*.text")):
+            if _segment_path(text_path) not in self._ids:
+                os.remove(text_path)
+
+    def __len__(self):
+        return sum(len(ids) for ids in self._ids.values())
+
+    @property
+    def segments(self):
+        return list(self._segments)
+
+    def size_bytes(self):
+        return sum(
+            os.path.getsize(path) + (os.path.getsize(_text_path(path)) if os.path.exists(_text_path(path)) else 0)
+            for path in self._segments
+        )
+
+    def archived(self, history_ids):
+        """
+        history_ids のうち既にセグメントに入っているもの
+        """
+        history_ids = np.asarray(list(history_ids), dtype=np.int64)
+        found = set()
+        for ids in list(self._ids.values()):
+            found.update(history_ids[np.isin(history_ids, ids)].tolist())
+        return found
+
+    def write_segment(self, rows, vectors):
+        """
+        rows: [(id, user_id, content, timestamp, vector_id, vector_space)]
+        vectors: rows のうちベクトルを持つ行のベクトル（rows と同じ順）
+        max_rows 行ずつ新しいセグメントに書き出し、ファイルサイズの合計を返す（スレッドから呼んでよい）
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        written = 0
+        used = 0
+        for start in range(0, len(rows), self.max_rows):
+            chunk = rows[start:start + self.max_rows]
+            count = sum(1 for row in chunk if row[4] is not None)
+            written += self._write_one(chunk, vectors[used:used + count])
+            used += count
+        return written
+
+    def _write_one(self, rows, vectors):
+        norms = np.linalg.norm(vectors, axis=1)
+        norms[norms == 0] = 1.0
+
+        vector_rows = np.full(len(rows), -1, dtype=np.int64)
+        has_vector = [i for i, row in enumerate(rows) if row[4] is not None]
+        vector_rows[has_vector] = np.arange(len(has_vector))
+
+        with self._lock:
+            number = len(self._segments) + 1
+            if self._segments:
+                number = int(os.path.basename(self._segments[-1])[8:14]) + 1
+            path = os.path.join(self.directory, f"segment-{number:06d}.npz")
+
+            # 本文ファイルを先に書く（npz がなければ本文ファイルは起動時に捨てられる）
+            text_offsets = [0]
+            with open(_text_path(path) + ".tmp", "wb") as f:
+                for row in rows:
+                    record = zlib.compress(json.dumps([str(row[1]), row[2], row[3]], ensure_ascii=False).encode("utf-8"))
+                    f.write(record)
+                    text_offsets.append(text_offsets[-1] + len(record))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(_text_path(path) + ".tmp", _text_path(path))
+
+            partial = path + ".tmp"
+            with open(partial, "wb") as f:
+                np.savez_compressed(
+                    f,
+                    ids=np.asarray([row[0] for row in rows], dtype=np.int64),
+                    text_offsets=np.asarray(text_offsets, dtype=np.int64),
+                    vectors=vectors / norms[:, None],
+                    vector_rows=vector_rows,
+                    vector_spaces=np.asarray([str(rows[i][5]) for i in has_vector], dtype=str),
+                )
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(partial, path)
+            self._segments.append(path)
+            self._ids[path] = np.asarray([row[0] for row in rows], dtype=np.int64)
+        return os.path.getsize(path) + os.path.getsize(_text_path(path))
+
+    def _load(self, path):
+        with self._lock:
+            segment = self._cache.get(path)
+            if segment is not None:
+                self._cache.move_to_end(path)
+                return segment
+        with np.load(path) as data:
+            # 本文は読まない（古い形式のセグメントの contents / user_ids も _texts で必要な行だけ引く）
+            segment = {name: data[name] for name in data.files if name not in LEGACY_TEXT_FIELDS}
+        with self._lock:
+            self._cache[path] = segment
+            while len(self._cache) > self.cache_segments:
+                self._cache.popitem(last=False)
+        return segment
+
+    def _texts(self, path, segment, rows):
+        """
+        セグメントの rows 行目の (user_id, content) のリスト
+        """
+        if "text_offsets" not in segment:
+            # 本文ファイル導入前のセグメント: 固定長の文字列配列から読む
+            with np.load(path) as data:
+                user_ids, contents = data["user_ids"], data["contents"]
+            return [(str(user_ids[row]), str(contents[row])) for row in rows]
+
+        offsets = segment["text_offsets"]
+        texts = []
+        with open(_text_path(path), "rb") as f:
+            for row in rows:
+                f.seek(offsets[row])
+                user_id, content, _ = json.loads(zlib.decompress(f.read(offsets[row + 1] - offsets[row])).decode("utf-8"))
+                texts.append((user_id, content))
+        return texts
+
+    def band(self, query, low=0.5, high=0.7, space=None):
+        """
+        全セグメントから類似度が [low, high] に入る履歴を [(user_id, content, similarity)] で返す
+        space を指定すると、その埋め込み空間のベクトルだけを比べる
+        （セグメントを展開するので重い。スレッドから呼ぶこと）
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(query)
+        if query.size != self.dim or norm == 0:
+            return []
+        query = query / norm
+
+        results = []
+        for path in self.segments:
+            segment = self._load(path)
+            if len(segment["vectors"]) == 0:
+                continue
+            sims = segment["vectors"] @ query
+            in_band = (sims >= low) & (sims <= high)
+            if space is not None:
+                if "vector_spaces" in segment:
+                    in_band &= segment["vector_spaces"] == space
+                elif space != self.legacy_space:
+                    continue
+            matched = np.flatnonzero(in_band)
+            if len(matched) == 0:
+                continue
+            rows = np.flatnonzero(np.isin(segment["vector_rows"], matched))
+            for row, (user_id, content) in zip(rows, self._texts(path, segment, rows)):
+                results.append((user_id, content, float(sims[segment["vector_rows"][row]])))
+        return results
+
+
+# 本文ファイル導入前のセグメントが npz に持っていた本文の配列
+LEGACY_TEXT_FIELDS = ("user_ids", "contents", "timestamps")
+
+
+def _text_path(path):
+    return path[:-len(".npz")] + ".text"
+
+
+def _segment_path(text_path):
+    return text_path[:-len(".text")] + ".npz"
+
+
+class HistoryRetention:
+    """
+    ホット窓の外に出た履歴をコールド層へ移す
+    max_age_days: これより古い履歴 / max_per_user: ユーザーごとの保持件数 / max_total: 全体の保持件数
+    （None の条件は使わない）
+    """
+
+    def __init__(self, state, vector_store, archive, max_age_days=None, max_per_user=None, max_total=None):
+        self.state = state
+        self.vector_store = vector_store
+        self.archive = archive
+        self.max_age_days = max_age_days
+        self.max_per_user = max_per_user
+        self.max_total = max_total
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self):
+        return self._lock.locked()
+
+    async def wait_idle(self):
+        """
+        実行中の圧縮が終わるまで待つ
+        """
+        async with self._lock:
+            pass
+
+    def cold_rows(self, store):
+        before = None
+        if self.max_age_days:
+            # 履歴の timestamp は str(datetime.now()) なので文字列比較でよい
+            before = str(datetime.now() - timedelta(days=self.max_age_days))
+        return store.select_cold_history(before, self.max_per_user, self.max_total)
+
+    def _write_segment(self, rows):
+        vector_ids = [row[4] for row in rows if row[4] is not None]
+        vectors = np.array(self.vector_store.matrix()[vector_ids], dtype=np.float32)
+        return self.archive.write_segment(rows, vectors)
+
+    async def compact(self, search_index, ingest_queue, scheduler):
+        """
+        コールド化した履歴をセグメントに書き出し、DB・ベクトルファイル・検索行列から取り除く
+        結果 (件数と各ファイルのサイズ変化) を返す
+        重い処理（選択・ベクトルの読み出し・ファイルの書き直し・VACUUM）は別接続でスレッドに回す。
+        その間は取り込みを止め（ベクトルの追記・行番号の付け替えが重ならないように）、
+        NoiseState のフラッシュと失効スケジューラの DB 書き込みも止めておく
+        """
+        async with self._lock:
+            async with ingest_queue.paused():
+                self.state.flush()
+                with self.state.hold_flush(), scheduler.hold():
+                    maintenance = await asyncio.to_thread(self.state.store.clone)
+                    try:
+                        return await self._compact(maintenance, search_index)
+                    finally:
+                        maintenance.close()
+
+    async def _compact(self, maintenance, search_index):
+        store = self.state.store
+        before = {"db": store.size_bytes(), "vectors": self.vector_store.size_bytes()}
+
+        rows = await asyncio.to_thread(self.cold_rows, maintenance)
+        if not rows:
+            return {"archived": 0, "segment_bytes": 0, "before": before, "after": before, "reclaimed": 0}
+
+        # 前回セグメントを書いた直後に落ちた分は、書き直さずに DB から消すだけにする
+        done = self.archive.archived(row[0] for row in rows)
+        fresh = [row for row in rows if row[0] not in done]
+        segment_bytes = 0
+        if fresh:
+            segment_bytes = await asyncio.to_thread(self._write_segment, fresh)
+
+        history_ids = [row[0] for row in rows]
+        compacted = await asyncio.to_thread(maintenance.compact_history, history_ids, self.vector_store)
+
+        # 差し替えとメモリ上の索引の更新だけはイベントループ上で行う
+        self.vector_store.swap_in(compacted)
+        store.finish_vector_compaction()
+        self.state.forget_history(history_ids)
+        search_index.remove(history_ids)
+
+        await asyncio.to_thread(maintenance.vacuum)
+
+        after = {"db": store.size_bytes(), "vectors": self.vector_store.size_bytes()}
+        reclaimed = sum(before.values()) - sum(after.values())
+        return {
+            "archived": len(rows),
+            "segment_bytes": segment_bytes,
+            "before": before,
+            "after": after,
+            "reclaimed": reclaimed,
+        }
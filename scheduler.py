@@ -0,0 +1,178 @@
+import heapq
+import time
+from contextlib import contextmanager
+
+
+# ==========================================
+# 失効スケジューラ
+# ==========================================
+# 「期限 (deadline) が来たらロールを外す」のような予定を DB に保存し、
+# メモリ上のヒープで期限順に管理する。
+# 起動時に DB から読み直すので、再起動をまたいでも失効が漏れない
+# （停止中に期限を過ぎたものは起動直後にまとめて処理される）。
+# kind ごとに処理関数を登録すれば、ロール以外の期限付き付与にも使える。
+
+class ExpiryScheduler:
+    """
+    DB に裏付けられた失効キュー
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._heap = [] # (deadline, id)
+        self._entries = {} # id -> entry
+        self._handlers = {} # kind -> async handler(entries)
+        self._held = 0
+        self._deferred = [] # hold() の間に溜めた DB 書き込み (op, 引数)
+        self._next_temp_id = -1 # hold() の間に登録した予定の仮 id（DB に書くときに本当の id に付け替える）
+        for entry in store.load_expirations():
+            self._push(entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def register(self, kind, handler):
+        """
+        kind の予定をまとめて処理するコルーチン関数を登録する
+        handler(entries) は処理できなかった（再試行したい）予定のリストを返す
+        """
+        self._handlers[kind] = handler
+
+    def _push(self, entry):
+        self._entries[entry["id"]] = entry
+        heapq.heappush(self._heap, (entry["deadline"], entry["id"]))
+
+    @contextmanager
+    def hold(self):
+        """
+        with の間は DB に書かず、抜けたときに順に書き出す（別の接続が DB を書き換えている間、
+        書き込みロックを待ってイベントループを止めないように。メモリ上の予定はそのまま動く）
+        """
+        self._held += 1
+        try:
+            yield
+        finally:
+            self._held -= 1
+            if self._held == 0:
+                self._write_deferred()
+
+    def _write_deferred(self):
+        real_ids = {} # 仮 id → DB の id
+        deferred, self._deferred = self._deferred, []
+        for op, arg in deferred:
+            if op == "add":
+                temp_id = arg["id"]
+                arg["id"] = real_ids[temp_id] = self.store.add_expiration(
+                    arg["deadline"], arg["kind"], arg["guild_id"], arg["role_id"], arg["member_id"]
+                )
+                # 取り消し・完了済みでなければ本当の id で入れ直す（仮 id のヒープ要素は読み捨てられる）
+                if self._entries.pop(temp_id, None) is not None:
+                    self._push(arg)
+            elif op == "delete":
+                self.store.delete_expirations([real_ids.get(expiration_id, expiration_id) for expiration_id in arg])
+            elif op == "update":
+                self.store.update_expiration(arg["id"], arg["deadline"])
+
+    def schedule(self, delay, kind, guild_id, role_id, member_id):
+        """
+        delay 秒後の失効を登録し、その id を返す
+        """
+        entry = {
+            "deadline": time.time() + delay,
+            "kind": kind,
+            "guild_id": guild_id,
+            "role_id": role_id,
+            "member_id": member_id,
+        }
+        if self._held:
+            entry["id"] = self._next_temp_id
+            self._next_temp_id -= 1
+            self._deferred.append(("add", entry))
+        else:
+            entry["id"] = self.store.add_expiration(entry["deadline"], kind, guild_id, role_id, member_id)
+        self._push(entry)
+        return entry["id"]
+
+    def cancel(self, role_id, member_id, kind=None):
+        """
+        (role, member) の予定を取り消す（恒久的な付与で上書きされた場合など）
+        """
+        ids = [
+            entry["id"] for entry in self._entries.values()
+            if entry["role_id"] == role_id and entry["member_id"] == member_id
+            and (kind is None or entry["kind"] == kind)
+        ]
+        for expiration_id in ids:
+            del self._entries[expiration_id]
+        if ids:
+            self._delete(ids)
+        return len(ids)
+
+    def pop_due(self, now=None, limit=100):
+        """
+        期限を過ぎた予定を最大 limit 件取り出す（DB からはまだ消さない）
+        """
+        now = time.time() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < limit:
+            deadline, expiration_id = heapq.heappop(self._heap)
+            entry = self._entries.get(expiration_id)
+            # 取り消し済み・延期済みのヒープ要素は読み捨てる
+            if entry is None or entry["deadline"] != deadline:
+                continue
+            due.append(entry)
+        return due
+
+    def complete(self, entries):
+        """
+        処理し終えた予定を消す
+        """
+        ids = [entry["id"] for entry in entries]
+        for expiration_id in ids:
+            self._entries.pop(expiration_id, None)
+        if ids:
+            self._delete(ids)
+
+    def _delete(self, ids):
+        if self._held:
+            self._deferred.append(("delete", list(ids)))
+        else:
+            self.store.delete_expirations(ids)
+
+    def retry_later(self, entry, delay):
+        """
+        一時的に失敗した予定を delay 秒後にやり直す
+        """
+        entry["deadline"] = time.time() + delay
+        if self._held:
+            self._deferred.append(("update", entry))
+        else:
+            self.store.update_expiration(entry["id"], entry["deadline"])
+        self._push(entry)
+
+    async def run_due(self, limit=100, retry_delay=60.0):
+        """
+        期限を過ぎた予定を kind ごとにまとめて処理する。処理件数を返す
+        """
+        due = self.pop_due(limit=limit)
+        by_kind = {}
+        for entry in due:
+            by_kind.setdefault(entry["kind"], []).append(entry)
+
+        for kind, entries in by_kind.items():
+            handler = self._handlers.get(kind)
+            if handler is None:
+                print(f"ExpiryScheduler: no handler for {kind}")
+                failed = entries
+            else:
+                try:
+                    failed = await handler(entries) or []
+                except Exception as e:
+                    print(f"ExpiryScheduler Error ({kind}): {e}")
+                    failed = entries
+
+            failed_ids = {entry["id"] for entry in failed}
+            self.complete([entry for entry in entries if entry["id"] not in failed_ids])
+            for entry in failed:
+                self.retry_later(entry, retry_delay)
+        return len(due)
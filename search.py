@@ -0,0 +1,428 @@
+import numpy as np
+
+
+# ==========================================
+# 類似度バンド検索 (Designed Serendipity)
+# ==========================================
+# 全履歴ベクトルを L2 正規化済みの1枚の行列として保持し、
+# 行列×ベクトル1回 + ブールマスクで「類似度 0.5〜0.7」の候補を返す。
+# owner_ids / history_ids は行列の各行と並ぶ配列。
+#
+# バンド判定には float32 の精度は要らないので、行列を float16 や
+# int8 (行ごとのスケール付き) で持てるようにしている（メモリ 1/2〜1/4）。
+# scale には「量子化後のベクトル自身のノルムの逆数」を入れておき、
+# 類似度は (量子化行 · クエリ) × scale で計算する。量子化で縮んだ / 伸びた
+# ノルムの分だけ類似度がずれるのを打ち消すため。
+
+PRECISIONS = ("float32", "float16", "int8")
+
+# 量子化行列を float32 に戻して計算するときの1回あたりの行数 (キャッシュに収まる大きさ)
+CHUNK_ROWS = 4096
+
+
+def quantize(vectors, precision):
+    """
+    正規化済み float32 行列を (量子化行列, 行ごとのスケール) にする
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if precision == "float32":
+        return vectors, np.ones(len(vectors), dtype=np.float32)
+    if precision == "float16":
+        quantized = vectors.astype(np.float16)
+    elif precision == "int8":
+        peak = np.abs(vectors).max(axis=1, initial=0.0)
+        peak[peak == 0] = 1.0
+        quantized = np.round(vectors / peak[:, None] * 127).astype(np.int8)
+    else:
+        raise ValueError(f"Unknown precision: {precision}")
+    norms = np.linalg.norm(quantized.astype(np.float32), axis=1)
+    scales = np.zeros(len(vectors), dtype=np.float32)
+    np.divide(1.0, norms, out=scales, where=norms > 0)
+    return quantized, scales
+
+
+class BandSearchEngine:
+    """
+    正規化済み埋め込み行列に対する全件バンド検索
+    on_message からの追加はインクリメンタルに反映される
+    precision: 行列の保持形式 ("float32" / "float16" / "int8")
+    """
+
+    def __init__(self, dim, initial_capacity=1024, precision="float32"):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision: {precision}")
+        self.dim = dim
+        self.precision = precision
+        self._count = 0
+        self._matrix, self._scales, self._owner_ids, self._history_ids = self._allocate(initial_capacity)
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def matrix(self):
+        """
+        保持している行列そのもの (precision の dtype)。float32 の値が欲しいときは rows() を使う
+        """
+        return self._matrix[:self._count]
+
+    @property
+    def scales(self):
+        return self._scales[:self._count]
+
+    def nbytes(self):
+        return self.matrix.nbytes + (self.scales.nbytes if self.precision != "float32" else 0)
+
+    def rows(self, index):
+        """
+        指定した行を正規化済み float32 で返す（index はスライスか行番号の配列）
+        """
+        rows = self.matrix[index]
+        if self.precision == "float32":
+            return rows
+        return rows.astype(np.float32) * self.scales[index][..., None]
+
+    def snapshot(self):
+        """
+        現在の行だけを見る読み取り専用の BandSearchEngine（配列はコピーせず共有する）
+        add は len() より後ろに書き込み、remove は新しい配列を作るので、スナップショットの行は変わらない
+        """
+        view = BandSearchEngine.__new__(BandSearchEngine)
+        view.dim = self.dim
+        view.precision = self.precision
+        view._count = self._count
+        view._matrix, view._scales, view._owner_ids, view._history_ids = (
+            _read_only(array) for array in (self.matrix, self.scales, self.owner_ids, self.history_ids)
+        )
+        return view
+
+    @property
+    def owner_ids(self):
+        return self._owner_ids[:self._count]
+
+    @property
+    def history_ids(self):
+        return self._history_ids[:self._count]
+
+    def _allocate(self, capacity):
+        """
+        capacity 行分の (行列, scales, owner_ids, history_ids) を確保する（共有メモリ版はここを差し替える）
+        """
+        return (
+            np.zeros((capacity, self.dim), dtype=self.precision),
+            np.zeros(capacity, dtype=np.float32),
+            np.zeros(capacity, dtype=np.int64),
+            np.zeros(capacity, dtype=np.int64),
+        )
+
+    def _reallocate(self, capacity, keep=slice(None)):
+        """
+        新しい配列を確保し、keep で選んだ行を先頭に詰めて移す
+        """
+        arrays = self._allocate(capacity)
+        for new, old in zip(arrays, (self.matrix, self.scales, self.owner_ids, self.history_ids)):
+            kept = old[keep]
+            new[:len(kept)] = kept
+        self._matrix, self._scales, self._owner_ids, self._history_ids = arrays
+
+    def _reserve(self, extra):
+        needed = self._count + extra
+        capacity = len(self._matrix)
+        if needed <= capacity:
+            return
+        capacity = max(capacity, 1)
+        while capacity < needed:
+            capacity *= 2
+        self._reallocate(capacity)
+
+    def add_batch(self, owner_ids, history_ids, vectors):
+        """
+        複数行をまとめて追加する（起動時の構築用）
+        ゼロベクトルや次元違いは除外し、追加した行数を返す
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        norms = np.linalg.norm(vectors, axis=1)
+        keep = norms > 0
+        n = int(keep.sum())
+        if n == 0:
+            return 0
+
+        self._reserve(n)
+        end = self._count + n
+        quantized, scales = quantize(vectors[keep] / norms[keep, None], self.precision)
+        self._matrix[self._count:end] = quantized
+        self._scales[self._count:end] = scales
+        self._owner_ids[self._count:end] = np.asarray(owner_ids, dtype=np.int64)[keep]
+        self._history_ids[self._count:end] = np.asarray(history_ids, dtype=np.int64)[keep]
+        self._count = end
+        return n
+
+    def add(self, owner_id, history_id, vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        if vector.size != self.dim:
+            return False
+        return self.add_batch([int(owner_id)], [history_id], vector[None, :]) == 1
+
+    def remove(self, history_ids):
+        """
+        指定した履歴の行を取り除き、取り除いた行数を返す（アーカイブ時用）
+        学習スレッドが古い配列を読んでいても壊れないよう、新しい配列に詰め直す
+        """
+        keep = ~np.isin(self.history_ids, np.asarray(list(history_ids), dtype=np.int64))
+        removed = self._count - int(keep.sum())
+        if removed == 0:
+            return 0
+        self._reallocate(len(self._matrix), keep)
+        self._count -= removed
+        return removed
+
+    def similarities(self, query, rows=None):
+        """
+        全行（rows を指定したらその行だけ）とのコサイン類似度
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(query)
+        if query.size != self.dim or norm == 0 or self._count == 0:
+            return np.empty(0, dtype=np.float32)
+        return self.dot(query / norm, rows)
+
+    def dot(self, query, rows=None):
+        """
+        正規化済みクエリとの内積（量子化行列は CHUNK_ROWS 行ずつ float32 に戻して計算する）
+        """
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        if self.precision == "float32":
+            return matrix @ query
+        scales = self.scales if rows is None else self.scales[rows]
+        sims = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), CHUNK_ROWS):
+            end = start + CHUNK_ROWS
+            sims[start:end] = (matrix[start:end].astype(np.float32) @ query) * scales[start:end]
+        return sims
+
+    def band(self, query, low=0.5, high=0.7):
+        """
+        類似度が [low, high] に入る行の (owner_ids, history_ids, similarities)
+        """
+        sims = self.similarities(query)
+        if sims.size == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, sims
+        mask = (sims >= low) & (sims <= high)
+        return self.owner_ids[mask], self.history_ids[mask], sims[mask]
+
+
+def _read_only(array):
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+# ==========================================
+# 近似インデックス (IVF)
+# ==========================================
+# 履歴が数百万件になると全件スキャンでも重くなるため、
+# 球面 k-means で行列をパーティションに分け、バンドに掛かりうる
+# パーティションだけを調べる。
+# 各パーティションは「重心との最小コサイン (半径)」を持つので、
+# 重心との角度 ± 半径 から類似度の取りうる範囲が分かり、
+# バンドと重ならないパーティションは安全に読み飛ばせる。
+# n_probe を指定すると、その中からさらに重心がバンド中央に近い順に絞る。
+
+class IVFBandIndex:
+    """
+    BandSearchEngine の上に載せる IVF インデックス
+    add / band は BandSearchEngine と同じ形で呼べる
+    """
+
+    def __init__(self, engine, n_lists=None, n_probe=None, min_rows=1024, rebuild_growth=1.5, seed=0):
+        self.engine = engine
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_rows = min_rows
+        self.rebuild_growth = rebuild_growth
+        self._rng = np.random.default_rng(seed)
+
+        self._centroids = None
+        self._min_cos = None
+        self._members = []
+        self._member_arrays = []
+        self._indexed = 0 # インデックスに振り分け済みの行数
+        self._trained_rows = 0
+        self._generation = 0 # remove() で行番号が変わるたびに進む
+
+    def __len__(self):
+        return len(self.engine)
+
+    @property
+    def trained(self):
+        return self._centroids is not None
+
+    def needs_rebuild(self):
+        n = len(self.engine)
+        if n < self.min_rows:
+            return False
+        return not self.trained or n >= self._trained_rows * self.rebuild_growth
+
+    # ------------------------------------------
+    # 構築
+    # ------------------------------------------
+    def snapshot(self):
+        """
+        学習に使う行列のスナップショット（イベントループ上で取ってから train に渡す）
+        """
+        return {"engine": self.engine.snapshot(), "generation": self._generation}
+
+    def train(self, snapshot=None, iterations=10, sample_size=50000):
+        """
+        スナップショットの行列から重心・割り当て・各パーティションの半径を計算する（スレッドから呼んでよい）
+        結果は install() で反映する
+        """
+        snapshot = snapshot or self.snapshot()
+        engine = snapshot["engine"]
+        generation = snapshot["generation"]
+        n = len(engine)
+        if n == 0:
+            return None
+
+        n_lists = self.n_lists or max(1, int(np.sqrt(n)))
+        n_lists = min(n_lists, n)
+
+        if n > sample_size:
+            sample = engine.rows(np.sort(self._rng.choice(n, sample_size, replace=False)))
+        else:
+            sample = engine.rows(slice(0, n))
+
+        centroids = sample[self._rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            norms = np.linalg.norm(sums, axis=1)
+            filled = norms > 0
+            centroids[filled] = sums[filled] / norms[filled, None]
+
+        assign = np.empty(n, dtype=np.int64)
+        cos = np.empty(n, dtype=np.float32)
+        for start in range(0, n, 65536):
+            end = min(start + 65536, n)
+            sims = engine.rows(slice(start, end)) @ centroids.T
+            assign[start:end] = np.argmax(sims, axis=1)
+            cos[start:end] = sims[np.arange(end - start), assign[start:end]]
+        min_cos = np.ones(len(centroids), dtype=np.float32)
+        np.minimum.at(min_cos, assign, cos)
+        return {"rows": n, "centroids": centroids, "assign": assign, "min_cos": min_cos, "generation": generation}
+
+    def install(self, trained):
+        """
+        train() の結果を反映し、学習後に追加された行も振り分ける（反映したかどうかを返す）
+        """
+        if trained is None or trained["generation"] != self._generation or trained["rows"] > len(self.engine):
+            # 学習中に行が削除された結果は使えない（次回の再構築に任せる）
+            return False
+        centroids = trained["centroids"]
+        assign = trained["assign"]
+        n = trained["rows"]
+
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+        self._members = [order[bounds[i]:bounds[i + 1]].tolist() for i in range(len(centroids))]
+        self._member_arrays = [None] * len(centroids)
+
+        self._centroids = centroids
+        self._min_cos = trained["min_cos"].copy()
+        self._indexed = n
+        self._trained_rows = n
+        self._assign_new_rows()
+        return True
+
+    def rebuild(self):
+        self.install(self.train())
+
+    # ------------------------------------------
+    # 追加
+    # ------------------------------------------
+    def add(self, owner_id, history_id, vector):
+        added = self.engine.add(owner_id, history_id, vector)
+        if added:
+            self._assign_new_rows()
+        return added
+
+    def remove(self, history_ids):
+        """
+        行を取り除く。行番号が変わるので、再学習まではインデックスを使わない（全件スキャン）
+        """
+        removed = self.engine.remove(history_ids)
+        if removed:
+            self._generation += 1
+            self._centroids = None
+            self._min_cos = None
+            self._members = []
+            self._member_arrays = []
+            self._indexed = 0
+            self._trained_rows = 0
+        return removed
+
+    def _assign_new_rows(self):
+        if not self.trained:
+            return
+        n = len(self.engine)
+        if self._indexed >= n:
+            return
+        rows = self.engine.rows(slice(self._indexed, n))
+        cos = rows @ self._centroids.T
+        assign = np.argmax(cos, axis=1)
+        for offset, list_id in enumerate(assign):
+            self._members[list_id].append(self._indexed + offset)
+            self._member_arrays[list_id] = None
+            self._min_cos[list_id] = min(self._min_cos[list_id], cos[offset, list_id])
+        self._indexed = n
+
+    def _member_array(self, list_id):
+        array = self._member_arrays[list_id]
+        if array is None:
+            array = np.asarray(self._members[list_id], dtype=np.int64)
+            self._member_arrays[list_id] = array
+        return array
+
+    # ------------------------------------------
+    # 検索
+    # ------------------------------------------
+    def probe_lists(self, query, low=0.5, high=0.7, n_probe=None):
+        """
+        調べるパーティション番号（優先度順）
+        """
+        t = np.clip(self._centroids @ query, -1.0, 1.0)
+        theta = np.arccos(t)
+        radius = np.arccos(np.clip(self._min_cos, -1.0, 1.0))
+        max_sim = np.cos(np.maximum(theta - radius, 0.0))
+        min_sim = np.cos(np.minimum(theta + radius, np.pi))
+        eligible = np.flatnonzero((max_sim >= low) & (min_sim <= high))
+
+        order = eligible[np.argsort(np.abs(t[eligible] - (low + high) / 2))]
+        n_probe = n_probe or self.n_probe
+        return order[:n_probe] if n_probe else order
+
+    def band(self, query, low=0.5, high=0.7, n_probe=None):
+        """
+        類似度が [low, high] に入る行の (owner_ids, history_ids, similarities)
+        未学習（行数が少ない間）は全件スキャンと同じ
+        """
+        if not self.trained:
+            return self.engine.band(query, low, high)
+
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(query)
+        empty = np.empty(0, dtype=np.int64)
+        if query.size != self.engine.dim or norm == 0:
+            return empty, empty, np.empty(0, dtype=np.float32)
+        query = query / norm
+
+        lists = self.probe_lists(query, low, high, n_probe)
+        if len(lists) == 0:
+            return empty, empty, np.empty(0, dtype=np.float32)
+        rows = np.concatenate([self._member_array(i) for i in lists])
+        sims = self.engine.dot(query, rows)
+        mask = (sims >= low) & (sims <= high)
+        rows = rows[mask]
+        return self.engine.owner_ids[rows], self.engine.history_ids[rows], sims[mask]
@@ -0,0 +1,224 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from search import BandSearchEngine
+
+
+# ==========================================
+# 検索ワーカープロセス
+# ==========================================
+# 全件スキャン (行列×ベクトル) を別プロセスで行い、イベントループ
+# （ハートビート・コマンド応答）を止めない。
+# 検索行列は SharedBandEngine がメモリマップファイルに置き、ワーカーは同じファイルを
+# 読み取り専用でマップする（リクエストごとに行列を pickle しない）。
+# 行の追加はファイルに直接書き込まれ、リクエストには「何行目まで有効か」と
+# 配列の世代だけを載せるので、更新はワーカーにそのまま見える。
+# 容量の拡張・行の削除で配列を作り直したときだけ世代が変わり、ワーカーは新しいファイルを開き直す。
+# 古い世代のファイルは、それを参照するリクエストがなくなってから消す。
+
+ARRAY_NAMES = ("matrix", "scales", "owner_ids", "history_ids")
+DIRECTORY_PREFIX = "noise-search-"
+
+
+def remove_stale_directories(directory=None):
+    """
+    directory（未設定なら一時ディレクトリ）にある、もう動いていないプロセスの共有ファイル置き場を消す
+    消したディレクトリの数を返す
+    """
+    directory = directory or tempfile.gettempdir()
+    removed = 0
+    for name in os.listdir(directory):
+        if not name.startswith(DIRECTORY_PREFIX):
+            continue
+        pid = name[len(DIRECTORY_PREFIX):].split("-", 1)[0]
+        if pid.isdigit() and _alive(int(pid)):
+            continue
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+        removed += 1
+    return removed
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def map_arrays(layout, mode):
+    """
+    layout のファイルを (行列, scales, owner_ids, history_ids) としてマップする
+    """
+    capacity = layout["capacity"]
+    shapes = {
+        "matrix": ((capacity, layout["dim"]), layout["precision"]),
+        "scales": ((capacity,), "float32"),
+        "owner_ids": ((capacity,), "int64"),
+        "history_ids": ((capacity,), "int64"),
+    }
+    return tuple(
+        np.asarray(np.memmap(layout["paths"][name], dtype=shapes[name][1], mode=mode, shape=shapes[name][0]))
+        for name in ARRAY_NAMES
+    )
+
+
+class SharedBandEngine(BandSearchEngine):
+    """
+    配列を directory 配下のメモリマップファイルに置く BandSearchEngine
+    layout をワーカーに渡すと、同じ配列を attach() で読める
+    """
+
+    def __init__(self, dim, directory=None, initial_capacity=1024, precision="float32"):
+        # ディレクトリ名に pid を入れ、remove_stale_directories が持ち主の生死を判断できるようにする
+        self.directory = tempfile.mkdtemp(prefix=f"{DIRECTORY_PREFIX}{os.getpid()}-", dir=directory)
+        self.generation = 0
+        self.layout = None
+        self.in_flight = Counter() # 世代 → 処理中のリクエスト数
+        self._retired = {} # 世代 → ファイル
+        super().__init__(dim, initial_capacity, precision)
+
+    def _allocate(self, capacity):
+        self.generation += 1
+        if self.layout is not None:
+            self._retired[self.layout["generation"]] = list(self.layout["paths"].values())
+        self.layout = {
+            "generation": self.generation,
+            "dim": self.dim,
+            "precision": self.precision,
+            "capacity": max(capacity, 1),
+            "paths": {name: os.path.join(self.directory, f"{self.generation:06d}-{name}.bin") for name in ARRAY_NAMES},
+        }
+        arrays = map_arrays(self.layout, "w+")
+        self.release()
+        return arrays
+
+    def release(self):
+        """
+        処理中のリクエストがなくなった古い世代のファイルを消す
+        （マップ済みの配列はファイルを消しても読める）
+        """
+        for generation in list(self._retired):
+            if self.in_flight[generation] == 0:
+                for path in self._retired.pop(generation):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def attach(layout):
+    """
+    layout の配列を読み取り専用でマップした BandSearchEngine（ワーカープロセス側）
+    """
+    engine = BandSearchEngine(layout["dim"], initial_capacity=0, precision=layout["precision"])
+    engine._matrix, engine._scales, engine._owner_ids, engine._history_ids = map_arrays(layout, "r")
+    return engine
+
+
+# ワーカープロセスごとの attach 済み配列 (世代 → engine)
+_attached = {}
+
+
+def _band(layout, count, query, low, high, within):
+    engine = _attached.get(layout["generation"])
+    if engine is None:
+        # 新しい世代が来たら、それより古い世代は手放す
+        for generation in [g for g in _attached if g < layout["generation"]]:
+            del _attached[generation]
+        engine = _attached[layout["generation"]] = attach(layout)
+    engine._count = count
+    return band_within(engine, query, low, high, within)
+
+
+def band_within(engine, query, low, high, within=None):
+    """
+    engine.band と同じ。within (history_id の配列) を指定したらその履歴の行だけを調べる
+    """
+    if within is None:
+        return engine.band(query, low, high)
+    rows = np.flatnonzero(np.isin(engine.history_ids, within))
+    sims = engine.similarities(query, rows)
+    if sims.size == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, sims
+    mask = (sims >= low) & (sims <= high)
+    rows = rows[mask]
+    return engine.owner_ids[rows], engine.history_ids[rows], sims[mask]
+
+
+class SearchPool:
+    """
+    SharedBandEngine に対するバンド検索をワーカープロセスで実行する
+    postings: キーワード → [(user_id, history_id)] を返す関数（keyword 指定の検索で使う）
+    engine / postings は後から設定してもよい（起動処理より前にワーカーを fork しておくため）
+    ワーカーが落ちた場合はスレッドでの検索に切り替える
+    """
+
+    def __init__(self, engine, workers=2, postings=None):
+        self.engine = engine
+        self.postings = postings
+        self.workers = workers
+        # bot.py はトップレベルで初期化を行うので、spawn / forkserver だと子プロセスで全部やり直してしまう。
+        # fork で、スレッドや待ち受けソケットを作る前（起動処理の最初）にワーカーを揃えておく
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+        self._executor.submit(int).result()
+        self.broken = False
+        self.requests = 0
+
+    async def band(self, query, low=0.5, high=0.7, keyword=None):
+        """
+        類似度が [low, high] に入る行の (owner_ids, history_ids, similarities)
+        keyword を指定すると、そのキーワードを含む履歴だけを対象にする
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        within = None
+        if keyword is not None:
+            within = np.asarray([history_id for _, history_id in self.postings(keyword)], dtype=np.int64)
+
+        if self.broken:
+            return await self._band_in_thread(query, low, high, within)
+
+        layout = self.engine.layout
+        generation = layout["generation"]
+        self.engine.in_flight[generation] += 1
+        self.requests += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, _band, layout, len(self.engine), query, low, high, within)
+        except BrokenProcessPool as e:
+            print(f"Search Pool Error: {e} (falling back to in-process search)")
+            self.broken = True
+            return await self._band_in_thread(query, low, high, within)
+        finally:
+            self.engine.in_flight[generation] -= 1
+            if self.engine.in_flight[generation] == 0:
+                del self.engine.in_flight[generation]
+            self.engine.release()
+
+    async def _band_in_thread(self, query, low, high, within):
+        """
+        ワーカーが使えないときの検索。行数と配列はループ上で固定してからスレッドに渡す
+        （スレッドで数えている間に追加・削除されても、読む範囲がずれない）
+        """
+        snapshot = self.engine.snapshot()
+        return await asyncio.to_thread(band_within, snapshot, query, low, high, within)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if self.engine is not None:
+            self.engine.close()
+
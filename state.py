@@ -0,0 +1,348 @@
+import asyncio
+from contextlib import contextmanager
+
+from keywords import AhoCorasick
+from registry import HistoryRegistry
+from storage import USER_FIELDS
+from tracing import span
+
+
+# ==========================================
+# インメモリ状態 + ライトビハインド
+# ==========================================
+# 起動時に一度だけ NoiseStore からユーザー情報を読み込み、
+# 以降のハンドラはすべてこのオブジェクトを書き換える。
+# 変更は dirty として記録し、デバウンスされたバックグラウンドタスクが
+# FLUSH_INTERVAL ごとに1トランザクションでまとめて書き出す。
+
+class NoiseState:
+    """
+    プロセス全体で共有するユーザーデータ
+    NoiseStore と同じユーザー単位のAPIを持つ
+    """
+
+    def __init__(self, store, flush_interval=2.0):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.users = store.load_users()
+
+        self._dirty_users = set()
+        self._dirty_keywords = set() # (user_id, keyword)
+        self._pending_history = [] # (id, user_id, content, timestamp, vector_id, vector_space)
+        self._next_history_id = store.max_history_id() + 1
+        self._flush_task = None
+        self._flush_held = 0 # hold_flush() の入れ子の深さ
+
+        # ランダム抽選用の (user_id, history_id) 配列
+        self.registry = HistoryRegistry()
+        self.registry.add_batch(*store.load_history_index())
+
+        # 逆引きインデックス: channel_id → 持ち主 / role_id → 持ち主
+        self._channel_owners = {}
+        self._role_owners = {}
+        for user_id, user in self.users.items():
+            if user.get("channel_id") is not None:
+                self._channel_owners.setdefault(user["channel_id"], user_id)
+            if user.get("role_id") is not None:
+                self._role_owners[user["role_id"]] = user_id
+
+        # キーワード → [(user_id, history_id)] の転置インデックス
+        self.postings = store.load_postings()
+        self._pending_postings = [] # (keyword, history_id, user_id)
+        self._pending_indexed = set()
+        self._removed_keywords = set()
+
+    # ------------------------------------------
+    # ユーザー
+    # ------------------------------------------
+    def get_user(self, user_id):
+        return self.users.get(user_id)
+
+    def ensure_user(self, user_id, channel_id=None, onboarding_status=None):
+        user = self.users.get(user_id)
+        if user is None:
+            user = {
+                "channel_id": channel_id,
+                "points": 0,
+                "expose_count": 0,
+                "onboarding_status": onboarding_status,
+                "connection_enabled": True,
+                "role_id": None,
+                "keyword_stats": {},
+            }
+            self.users[user_id] = user
+            if channel_id is not None:
+                self._channel_owners.setdefault(channel_id, user_id)
+            self.mark_dirty(user_id)
+        return user
+
+    def update_user(self, user_id, **fields):
+        unknown = set(fields) - set(USER_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown user fields: {', '.join(sorted(unknown))}")
+        user = self.users.get(user_id)
+        if user is None:
+            return
+        # 明示的に割り当てられたチャンネル / ロールは逆引きを上書きする
+        if "channel_id" in fields:
+            _reassign(self._channel_owners, user.get("channel_id"), fields["channel_id"], user_id)
+        if "role_id" in fields:
+            _reassign(self._role_owners, user.get("role_id"), fields["role_id"], user_id)
+        user.update(fields)
+        self.mark_dirty(user_id)
+
+    def add_points(self, user_id, delta):
+        user = self.users.get(user_id)
+        if user is None:
+            return
+        user["points"] += delta
+        self.mark_dirty(user_id)
+
+    def find_owner_by_channel(self, channel_id):
+        return self._channel_owners.get(channel_id)
+
+    def find_owner_by_role(self, role_id):
+        return self._role_owners.get(role_id)
+
+    def get_role_id(self, user_id):
+        user = self.users.get(user_id)
+        return user.get("role_id") if user else None
+
+    # ------------------------------------------
+    # キーワード統計
+    # ------------------------------------------
+    def increment_keyword(self, user_id, keyword):
+        """
+        キーワードの出現回数を +1 し、更新後の値を返す
+        """
+        stats = self.users[user_id]["keyword_stats"]
+        stats[keyword] = stats.get(keyword, 0) + 1
+        self._dirty_keywords.add((user_id, keyword))
+        self._schedule_flush()
+        return stats[keyword]
+
+    # ------------------------------------------
+    # 投稿履歴
+    # ------------------------------------------
+    def append_history(self, user_id, content, timestamp, vector_id, vector_space=None):
+        history_id = self._next_history_id
+        self._next_history_id += 1
+        self._pending_history.append((history_id, user_id, content, timestamp, vector_id, vector_space))
+        self.registry.add(user_id, history_id)
+        self._schedule_flush()
+        return history_id
+
+    def get_history(self, history_id):
+        """
+        履歴1件を (user_id, content, vector_id) で返す（未フラッシュ分を含む）
+        """
+        for pending_id, user_id, content, _, vector_id, _ in self._pending_history:
+            if pending_id == history_id:
+                return user_id, content, vector_id
+        with span("db_load", stage=True):
+            return self.store.get_history(history_id)
+
+    def random_history(self, exclude_content=None, attempts=8):
+        """
+        履歴から一様に1件選んで (user_id, content) を返す
+        本文が exclude_content と完全一致したものは選び直す（attempts 回まで。見つからなければ None）
+        """
+        for _ in range(attempts):
+            picked = self.registry.sample()
+            if picked is None:
+                return None
+            history = self.get_history(picked[1])
+            if history is None or history[1] == exclude_content:
+                continue
+            return history[0], history[1]
+        return None
+
+    def iter_history(self):
+        """
+        全履歴を (id, user_id, content, vector_id, vector_space) で順に返す（未フラッシュ分を含む）
+        """
+        pending = list(self._pending_history)
+        yield from self.store.iter_history()
+        for history_id, user_id, content, _, vector_id, vector_space in pending:
+            yield history_id, user_id, content, vector_id, vector_space
+
+    def forget_history(self, history_ids):
+        """
+        DB から消した（コールド層に移した）履歴を抽選用配列・転置インデックスから取り除く
+        """
+        self.registry.remove(history_ids)
+        removed = set(history_ids)
+        for keyword, postings in self.postings.items():
+            self.postings[keyword] = [p for p in postings if p[1] not in removed]
+
+    # ------------------------------------------
+    # キーワード転置インデックス
+    # ------------------------------------------
+    def get_postings(self, keyword):
+        """
+        keyword を含む（ベクトル付きの）履歴の [(user_id, history_id)]
+        """
+        return self.postings.get(keyword, [])
+
+    def add_postings(self, user_id, history_id, keywords):
+        """
+        新しい履歴1件を、含まれるキーワードの転置リストに追加する
+        """
+        for keyword in keywords:
+            if keyword not in self.postings:
+                # 未構築のキーワードは sync_keyword_index で全体を作る
+                continue
+            self.postings[keyword].append((user_id, history_id))
+            self._pending_postings.append((keyword, history_id, user_id))
+        self._schedule_flush()
+
+    def sync_keyword_index(self, keywords):
+        """
+        転置インデックスを現在のキーワード一覧に合わせる
+        新しいキーワードは全履歴を1回だけ走査して構築し、消えたキーワードは破棄する
+        """
+        keywords = list(dict.fromkeys(keywords))
+        removed = set(self.postings) - set(keywords)
+        for keyword in removed:
+            del self.postings[keyword]
+            self._pending_indexed.discard(keyword)
+            self._removed_keywords.add(keyword)
+        self._pending_postings = [p for p in self._pending_postings if p[0] not in removed]
+
+        added = [keyword for keyword in keywords if keyword not in self.postings]
+        if added:
+            automaton = AhoCorasick(added)
+            for keyword in added:
+                self.postings[keyword] = []
+            for history_id, user_id, content, vector_id, _ in self.iter_history():
+                if vector_id is None:
+                    continue
+                for keyword in automaton.find(content):
+                    self.postings[keyword].append((user_id, history_id))
+                    self._pending_postings.append((keyword, history_id, user_id))
+            self._pending_indexed.update(added)
+            print(f"Indexed {len(added)} keywords")
+
+        if removed or added:
+            self._schedule_flush()
+        return len(added), len(removed)
+
+    # ------------------------------------------
+    # フラッシュ
+    # ------------------------------------------
+    def mark_dirty(self, user_id):
+        self._dirty_users.add(user_id)
+        self._schedule_flush()
+
+    @property
+    def dirty(self):
+        return bool(
+            self._dirty_users
+            or self._dirty_keywords
+            or self._pending_history
+            or self._pending_postings
+            or self._pending_indexed
+            or self._removed_keywords
+        )
+
+    @property
+    def flush_held(self):
+        return self._flush_held > 0
+
+    @contextmanager
+    def hold_flush(self):
+        """
+        with の間はフラッシュしない（別の接続が DB を書き換えている間、書き込みロックを待って止まらないように）
+        変更は溜めておき、抜けたときに書き出す
+        """
+        self._flush_held += 1
+        try:
+            yield
+        finally:
+            self._flush_held -= 1
+            if self._flush_held == 0 and self.dirty:
+                self._schedule_flush()
+
+    def flush(self):
+        """
+        溜まっている変更を1トランザクションで書き出す
+        """
+        if not self.dirty or self._flush_held:
+            return
+
+        users = {user_id: self.users[user_id] for user_id in self._dirty_users}
+        keyword_stats = [
+            (user_id, keyword, self.users[user_id]["keyword_stats"][keyword])
+            for user_id, keyword in self._dirty_keywords
+        ]
+        history = self._pending_history
+        postings = self._pending_postings
+        indexed = self._pending_indexed
+        removed = self._removed_keywords
+
+        # keyword_stats / history より先に users を書く必要があるので、
+        # 統計だけ更新されたユーザーも users 側に含めておく
+        for user_id, _ in self._dirty_keywords:
+            users.setdefault(user_id, self.users[user_id])
+        for _, user_id, _, _, _, _ in history:
+            if user_id in self.users:
+                users.setdefault(user_id, self.users[user_id])
+
+        self._dirty_users = set()
+        self._dirty_keywords = set()
+        self._pending_history = []
+        self._pending_postings = []
+        self._pending_indexed = set()
+        self._removed_keywords = set()
+
+        try:
+            with span("db_save", stage=True):
+                self.store.write_batch(
+                    users,
+                    keyword_stats,
+                    history,
+                    postings=postings,
+                    indexed_keywords=indexed,
+                    removed_keywords=removed,
+                )
+        except Exception:
+            # 失敗した分は次回のフラッシュで再送する
+            self._dirty_users |= set(users)
+            self._dirty_keywords |= {(user_id, keyword) for user_id, keyword, _ in keyword_stats}
+            self._pending_history = history + self._pending_history
+            self._pending_postings = postings + self._pending_postings
+            self._pending_indexed |= indexed
+            self._removed_keywords |= removed
+            raise
+
+    def _schedule_flush(self):
+        if self._flush_task and not self._flush_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # イベントループ外（起動処理など）では close() 時にまとめて書き出す
+            return
+        self._flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"DB Flush Error: {e}")
+            self._flush_task = None
+            self._schedule_flush()
+
+    def close(self):
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        self.flush()
+        self.store.close()
+
+
+def _reassign(index, old_key, new_key, user_id):
+    if old_key is not None and index.get(old_key) == user_id:
+        del index[old_key]
+    if new_key is not None:
+        index[new_key] = user_id
@@ -0,0 +1,491 @@
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+
+
+# ==========================================
+# SQLite ストレージ (WALモード)
+# ==========================================
+# noise_db.json と同じデータモデル（users / points / expose_count /
+# onboarding_status / keyword_stats / connection_enabled / history）を
+# インデックス付きのテーブルに分けて保持する。
+# 1回の発言で触るのは数行だけで、DB全体の読み書きは発生しない。
+# 埋め込みベクトル本体は VectorStore に置き、history には行番号と作ったバックエンドの名前だけを持つ。
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    channel_id INTEGER,
+    points INTEGER NOT NULL DEFAULT 0,
+    expose_count INTEGER NOT NULL DEFAULT 0,
+    onboarding_status TEXT,
+    connection_enabled INTEGER NOT NULL DEFAULT 1,
+    role_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_users_channel ON users(channel_id);
+
+CREATE TABLE IF NOT EXISTS keyword_stats (
+    user_id TEXT NOT NULL,
+    keyword TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, keyword)
+);
+CREATE INDEX IF NOT EXISTS idx_keyword_stats_keyword ON keyword_stats(keyword);
+
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    vector_id INTEGER,
+    vector_space TEXT -- ベクトルを作った埋め込みバックエンド (embedding.py の name)
+);
+CREATE INDEX IF NOT EXISTS idx_history_user ON history(user_id, id);
+
+-- キーワード → 履歴 の転置インデックス（ベクトルを持つ履歴のみ）
+CREATE TABLE IF NOT EXISTS keyword_postings (
+    keyword TEXT NOT NULL,
+    history_id INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (keyword, history_id)
+);
+
+-- 転置インデックスを構築済みのキーワード
+CREATE TABLE IF NOT EXISTS indexed_keywords (
+    keyword TEXT PRIMARY KEY
+);
+
+-- 期限付きの付与（/expose のロールなど）の失効予定
+CREATE TABLE IF NOT EXISTS expirations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    deadline REAL NOT NULL,
+    kind TEXT NOT NULL,
+    guild_id INTEGER NOT NULL,
+    role_id INTEGER NOT NULL,
+    member_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_expirations_deadline ON expirations(deadline);
+
+-- 既存メンバー一括オンボーディングの進捗 (status: pending / done / failed)
+CREATE TABLE IF NOT EXISTS onboarding_backfill (
+    guild_id INTEGER NOT NULL,
+    member_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (guild_id, member_id)
+);
+CREATE INDEX IF NOT EXISTS idx_onboarding_backfill_status ON onboarding_backfill(guild_id, status);
+
+-- 雑多な状態 (ベクトルファイル差し替え中の印など)
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# 件数上限を指定しないときの番兵
+NO_LIMIT = 2 ** 62
+
+# users テーブルで NoiseState.update_user から書き換えてよいカラム
+USER_FIELDS = ("channel_id", "points", "expose_count", "onboarding_status", "connection_enabled", "role_id")
+
+
+class NoiseStore:
+    """
+    ユーザーデータベース本体
+    ユーザーの読み書きは NoiseState がメモリ上で行い、ここへはまとめて書き戻す
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+        self._depth = 0
+        self._upgrade_schema()
+
+    def _upgrade_schema(self):
+        # 旧スキーマ (history.vector にJSONを格納) には vector_id 列がない
+        if "vector_id" not in self._columns("history"):
+            self.conn.execute("ALTER TABLE history ADD COLUMN vector_id INTEGER")
+        # vector_space (埋め込みバックエンドのタグ) は後から追加した列。既存のベクトルは tag_vector_space で埋める
+        if "vector_space" not in self._columns("history"):
+            self.conn.execute("ALTER TABLE history ADD COLUMN vector_space TEXT")
+        # role_id (個室ロールのID) は後から追加した列
+        if "role_id" not in self._columns("users"):
+            self.conn.execute("ALTER TABLE users ADD COLUMN role_id INTEGER")
+
+    def _columns(self, table):
+        return {row["name"] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+
+    def close(self):
+        self.conn.close()
+
+    def clone(self):
+        """
+        同じ DB ファイルへの別の接続（スレッドで行うメンテナンス用）
+        """
+        return NoiseStore(self.path)
+
+    @contextmanager
+    def transaction(self):
+        """
+        複数の更新を1トランザクションにまとめる（ネスト可）
+        """
+        if self._depth == 0:
+            self.conn.execute("BEGIN IMMEDIATE")
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._depth -= 1
+            if self._depth == 0:
+                self.conn.execute("ROLLBACK")
+            raise
+        else:
+            self._depth -= 1
+            if self._depth == 0:
+                self.conn.execute("COMMIT")
+
+    # ------------------------------------------
+    # 移行
+    # ------------------------------------------
+    def migrate_from_json(self, json_path, vector_store):
+        """
+        旧 noise_db.json を取り込む（DBが空のときだけ）
+        ベクトルは vector_store に移し、取り込み後のJSONは .migrated を付けて退避する
+        """
+        if not os.path.exists(json_path):
+            return 0
+        if self.conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            return 0
+
+        with open(json_path, "r") as f:
+            data = json.load(f)
+
+        users = data.get("users", {})
+        with self.transaction():
+            for user_id, udata in users.items():
+                self.conn.execute(
+                    "INSERT INTO users (user_id, channel_id, points, expose_count, onboarding_status, connection_enabled)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        user_id,
+                        udata.get("channel_id"),
+                        udata.get("points", 0),
+                        udata.get("expose_count", 0),
+                        udata.get("onboarding_status"),
+                        1 if udata.get("connection_enabled", True) else 0,
+                    ),
+                )
+                for kw, count in udata.get("keyword_stats", {}).items():
+                    self.conn.execute(
+                        "INSERT INTO keyword_stats (user_id, keyword, count) VALUES (?, ?, ?)",
+                        (user_id, kw, count),
+                    )
+                for h in udata.get("history", []):
+                    vector_id = vector_store.append(h["vector"]) if h.get("vector") else None
+                    self.conn.execute(
+                        "INSERT INTO history (user_id, content, timestamp, vector_id) VALUES (?, ?, ?, ?)",
+                        (user_id, h.get("content", ""), h.get("timestamp", ""), vector_id),
+                    )
+
+        os.replace(json_path, json_path + ".migrated")
+        print(f"Migrated {len(users)} users from {json_path}")
+        return len(users)
+
+    def migrate_vectors(self, vector_store):
+        """
+        旧スキーマの history.vector (JSON) を vector_store へ移す
+        """
+        if "vector" not in self._columns("history"):
+            return 0
+
+        rows = self.conn.execute(
+            "SELECT id, vector FROM history WHERE vector IS NOT NULL AND vector_id IS NULL ORDER BY id"
+        ).fetchall()
+        with self.transaction():
+            for row in rows:
+                vector = json.loads(row["vector"])
+                vector_id = vector_store.append(vector) if vector else None
+                self.conn.execute(
+                    "UPDATE history SET vector_id = ?, vector = NULL WHERE id = ?", (vector_id, row["id"])
+                )
+        if rows:
+            print(f"Moved {len(rows)} history vectors to {vector_store.path}")
+        return len(rows)
+
+    def tag_vector_space(self, space):
+        """
+        タグのないベクトル（タグ導入前・JSON からの取り込み分）を space で作られたものとして記録する
+        """
+        cur = self.conn.execute(
+            "UPDATE history SET vector_space = ? WHERE vector_id IS NOT NULL AND vector_space IS NULL", (space,)
+        )
+        if cur.rowcount:
+            print(f"Tagged {cur.rowcount} history vectors as {space}")
+        return cur.rowcount
+
+    # ------------------------------------------
+    # 投稿履歴
+    # ------------------------------------------
+    def get_history(self, history_id):
+        """
+        履歴1件を (user_id, content, vector_id) で返す。なければ None
+        """
+        row = self.conn.execute(
+            "SELECT user_id, content, vector_id FROM history WHERE id = ?", (history_id,)
+        ).fetchone()
+        return (row["user_id"], row["content"], row["vector_id"]) if row else None
+
+    def iter_history(self):
+        """
+        全履歴を (id, user_id, content, vector_id, vector_space) で順に返す
+        """
+        for row in self.conn.execute("SELECT id, user_id, content, vector_id, vector_space FROM history ORDER BY id"):
+            yield row["id"], row["user_id"], row["content"], row["vector_id"], row["vector_space"]
+
+    def load_history_index(self):
+        """
+        全履歴の (user_ids, ids) を ID 順に返す（本文は読まない）
+        """
+        user_ids = []
+        ids = []
+        for row in self.conn.execute("SELECT id, user_id FROM history ORDER BY id"):
+            ids.append(row["id"])
+            user_ids.append(row["user_id"])
+        return user_ids, ids
+
+    def select_cold_history(self, before=None, max_per_user=None, max_total=None):
+        """
+        ホット窓から外れた履歴を (id, user_id, content, timestamp, vector_id, vector_space) で返す
+        before より古いもの、ユーザーごとの新しい順 max_per_user 件より後ろ、
+        全体の新しい順 max_total 件より後ろ、のいずれかに当たるものが対象
+        """
+        rows = self.conn.execute(
+            "SELECT id, user_id, content, timestamp, vector_id, vector_space FROM ("
+            " SELECT *,"
+            "  ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY id DESC) AS user_rank,"
+            "  ROW_NUMBER() OVER (ORDER BY id DESC) AS total_rank"
+            " FROM history)"
+            " WHERE timestamp < ? OR user_rank > ? OR total_rank > ?"
+            " ORDER BY id",
+            (before or "", max_per_user or NO_LIMIT, max_total or NO_LIMIT),
+        )
+        return [tuple(row) for row in rows]
+
+    def compact_history(self, history_ids, vector_store):
+        """
+        履歴を削除し、残った履歴のベクトルだけを詰め直した新しいベクトルファイルのパスを返す
+        （重いのでスレッドから clone() した接続で呼ぶ。その間ベクトルの追記は止めておくこと）
+        呼び出し元は vector_store.swap_in → finish_vector_compaction() で差し替えを完了する。
+        途中で落ちても recover_vector_compaction() で続きから完了できる
+        """
+        removed = set(history_ids)
+        rows = [
+            (row["id"], row["vector_id"])
+            for row in self.conn.execute(
+                "SELECT id, vector_id FROM history WHERE vector_id IS NOT NULL ORDER BY vector_id"
+            )
+            if row["id"] not in removed
+        ]
+        # ファイルの書き出しは書き込みロックを取る前に済ませる
+        compacted = vector_store.write_compacted([vector_id for _, vector_id in rows])
+        with self.transaction():
+            self.conn.executemany("DELETE FROM keyword_postings WHERE history_id = ?", [(i,) for i in history_ids])
+            self.conn.executemany("DELETE FROM history WHERE id = ?", [(i,) for i in history_ids])
+            self.conn.executemany(
+                "UPDATE history SET vector_id = ? WHERE id = ?",
+                [(new_id, history_id) for new_id, (history_id, _) in enumerate(rows)],
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('pending_vector_file', ?)", (compacted,)
+            )
+        return compacted
+
+    def finish_vector_compaction(self):
+        self.conn.execute("DELETE FROM meta WHERE key = 'pending_vector_file'")
+
+    def recover_vector_compaction(self, vector_store):
+        """
+        compact_history の途中で止まった場合の後始末（起動時に呼ぶ）
+        コミット済みなら差し替えを完了し、未コミットなら作りかけのファイルを消す
+        """
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'pending_vector_file'").fetchone()
+        compacted = vector_store.path + ".compact"
+        if row is not None:
+            if os.path.exists(row["value"]):
+                vector_store.swap_in(row["value"])
+                print(f"Finished an interrupted vector compaction ({len(vector_store)} vectors)")
+            self.conn.execute("DELETE FROM meta WHERE key = 'pending_vector_file'")
+        elif os.path.exists(compacted):
+            os.remove(compacted)
+
+    def size_bytes(self):
+        """
+        DBファイル (WAL を含む) のサイズ
+        """
+        return sum(os.path.getsize(p) for p in (self.path, self.path + "-wal") if os.path.exists(p))
+
+    def vacuum(self):
+        """
+        削除で空いたページをファイルから切り詰める
+        """
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.conn.execute("VACUUM")
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def count_history(self):
+        return self.conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def max_history_id(self):
+        return self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM history").fetchone()[0]
+
+    # ------------------------------------------
+    # 一括読み書き (NoiseState のロード / フラッシュ用)
+    # ------------------------------------------
+    def load_users(self):
+        """
+        全ユーザーを {user_id: user} で返す（keyword_stats 込み、history なし）
+        """
+        users = {}
+        for row in self.conn.execute("SELECT * FROM users"):
+            user = _row_to_user(row)
+            user["keyword_stats"] = {}
+            users[user.pop("user_id")] = user
+        for row in self.conn.execute("SELECT user_id, keyword, count FROM keyword_stats"):
+            if row["user_id"] in users:
+                users[row["user_id"]]["keyword_stats"][row["keyword"]] = row["count"]
+        return users
+
+    # ------------------------------------------
+    # 失効予定 (ExpiryScheduler 用、書き込みは即時)
+    # ------------------------------------------
+    def add_expiration(self, deadline, kind, guild_id, role_id, member_id):
+        cur = self.conn.execute(
+            "INSERT INTO expirations (deadline, kind, guild_id, role_id, member_id) VALUES (?, ?, ?, ?, ?)",
+            (deadline, kind, guild_id, role_id, member_id),
+        )
+        return cur.lastrowid
+
+    def update_expiration(self, expiration_id, deadline):
+        self.conn.execute("UPDATE expirations SET deadline = ? WHERE id = ?", (deadline, expiration_id))
+
+    def delete_expirations(self, expiration_ids):
+        self.conn.executemany("DELETE FROM expirations WHERE id = ?", [(i,) for i in expiration_ids])
+
+    def load_expirations(self):
+        rows = self.conn.execute("SELECT * FROM expirations ORDER BY deadline")
+        return [dict(row) for row in rows]
+
+    # ------------------------------------------
+    # 一括オンボーディングの進捗 (書き込みは即時)
+    # ------------------------------------------
+    def backfill_enqueue(self, guild_id, member_ids, now):
+        """
+        メンバーを pending にする（前回 failed / done だったメンバーもやり直す）
+        """
+        with self.transaction():
+            self.conn.executemany(
+                "INSERT INTO onboarding_backfill (guild_id, member_id, status, updated_at) VALUES (?, ?, 'pending', ?)"
+                " ON CONFLICT(guild_id, member_id) DO UPDATE SET status = 'pending', updated_at = excluded.updated_at",
+                [(guild_id, member_id, now) for member_id in member_ids],
+            )
+
+    def backfill_mark(self, guild_id, member_ids, status, now):
+        with self.transaction():
+            self.conn.executemany(
+                "UPDATE onboarding_backfill SET status = ?, updated_at = ? WHERE guild_id = ? AND member_id = ?",
+                [(status, now, guild_id, member_id) for member_id in member_ids],
+            )
+
+    def backfill_pending(self, guild_id):
+        rows = self.conn.execute(
+            "SELECT member_id FROM onboarding_backfill WHERE guild_id = ? AND status = 'pending' ORDER BY member_id",
+            (guild_id,),
+        )
+        return [row["member_id"] for row in rows]
+
+    def backfill_counts(self, guild_id):
+        rows = self.conn.execute(
+            "SELECT status, COUNT(*) AS n FROM onboarding_backfill WHERE guild_id = ? GROUP BY status", (guild_id,)
+        )
+        return {row["status"]: row["n"] for row in rows}
+
+    def backfill_guilds(self):
+        """
+        pending が残っている（中断された）ジョブのギルドID
+        """
+        rows = self.conn.execute("SELECT DISTINCT guild_id FROM onboarding_backfill WHERE status = 'pending'")
+        return [row["guild_id"] for row in rows]
+
+    def load_postings(self):
+        """
+        転置インデックスを {keyword: [(user_id, history_id), ...]} で返す
+        （構築済みキーワードの分だけ）
+        """
+        postings = {row["keyword"]: [] for row in self.conn.execute("SELECT keyword FROM indexed_keywords")}
+        rows = self.conn.execute("SELECT keyword, user_id, history_id FROM keyword_postings ORDER BY history_id")
+        for row in rows:
+            if row["keyword"] in postings:
+                postings[row["keyword"]].append((row["user_id"], row["history_id"]))
+        return postings
+
+    def write_batch(self, users, keyword_stats, history, postings=(), indexed_keywords=(), removed_keywords=()):
+        """
+        フラッシュ1回分の変更を1トランザクションで書き込む
+        users: {user_id: user} / keyword_stats: [(user_id, keyword, count)]
+        history: [(id, user_id, content, timestamp, vector_id, vector_space)]
+        postings: [(keyword, history_id, user_id)]
+        indexed_keywords / removed_keywords: 転置インデックスを構築した / 破棄したキーワード
+        """
+        with self.transaction():
+            for keyword in removed_keywords:
+                self.conn.execute("DELETE FROM keyword_postings WHERE keyword = ?", (keyword,))
+                self.conn.execute("DELETE FROM indexed_keywords WHERE keyword = ?", (keyword,))
+            for user_id, user in users.items():
+                self.conn.execute(
+                    "INSERT INTO users (user_id, channel_id, points, expose_count, onboarding_status, connection_enabled, role_id)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT(user_id) DO UPDATE SET channel_id = excluded.channel_id, points = excluded.points,"
+                    " expose_count = excluded.expose_count, onboarding_status = excluded.onboarding_status,"
+                    " connection_enabled = excluded.connection_enabled, role_id = excluded.role_id",
+                    (
+                        user_id,
+                        user.get("channel_id"),
+                        user.get("points", 0),
+                        user.get("expose_count", 0),
+                        user.get("onboarding_status"),
+                        1 if user.get("connection_enabled", True) else 0,
+                        user.get("role_id"),
+                    ),
+                )
+            self.conn.executemany(
+                "INSERT INTO keyword_stats (user_id, keyword, count) VALUES (?, ?, ?)"
+                " ON CONFLICT(user_id, keyword) DO UPDATE SET count = excluded.count",
+                keyword_stats,
+            )
+            self.conn.executemany(
+                "INSERT INTO history (id, user_id, content, timestamp, vector_id, vector_space)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                history,
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO keyword_postings (keyword, history_id, user_id) VALUES (?, ?, ?)",
+                postings,
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO indexed_keywords (keyword) VALUES (?)",
+                [(keyword,) for keyword in indexed_keywords],
+            )
+
+
+def _row_to_user(row):
+    user = dict(row)
+    user["connection_enabled"] = bool(user["connection_enabled"])
+    return user
+
@@ -0,0 +1,168 @@
+import functools
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from metrics import STAGE_SECONDS
+
+
+# ==========================================
+# トレース / サンプリングプロファイラ
+# ==========================================
+# ハンドラとその中の処理段階を「スパン」として計測し、直近のものを
+# リングバッファに残す。スパンは contextvars で親子関係とトレースIDを引き継ぐので、
+# 1件のメッセージ (on_message → 取り込みワーカー → 思考接続) を同じIDで追える。
+# 重くなったときは SamplingProfiler でイベントループのスレッドのスタックを
+# 一定間隔で採取し、flamegraph 用の collapsed stack 形式で書き出す。
+
+_current = ContextVar("noise_trace_span", default=None) # (trace_id, span_id)
+
+
+def new_trace_id():
+    return secrets.token_hex(4)
+
+
+class Tracer:
+    """
+    終了したスパンを {trace_id, span_id, parent_id, name, start, duration} で最大 max_spans 件保持する
+    """
+
+    def __init__(self, max_spans=10000):
+        self.spans = deque(maxlen=max_spans)
+        self._next_id = 0
+
+    def current_trace_id(self):
+        current = _current.get()
+        return current[0] if current else None
+
+    @contextmanager
+    def span(self, name, trace_id=None, stage=False):
+        """
+        スパンを1つ計測する。親がなければ新しいトレースを始める（trace_id で引き継ぎも可）
+        stage=True なら noise_stage_seconds{stage=name} にも記録する
+        """
+        parent = _current.get()
+        if trace_id is None:
+            trace_id = parent[0] if parent else new_trace_id()
+        parent_id = parent[1] if parent and parent[0] == trace_id else None
+        self._next_id += 1
+        span_id = self._next_id
+
+        token = _current.set((trace_id, span_id))
+        start = time.time()
+        began = time.perf_counter()
+        try:
+            yield trace_id
+        finally:
+            duration = time.perf_counter() - began
+            _current.reset(token)
+            self.spans.append({
+                "trace_id": trace_id,
+                "span_id": span_id,
+                "parent_id": parent_id,
+                "name": name,
+                "start": start,
+                "duration": duration,
+            })
+            if stage:
+                STAGE_SECONDS.observe(duration, stage=name)
+
+    def traced(self, name=None):
+        """
+        コルーチン関数全体をスパンで囲むデコレーター
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(name or func.__name__):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def slowest(self, n=10, since=None):
+        """
+        所要時間の長い順に n 件（since 以降に始まったスパンのみ）
+        """
+        spans = [s for s in list(self.spans) if since is None or s["start"] >= since]
+        spans.sort(key=lambda s: s["duration"], reverse=True)
+        return spans[:n]
+
+    def summary(self, since=None):
+        """
+        スパン名ごとの {name: (件数, 合計秒, 最大秒)}
+        """
+        result = {}
+        for s in list(self.spans):
+            if since is not None and s["start"] < since:
+                continue
+            count, total, longest = result.get(s["name"], (0, 0.0, 0.0))
+            result[s["name"]] = (count + 1, total + s["duration"], max(longest, s["duration"]))
+        return result
+
+
+TRACER = Tracer()
+span = TRACER.span
+traced = TRACER.traced
+
+
+class SamplingProfiler:
+    """
+    指定スレッドのスタックを interval 秒ごとに採取する（別スレッドで動く）
+    max_samples に達するか stop() されたら止まる
+    """
+
+    def __init__(self, thread_id, interval=0.005, max_samples=100000):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_samples = max_samples
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval) and self.samples < self.max_samples:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """
+        flamegraph.pl / speedscope が読める collapsed stack 形式 ("f1;f2;f3 回数" を1行ずつ)
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top_functions(self, n=10):
+        """
+        スタックの先頭（実際に実行中だった関数）ごとのサンプル数
+        """
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(n)
@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+
+
+# ==========================================
+# ベクトルストア (float32 / memmap)
+# ==========================================
+# 埋め込みベクトルを JSON の float リストではなく、
+# 追記専用の float32 行列ファイルに保存する。
+# 履歴側は行番号 (vector_id) だけを持つ。
+
+class VectorStore:
+    """
+    追記専用の float32 行列 [行数, dim]
+    読み出しは np.memmap 経由なので、パースもコピーも発生しない
+    """
+
+    def __init__(self, path, dim=768):
+        self.path = path
+        self.dim = dim
+        self.row_bytes = dim * np.dtype(np.float32).itemsize
+
+        if not os.path.exists(path):
+            open(path, "wb").close()
+
+        # 書き込み途中で落ちた場合の半端な行は切り捨てる
+        size = os.path.getsize(path)
+        if size % self.row_bytes:
+            with open(path, "r+b") as f:
+                f.truncate(size - size % self.row_bytes)
+            print(f"VectorStore: truncated a partial row in {path}")
+
+        self._count = os.path.getsize(path) // self.row_bytes
+        self._file = open(path, "ab")
+        self._mm = None
+
+    def __len__(self):
+        return self._count
+
+    def append(self, vector):
+        """
+        ベクトルを1行追記して行番号を返す（次元が合わなければ None）
+        """
+        row = np.asarray(vector, dtype=np.float32).reshape(-1)
+        if row.size != self.dim:
+            print(f"VectorStore: expected {self.dim} dims, got {row.size}")
+            return None
+        self._file.write(row.tobytes())
+        self._file.flush()
+        row_id = self._count
+        self._count += 1
+        return row_id
+
+    def matrix(self):
+        """
+        全行の読み取り専用ビュー [行数, dim]
+        """
+        if self._count == 0:
+            return np.empty((0, self.dim), dtype=np.float32)
+        if self._mm is None or self._mm.shape[0] != self._count:
+            self._mm = np.memmap(self.path, dtype=np.float32, mode="r", shape=(self._count, self.dim))
+        return self._mm
+
+    def get(self, row_id):
+        if row_id is None or not 0 <= row_id < self._count:
+            return None
+        return self.matrix()[row_id]
+
+    def write_compacted(self, row_ids):
+        """
+        row_ids の行だけを順に並べた新しいファイルを作り、そのパスを返す
+        （新しい行番号は row_ids 内の位置。差し替えは swap_in で行う）
+        """
+        compacted = self.path + ".compact"
+        matrix = self.matrix()
+        with open(compacted, "wb") as f:
+            for start in range(0, len(row_ids), 65536):
+                f.write(np.ascontiguousarray(matrix[row_ids[start:start + 65536]]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        return compacted
+
+    def swap_in(self, compacted):
+        """
+        write_compacted で作ったファイルに差し替える
+        """
+        self._file.close()
+        self._mm = None
+        os.replace(compacted, self.path)
+        self._count = os.path.getsize(self.path) // self.row_bytes
+        self._file = open(self.path, "ab")
+
+    def size_bytes(self):
+        return self._count * self.row_bytes
+
+    def close(self):
+        self._file.close()
+        self._mm = None
+
+
+def load_by_space(vector_file, db_path, dim=768):
+    """
+    ベクトル空間 (history.vector_space) → その空間のベクトル行列（計測スクリプト用）
+    埋め込みバックエンドが違うベクトル同士の類似度には意味がないので、空間ごとに分けて返す
+    ファイルがなければ None
+    """
+    if not (os.path.exists(vector_file) and os.path.getsize(vector_file) >= dim * 4 and os.path.exists(db_path)):
+        return None
+    from storage import NoiseStore
+
+    vectors = np.memmap(vector_file, dtype=np.float32, mode="r").reshape(-1, dim)
+    store = NoiseStore(db_path)
+    rows = {}
+    for _, _, _, vector_id, vector_space in store.iter_history():
+        if vector_id is not None and vector_id < len(vectors):
+            rows.setdefault(vector_space or "untagged", []).append(vector_id)
+    store.close()
+    return {space: vectors[np.asarray(ids)] for space, ids in rows.items()}